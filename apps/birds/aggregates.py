@@ -0,0 +1,309 @@
+"""
+This file maintains the summary tables behind the dashboard aggregates
+
+The leaderboards and per-species figures would otherwise group the whole
+sightings table on every page view. Instead they read small tables that hold
+the aggregates already computed (see define_database_tables):
+
+    species_totals        per species: summed counts, sightings, checklist minutes
+    species_daily_totals  per species and observation date: summed counts, sightings
+    observer_totals       per observer: checklists, distinct species
+    observer_species      per observer and species: sightings (backs the distinct count)
+    observer_daily_totals per observer and observation date: checklists
+
+User checklist changes and uploaded batches are applied as deltas in the
+same transaction as the change itself (apply_checklists). Seeding, which
+changes many rows at once, rebuilds the tables from scratch, which can also be
+run by hand to repair them, from the folder containing apps/:
+
+    python -m apps.birds.aggregates
+"""
+import datetime
+from functools import reduce
+from .common import db
+
+# Periods a species time series can be rolled up to, each mapped to the
+# first day of the period containing a date (weeks start on Monday)
+GRANULARITIES = {
+    'day': lambda date: date,
+    'week': lambda date: date - datetime.timedelta(days=date.weekday()),
+    'month': lambda date: date.replace(day=1),
+    'year': lambda date: date.replace(month=1, day=1),
+}
+
+
+def _summaries(scope=None):
+    """
+    The delta-maintained summary tables with the grouped query each is filled from
+
+    Args:
+        scope (list, optional): Only aggregate the sightings of these checklist ids
+
+    Returns:
+        list: (table, query, left join, {key field: expression}, {value field: expression}, count field)
+    """
+    sightings, checklist = db.sightings, db.checklist
+    count = sightings.OBSERVATION_COUNT.coalesce_zero()
+    linked = (sightings.species_id != None)
+    joined = linked & (sightings.checklist_id == checklist.id)
+    checklists = checklist.id > 0
+    if scope is not None:
+        linked &= sightings.checklist_id.belongs(scope)
+        joined &= sightings.checklist_id.belongs(scope)
+        checklists = checklist.id.belongs(scope)
+
+    return [
+        (db.species_totals, linked, checklist.on(checklist.id == sightings.checklist_id),
+            {'species_id': sightings.species_id},
+            {'total_count': count.sum(), 'sightings': sightings.id.count(),
+             'total_minutes': checklist.DURATION_MINUTES.coalesce_zero().sum()},
+            'sightings'),
+        (db.species_daily_totals, joined, None,
+            {'species_id': sightings.species_id, 'OBSERVATION_DATE': checklist.OBSERVATION_DATE},
+            {'total_count': count.sum(), 'sightings': sightings.id.count()},
+            'sightings'),
+        (db.observer_species, joined, None,
+            {'OBSERVER_ID': checklist.OBSERVER_ID, 'species_id': sightings.species_id},
+            {'sightings': sightings.id.count()},
+            'sightings'),
+        (db.observer_totals, checklists, None,
+            {'OBSERVER_ID': checklist.OBSERVER_ID},
+            {'checklists': checklist.id.count()},
+            'checklists'),
+        (db.observer_daily_totals, checklists, None,
+            {'OBSERVER_ID': checklist.OBSERVER_ID, 'OBSERVATION_DATE': checklist.OBSERVATION_DATE},
+            {'checklists': checklist.id.count()},
+            'checklists'),
+    ]
+
+
+def apply_checklists(checklist_ids, sign):
+    """
+    Add (sign=1) or remove (sign=-1) the contribution of checklists to the summary tables
+
+    Called with -1 before checklists or their sightings change and with 1
+    after, inside the same transaction. The caller commits.
+
+    Args:
+        checklist_ids (list): IDs of the checklist rows
+        sign (int): 1 to add, -1 to remove
+    """
+    checklist_ids = list(checklist_ids)
+    if checklist_ids:
+        _apply(_summaries(checklist_ids), sign)
+
+
+def apply_unlinked_sightings(events, sign):
+    """
+    Add (sign=1) or remove (sign=-1) the contribution of sightings not linked to a checklist
+
+    Such sightings only count in species_totals (see rebuild). Called around
+    the linking of the sightings of some sampling events, inside the same
+    transaction; the caller commits.
+
+    Args:
+        events (list): SAMPLING_EVENT_IDENTIFIER values of the sightings
+        sign (int): 1 to add, -1 to remove
+    """
+    events = list(events)
+    if not events:
+        return
+    sightings = db.sightings
+    unlinked = (
+        sightings.SAMPLING_EVENT_IDENTIFIER.belongs(events) &
+        (sightings.checklist_id == None) & (sightings.species_id != None)
+    )
+    _apply([(db.species_totals, unlinked, None,
+             {'species_id': sightings.species_id},
+             {'total_count': sightings.OBSERVATION_COUNT.coalesce_zero().sum(),
+              'sightings': sightings.id.count()},
+             'sightings')], sign)
+
+
+def _apply(summaries, sign):
+    """Add or remove the grouped rows of summaries (as from _summaries) to their tables"""
+    observers = set()
+    for table, query, left, keys, values, count_field in summaries:
+        rows = db(query).select(*keys.values(), *values.values(), left=left, groupby=list(keys.values()))
+        for row in rows:
+            key = {name: row[expression] for name, expression in keys.items()}
+            delta = {name: (row[expression] or 0) * sign for name, expression in values.items()}
+            match = reduce(lambda a, b: a & b, (table[name] == value for name, value in key.items()))
+            if not db(match).update(**{name: table[name] + value for name, value in delta.items()}):
+                table.insert(**key, **delta)
+            db(match & (table[count_field] <= 0)).delete()
+            if 'OBSERVER_ID' in key:
+                observers.add(key['OBSERVER_ID'])
+
+    # Distinct species per observer is the number of its observer_species rows
+    for observer in observers:
+        db(db.observer_totals.OBSERVER_ID == observer).update(
+            species=db(db.observer_species.OBSERVER_ID == observer).count()
+        )
+
+
+def rebuild(verbose=True):
+    """
+    Recompute every summary table from sightings and checklist, in one transaction
+
+    Sightings not linked to a checklist still count in species_totals, as
+    they did when the totals were computed per request.
+
+    Args:
+        verbose (bool): Print the number of rows written per table
+    """
+    sightings, checklist = db.sightings, db.checklist
+    for table, query, left, keys, values, count_field in _summaries():
+        if table is db.observer_totals:
+            # Checklists without sightings still count for their observer
+            query, left = checklist.id > 0, sightings.on(
+                (sightings.checklist_id == checklist.id) & (sightings.species_id != None)
+            )
+            values = {'checklists': checklist.id.count(distinct=True),
+                      'species': sightings.species_id.count(distinct=True)}
+        select = db(query)._select(*keys.values(), *values.values(), left=left, groupby=list(keys.values()))
+        columns = ', '.join(table[name]._rname for name in [*keys, *values])
+        db(table).delete()
+        db.executesql(f"INSERT INTO {table._rname} ({columns}) {select.rstrip().rstrip(';')};")
+        if verbose:
+            print(f"{table._tablename}: {db(table).count()} rows.")
+    db.commit()
+
+
+def _indexed_select(query, table, index, *fields, **attributes):
+    """
+    Select through a given index of the query's first table
+
+    On SQLite the index is named with INDEXED BY, so the planner cannot trade
+    the range it bounds for an index matching the GROUP BY, which would walk
+    the whole table. Other backends choose their own plan.
+
+    Returns:
+        list: Tuples of the field values
+    """
+    if db._dbname != 'sqlite':
+        return [tuple(row[field] for field in fields) for row in db(query).select(*fields, **attributes)]
+    sql = db(query)._select(*fields, **attributes)
+    return db.executesql(sql.replace(f"FROM {table._rname}", f'FROM {table._rname} INDEXED BY "{index}"', 1))
+
+
+def leaderboard(limit, since=None):
+    """
+    Observers ranked by number of checklists
+
+    All-time rankings are read from observer_totals through its index on
+    checklists, so only the returned rows are touched. A ranking since a
+    date sums the observer_daily_totals rows of the window, a range of their
+    date index, and then counts the distinct species of the observers
+    returned only, from their checklists in the window.
+
+    Args:
+        limit (int): Number of observers to return
+        since (datetime.date, optional): Only count checklists observed on or after this date
+
+    Returns:
+        list: Dicts with name, total_observations (checklists) and unique_species
+    """
+    if since is None:
+        rows = db(db.observer_totals).select(
+            db.observer_totals.OBSERVER_ID,
+            db.observer_totals.checklists,
+            db.observer_totals.species,
+            orderby=~db.observer_totals.checklists,
+            limitby=(0, limit)
+        )
+        return [
+            dict(name=row.OBSERVER_ID, total_observations=row.checklists, unique_species=row.species)
+            for row in rows
+        ]
+
+    daily = db.observer_daily_totals
+    checklists = daily.checklists.sum()
+    ranked = _indexed_select(
+        daily.OBSERVATION_DATE >= since, daily, 'idx_observer_daily_totals',
+        daily.OBSERVER_ID, checklists,
+        groupby=daily.OBSERVER_ID, orderby=~checklists, limitby=(0, limit)
+    )
+    if not ranked:
+        return []
+
+    sightings, checklist = db.sightings, db.checklist
+    species = sightings.species_id.count(distinct=True)
+    named = [observer for observer, _ in ranked if observer is not None]
+    # NULL matches no IN list: checklists without an observer are counted apart
+    queries = [checklist.OBSERVER_ID.belongs(named)] if named else []
+    if len(named) < len(ranked):
+        queries.append(checklist.OBSERVER_ID == None)
+    counts = {}
+    for query in queries:
+        counts.update(_indexed_select(
+            query & (checklist.OBSERVATION_DATE >= since), checklist, 'idx_checklist_observer',
+            checklist.OBSERVER_ID, species,
+            left=sightings.on(sightings.checklist_id == checklist.id),
+            groupby=checklist.OBSERVER_ID
+        ))
+    return [
+        dict(name=observer, total_observations=total, unique_species=counts.get(observer, 0))
+        for observer, total in ranked
+    ]
+
+
+def daily_series(species_ids, start=None, end=None):
+    """
+    Summed observation counts per observation date, from species_daily_totals
+
+    Reads one row per species and date through the table's index, however
+    many sightings those days hold.
+
+    Args:
+        species_ids (list): Species to include
+        start, end (datetime.date, optional): Inclusive date range
+
+    Returns:
+        list: (datetime.date, total count) tuples
+    """
+    daily = db.species_daily_totals
+    query = daily.species_id.belongs(species_ids)
+    if start:
+        query &= daily.OBSERVATION_DATE >= start
+    if end:
+        query &= daily.OBSERVATION_DATE <= end
+    return [(row.OBSERVATION_DATE, row.total_count) for row in db(query).select(
+        daily.OBSERVATION_DATE, daily.total_count
+    )]
+
+
+def roll_up(daily, granularity, limit=None):
+    """
+    Sum daily totals into periods
+
+    Args:
+        daily (iterable): (datetime.date, total count) tuples
+        granularity (str): 'day', 'week', 'month' or 'year' (see GRANULARITIES)
+        limit (int, optional): Only keep the most recent periods
+
+    Returns:
+        list: (first day of the period, total count) tuples, latest first
+    """
+    period_start = GRANULARITIES[granularity]
+    totals = {}
+    for date, total in daily:
+        if date is None:
+            continue
+        period = period_start(date)
+        totals[period] = totals.get(period, 0) + (total or 0)
+    return sorted(totals.items(), reverse=True)[:limit]
+
+
+def needs_rebuild():
+    """Whether summary tables are empty while there are sightings or checklists to summarise"""
+    return (
+        (db(db.species_totals).isempty() and not db(db.sightings).isempty()) or
+        (db(db.observer_daily_totals).isempty() and not db(db.checklist).isempty())
+    )
+
+
+if __name__ == '__main__':
+    # Importing the models defines (and seeds) the tables
+    from . import models
+    rebuild()
@@ -0,0 +1,455 @@
+"""
+This file defines the optional in-memory analytics engine
+
+When NumPy is installed (and settings.ANALYTICS_ENGINE is on), every sighting
+is kept in memory as one row of column arrays, joined to its checklist:
+checklist id, latitude, longitude, observation date, species id, count and
+checklist duration. Bounding-box filters, per-species sums, top-k and date
+bucketing are then single vectorized passes over these columns instead of
+SQL aggregations.
+
+The columns record the 'checklist' data version they hold (see
+response_cache.py). User checklist writes refresh the rows of the checklists
+they touch, before committing, move the store to the version they bumped,
+and log the checklist ids under that version in the checklist_changes table.
+A store found behind the committed version (writes made by other worker
+processes) catches up by refreshing the checklists logged since its own
+version, which costs as much as the writes did.
+
+The engine never makes a request wait for a full load: the columns are
+loaded in a background thread on first use, after invalidate() (seeding,
+uploads and other bulk changes, which are not logged), when the log cannot
+bring the store up to date (it keeps settings.ANALYTICS_CHANGE_LOG_VERSIONS
+versions) and every settings.ANALYTICS_MAX_AGE seconds. Until a store holds
+the committed version, its queries return None and the endpoints answer
+from SQL, so no cached response is ever computed from data older than its
+version. Checklist refreshes made during a load are replayed onto the new
+columns.
+
+Without NumPy, engine.available() is False and the endpoints use their SQL
+queries.
+"""
+import time
+import threading
+import contextlib
+from .common import db, logger, settings
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Column name -> dtype; a missing checklist id is stored as -1, a missing
+# species id (ids start at 1), count or duration as 0, missing coordinates as
+# NaN and missing dates as NaT
+COLUMNS = {
+    'checklist_id': 'int64',
+    'lat': 'float64',
+    'lon': 'float64',
+    'date': 'datetime64[D]',
+    'species_id': 'int64',
+    'count': 'int64',
+    'minutes': 'float64',
+}
+
+LOAD_CHUNK_ROWS = 50000
+
+
+def data_version():
+    """The committed data version of checklists and their sightings (see response_cache.py)"""
+    data_versions = db.data_versions
+    latest = data_versions.version.max()
+    return db(data_versions.name == 'checklist').select(latest).first()[latest] or 0
+
+
+def log_changes(checklist_ids, version):
+    """
+    Record the checklists a write changed under the 'checklist' version it bumped
+
+    Called in the writing transaction, so the log commits with the change.
+    Versions older than settings.ANALYTICS_CHANGE_LOG_VERSIONS are pruned.
+
+    Args:
+        checklist_ids (list): IDs of the changed checklist rows
+        version (int): The version the change was bumped to
+    """
+    changes = db.checklist_changes
+    # A write changing no checklist row still logs its version
+    for checklist_id in set(checklist_ids) or {None}:
+        changes.insert(version=version, checklist_id=checklist_id)
+    db(changes.version <= version - settings.ANALYTICS_CHANGE_LOG_VERSIONS).delete()
+
+
+def logged_changes(since, version):
+    """
+    Checklists changed by the versions after since, up to version
+
+    Returns:
+        set: checklist ids, or None when some version is not logged (bulk
+            changes, or pruned)
+    """
+    changes = db.checklist_changes
+    rows = db((changes.version > since) & (changes.version <= version)).select(
+        changes.version, changes.checklist_id
+    )
+    if len({row.version for row in rows}) < version - since:
+        return None
+    return {row.checklist_id for row in rows if row.checklist_id}
+
+
+class ColumnStore:
+    """
+    Sightings as NumPy column arrays, for vectorized aggregates
+
+    Rows are appended into arrays with spare capacity; rows of changed or
+    deleted checklists are flagged dead in the alive column and dropped when
+    more than a quarter of the rows are dead.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Held while loading, so concurrent requests do not each read every sighting
+        self._load_lock = threading.Lock()
+        # Held while catching up from the change log
+        self._replay_lock = threading.Lock()
+        self._columns = None
+        self._size = 0
+        self._dead = 0
+        self._loaded = None
+        # Data version of the loaded rows
+        self._version = None
+        # Counts invalidations, so a load started before one does not clear it
+        self._generation = 0
+        # Refreshes made while a load is in flight, as (checklist ids, fresh
+        # columns, version they apply to, version they move to), to replay
+        # onto the new columns
+        self._pending = None
+        # Column snapshot pinned by the current thread (see pinned)
+        self._pinned = threading.local()
+
+    def available(self):
+        """Whether the engine can be used (NumPy installed and enabled)"""
+        return np is not None and settings.ANALYTICS_ENGINE
+
+    @staticmethod
+    def _select(query):
+        sightings, checklist = db.sightings, db.checklist
+        return db(query)._select(
+            checklist.id.coalesce(-1),
+            checklist.LATITUDE,
+            checklist.LONGITUDE,
+            checklist.OBSERVATION_DATE,
+            sightings.species_id.coalesce_zero(),
+            sightings.OBSERVATION_COUNT.coalesce_zero(),
+            checklist.DURATION_MINUTES.coalesce_zero(),
+            left=checklist.on(checklist.id == sightings.checklist_id)
+        )
+
+    @staticmethod
+    def _to_columns(rows):
+        if not rows:
+            return {name: np.empty(0, dtype=dtype) for name, dtype in COLUMNS.items()}
+        values = list(zip(*rows))
+        return {
+            name: np.array(column, dtype=dtype)
+            for (name, dtype), column in zip(COLUMNS.items(), values)
+        }
+
+    def load(self):
+        """Reload every sighting from the database"""
+        with self._load_lock:
+            self._load()
+
+    def _load_in_background(self):
+        try:
+            # This runs in its own thread: connect to the db
+            db._adapter.reconnect()
+            self._load()
+        except Exception as e:
+            logger.error(f"Error loading the analytics columns: {str(e)}")
+        finally:
+            db.rollback()
+            # Release this thread's connection (DAL.close only works in the
+            # thread that created the DAL)
+            db._adapter.close()
+            self._load_lock.release()
+
+    def load_in_background(self):
+        """Reload in a background thread, unless a load is already in flight"""
+        if self._load_lock.acquire(blocking=False):
+            try:
+                threading.Thread(target=self._load_in_background, daemon=True).start()
+            except Exception:
+                self._load_lock.release()
+                raise
+
+    def _read(self):
+        """
+        Every sighting, as columns
+
+        Returns:
+            tuple: (data version, columns dict)
+        """
+        # Read first: rows committed meanwhile only make the store newer
+        version = data_version()
+        db._adapter.execute(self._select(db.sightings.id > 0))
+        cursor = db._adapter.cursor
+        chunks = []
+        while True:
+            rows = cursor.fetchmany(LOAD_CHUNK_ROWS)
+            if not rows:
+                break
+            chunks.append(self._to_columns(rows))
+        columns = {
+            name: np.concatenate([chunk[name] for chunk in chunks]) if chunks else np.empty(0, dtype=dtype)
+            for name, dtype in COLUMNS.items()
+        }
+        columns['alive'] = np.ones(len(columns['checklist_id']), dtype=bool)
+        return version, columns
+
+    def _load(self):
+        """Reload every sighting; the caller holds the load lock"""
+        with self._lock:
+            generation, self._pending = self._generation, []
+        try:
+            version, columns = self._read()
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+        with self._lock:
+            self._columns, self._size, self._dead = columns, len(columns['alive']), 0
+            self._version = version
+            # Invalidated meanwhile: these rows may be stale too
+            self._loaded = time.monotonic() if generation == self._generation else None
+            for checklist_ids, fresh, since, refreshed_version in self._pending:
+                self._apply(checklist_ids, fresh, since, refreshed_version)
+            self._pending = None
+
+    def invalidate(self):
+        """Reload on next use (after bulk changes such as seeding or uploads)"""
+        with self._lock:
+            self._loaded = None
+            self._generation += 1
+
+    def refresh_checklists(self, checklist_ids, version=None):
+        """
+        Re-read the sightings of the given checklists after they changed
+
+        Rows previously loaded for these checklists are flagged dead, and
+        their current sightings (none, if deleted) are appended. Called in
+        the writing transaction, after the data version was bumped and before
+        it is committed; the change is also logged for other processes (see
+        log_changes). The rows are not refreshed until the store has been
+        loaded.
+
+        Args:
+            checklist_ids (list): IDs of the changed checklist rows
+            version (int, optional): The 'checklist' version the change was
+                bumped to; the store holds it afterwards if it held the one
+                before, and catches up from the log on next use otherwise
+        """
+        checklist_ids = [checklist_id for checklist_id in checklist_ids if checklist_id]
+        if not self.available():
+            return
+        if version is not None:
+            log_changes(checklist_ids, version)
+        self._refresh(checklist_ids, None if version is None else version - 1, version)
+
+    def _refresh(self, checklist_ids, since, version):
+        """Re-read checklists' sightings, moving the store from version since to version"""
+        if self._loaded is None and self._pending is None:
+            return
+        fresh = None
+        if checklist_ids:
+            fresh = self._to_columns(db.executesql(self._select(db.sightings.checklist_id.belongs(checklist_ids))))
+        with self._lock:
+            if self._pending is not None:
+                # The load in flight may have read these checklists before the change
+                self._pending.append((checklist_ids, fresh, since, version))
+            if self._columns is not None:
+                self._apply(checklist_ids, fresh, since, version)
+
+    def _apply(self, checklist_ids, fresh, since, version):
+        """Swap in the fresh rows of refreshed checklists; the caller holds the lock"""
+        if fresh is not None:
+            columns, size = self._columns, self._size
+            added = len(fresh['checklist_id'])
+            stale = columns['alive'][:size] & np.isin(columns['checklist_id'][:size], checklist_ids)
+            columns['alive'][:size][stale] = False
+            self._dead += int(stale.sum())
+
+            if size + added > len(columns['alive']):
+                # Grow into new arrays; queries holding the old ones are unaffected
+                capacity = max(2 * len(columns['alive']), size + added, 1024)
+                grown = {}
+                for name, column in columns.items():
+                    grown[name] = np.empty(capacity, dtype=column.dtype)
+                    grown[name][:size] = column[:size]
+                columns = grown
+            for name in COLUMNS:
+                columns[name][size:size + added] = fresh[name]
+            columns['alive'][size:size + added] = True
+            size += added
+
+            if self._dead * 4 > size:
+                alive = columns['alive'][:size]
+                columns = {name: column[:size][alive] for name, column in columns.items()}
+                size, self._dead = len(columns['alive']), 0
+            self._columns, self._size = columns, size
+        if version is not None and self._version == since:
+            self._version = version
+
+    @contextlib.contextmanager
+    def pinned(self):
+        """
+        Serve one column snapshot to every query of the enclosed block
+
+        Queries made by the current thread inside the block all see the same
+        rows, even if the store reloads or other threads refresh checklists
+        meanwhile; when the store is not current, they all return None.
+        """
+        if not self.available() or getattr(self._pinned, 'active', False):
+            yield
+            return
+        columns = self._snapshot()
+        if columns is not None:
+            # refresh_checklists flags rows dead in place: keep this block's flags
+            columns['alive'] = columns['alive'].copy()
+        self._pinned.active, self._pinned.columns = True, columns
+        try:
+            yield
+        finally:
+            self._pinned.active, self._pinned.columns = False, None
+
+    def _catch_up(self, current):
+        """
+        Refresh the checklists other processes changed since the store's version
+
+        Returns:
+            bool: Whether the store now holds the current version, or None
+                if some of the versions are not in the log
+        """
+        if not self._replay_lock.acquire(blocking=False):
+            # Another thread is catching up
+            return False
+        try:
+            since = self._version
+            if since >= current:
+                return True
+            checklist_ids = logged_changes(since, current)
+            if checklist_ids is None:
+                return None
+            self._refresh(sorted(checklist_ids), since, current)
+            return self._version >= current
+        finally:
+            self._replay_lock.release()
+
+    def _snapshot(self):
+        """The current columns, or None while the store is not at the committed version"""
+        if getattr(self._pinned, 'active', False):
+            return self._pinned.columns
+        current = data_version()
+        if self._loaded is None:
+            # Not loaded, or invalidated: answer from SQL until loaded
+            self.load_in_background()
+            return None
+        if self._version < current:
+            caught_up = self._catch_up(current)
+            if caught_up is None:
+                # Some versions are not in the log: reload
+                self.load_in_background()
+            if not caught_up:
+                return None
+        if time.monotonic() - self._loaded > settings.ANALYTICS_MAX_AGE:
+            # Only old: reload, answering from these rows meanwhile
+            self.load_in_background()
+        with self._lock:
+            size = self._size
+            return {name: column[:size] for name, column in self._columns.items()}
+
+    @staticmethod
+    def _species_sums(species, weights):
+        """Per-species sums of weights, for the species present (unlinked rows are in bin 0)"""
+        present = np.bincount(species)
+        sums = np.bincount(species, weights=weights)
+        present[:1] = 0
+        species_ids = np.nonzero(present)[0]
+        return species_ids, sums[species_ids]
+
+    @staticmethod
+    def _top(species_ids, sums, limit):
+        """The limit largest sums, largest first (ties by species id)"""
+        order = np.lexsort((species_ids, -sums))[:limit]
+        return [(int(species_ids[i]), sums[i].item()) for i in order]
+
+    @staticmethod
+    def _inside(columns, bounds):
+        """Mask of the rows whose checklist lies in a (south, north, west, east) box"""
+        south, north, west, east = bounds
+        lat, lon = columns['lat'], columns['lon']
+        return (lat >= south) & (lat <= north) & (lon >= west) & (lon <= east)
+
+    def top_species(self, measure, limit, bounds=None):
+        """
+        Species with the highest total of a measure
+
+        Args:
+            measure (str): 'count' (summed observation counts) or 'minutes'
+                (summed durations of the checklists each species was seen on)
+            limit (int): Number of species
+            bounds (tuple, optional): (south, north, west, east) to only
+                count checklists inside a bounding box
+
+        Returns:
+            list: (species id, total) tuples, largest total first, or None
+                while the store is not current
+        """
+        columns = self._snapshot()
+        if columns is None:
+            return None
+        species, weights = columns['species_id'], columns[measure]
+        mask = None if columns['alive'].all() else columns['alive']
+        if bounds is not None:
+            inside = self._inside(columns, bounds)
+            mask = inside if mask is None else mask & inside
+        if mask is not None:
+            species, weights = species[mask], weights[mask]
+        species_ids, sums = self._species_sums(species, weights)
+        if measure == 'count':
+            sums = sums.astype('int64')
+        return self._top(species_ids, sums, limit)
+
+    def species_dates(self, species_ids, start=None, end=None, bounds=None):
+        """
+        Summed observation counts per observation date for some species
+
+        Args:
+            species_ids (list): Species to include
+            start, end (datetime.date, optional): Inclusive date range
+            bounds (tuple, optional): (south, north, west, east) to only
+                count checklists inside a bounding box
+
+        Returns:
+            list: (datetime.date, total count) tuples, by date, or None
+                while the store is not current
+        """
+        columns = self._snapshot()
+        if columns is None:
+            return None
+        dates = columns['date']
+        mask = columns['alive'] & np.isin(columns['species_id'], list(species_ids)) & ~np.isnat(dates)
+        if start:
+            mask &= dates >= np.datetime64(start, 'D')
+        if end:
+            mask &= dates <= np.datetime64(end, 'D')
+        if bounds is not None:
+            mask &= self._inside(columns, bounds)
+        if not mask.any():
+            return []
+        unique_dates, positions = np.unique(dates[mask], return_inverse=True)
+        totals = np.bincount(positions, weights=columns['count'][mask]).astype('int64')
+        return list(zip(unique_dates.astype(object), totals.tolist()))
+
+
+engine = ColumnStore()
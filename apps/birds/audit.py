@@ -0,0 +1,170 @@
+"""
+Query-plan audit for the analytic actions in controllers.py
+
+Each audited action is run once with representative parameters while the SQL
+it issues is captured. Every distinct statement is then passed through
+EXPLAIN QUERY PLAN, and the audit fails if any of them reads a table with a
+full scan instead of an index.
+
+Run from the folder containing apps/ (SQLite only):
+
+    python -m apps.birds.audit
+
+The exit status is 1 if any query shape falls back to a full table scan.
+"""
+import io
+import re
+import sys
+import json
+import inspect
+from py4web import request
+from .common import db
+from . import controllers, pagination
+
+# Scans accepted on purpose, as {(action, table): reason}
+ALLOWED_SCANS = {}
+
+SAMPLE_USER_EMAIL = "audit@example.com"
+
+FULL_SCAN = re.compile(r'^SCAN (?:TABLE )?"?(\w+)"?(?: AS \w+)?$')
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def audited_requests():
+    """
+    Build the audited requests from sample values present in the database
+
+    Returns:
+        list: (action name, method, parameters) tuples
+    """
+    species = db(db.sightings).select(db.sightings.COMMON_NAME, limitby=(0, 1)).first()
+    species = species.COMMON_NAME if species else "Song Sparrow"
+    checklist = db(db.checklist).select(limitby=(0, 1)).first()
+    lat, lon = (checklist.LATITUDE, checklist.LONGITUDE) if checklist else (37.0, -122.0)
+    since = checklist.OBSERVATION_DATE.isoformat() if checklist else "2021-01-01"
+    bounds = dict(north=lat + 1, south=lat - 1, east=lon + 1, west=lon - 1)
+    return [
+        ('get_bird_sightings', 'POST', bounds),
+        ('get_bird_sightings', 'POST', dict(bounds, species=species)),
+        ('get_bird_sightings', 'POST', dict(bounds, zoom=8)),
+        ('get_bird_sightings', 'POST', dict(north=85, south=-85, east=180, west=-180, zoom=2)),
+        ('get_hotspot_details', 'POST', dict(lat=lat, lon=lon)),
+        ('get_hotspot_details', 'POST', dict(lat=lat, lon=lon, species=species)),
+        ('get_hotspot_details', 'POST', dict(lat=lat, lon=lon, radius_km=25)),
+        ('get_hotspot_details', 'POST', dict(lat=lat, lon=lon, nearest=10)),
+        ('get_user_checklist_statistics', 'GET', {}),
+        ('search_species', 'GET', dict(q=species[:4])),
+        ('search_species', 'GET', dict(q=species[:4], min_obs=5)),
+        ('search_species', 'GET', dict(q=species[1:6], limit=5)),
+        ('get_checklist_species_count', 'GET', dict(checklist_id=1)),
+        ('get_species_statistics', 'POST', dict(species=species)),
+        ('get_region_statistics', 'GET', bounds),
+        ('get_region_statistics', 'GET', dict(north=85, south=-85, east=180, west=-180)),
+        ('get_region_statistics', 'GET', dict(north=85, south=-85, east=180, west=-180, approximate='true')),
+        ('get_species_time_series', 'POST', dict(species=species)),
+        ('get_species_time_series', 'POST', dict(species=species, granularity='month', start='2000-01-01')),
+        ('get_species_time_series', 'POST', dict(bounds, species=species, granularity='week')),
+        ('get_top_contributors', 'GET', {}),
+        ('get_top_contributors', 'GET', dict(limit=100)),
+        ('get_top_contributors', 'GET', dict(since=since, limit=20)),
+        ('get_top_contributors', 'GET', dict(since=since, limit=20, approximate='true')),
+        ('get_top_observed_birds', 'GET', {}),
+        ('get_bird_observation_times', 'GET', {}),
+        ('get_species', 'GET', dict(limit=50)),
+        ('get_species', 'GET', dict(limit=50, sort='-COMMON_NAME', after=pagination.encode_cursor('-COMMON_NAME', species, 1))),
+        ('get_checklists', 'GET', dict(limit=50, after=pagination.encode_cursor('id', None, 1))),
+        ('get_checklists', 'GET', dict(limit=50, sort='OBSERVATION_DATE', after=pagination.encode_cursor('OBSERVATION_DATE', since, 1))),
+        ('get_checklists', 'GET', dict(limit=50, sort='-OBSERVATION_DATE', fields='LATITUDE,LONGITUDE')),
+        ('get_my_checklists', 'GET', dict(limit=50)),
+        ('get_my_checklists', 'GET', dict(limit=50, sort='-OBSERVATION_DATE', after=pagination.encode_cursor('-OBSERVATION_DATE', since, 1))),
+    ]
+
+
+def _bind_request(method, params):
+    """Point the global request at a synthetic GET query or POST JSON body"""
+    if method == 'POST':
+        body = json.dumps(params).encode('utf-8')
+        query_string = ''
+    else:
+        body = b''
+        query_string = '&'.join(f"{key}={value}" for key, value in params.items())
+    request.__init__({
+        'REQUEST_METHOD': method,
+        'PATH_INFO': '/audit',
+        'QUERY_STRING': query_string,
+        'CONTENT_TYPE': 'application/json',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': io.BytesIO(body),
+    })
+
+
+def capture_queries(action_name, method, params):
+    """
+    Run an action body (without its fixtures) and capture the SELECTs it issues
+
+    Returns:
+        tuple: (list of SQL statements, action result)
+    """
+    _bind_request(method, params)
+    get_user_email = controllers.get_user_email
+    controllers.get_user_email = lambda: SAMPLE_USER_EMAIL
+    # pydal keeps only the last 100 timings, so start from an empty list
+    del db._timings[:]
+    try:
+        # Unwrapped past the response cache, so every request reaches the database
+        result = inspect.unwrap(getattr(controllers, action_name))()
+    finally:
+        controllers.get_user_email = get_user_email
+        db.rollback()
+    statements = [sql for sql, _ in db._timings if sql.lstrip().upper().startswith('SELECT ')]
+    return [sql for sql in statements if sql.strip().rstrip(';') != 'SELECT 1'], result
+
+
+def full_scans(sql):
+    """
+    Run EXPLAIN QUERY PLAN and return the tables read with a full scan
+
+    Returns:
+        tuple: (list of plan detail lines, list of fully scanned table names)
+    """
+    plan = [row[-1] for row in db.executesql("EXPLAIN QUERY PLAN " + sql)]
+    scanned = [match.group(1) for match in map(FULL_SCAN.match, plan) if match]
+    return plan, scanned
+
+
+def run_audit(verbose=True):
+    """
+    Audit the query plans of every audited action
+
+    Returns:
+        list: Failures as (action, table, SQL statement) tuples
+    """
+    if db._dbname != 'sqlite':
+        raise RuntimeError("The query-plan audit only supports SQLite")
+
+    failures = []
+    shapes = set()
+    for action_name, method, params in audited_requests():
+        statements, result = capture_queries(action_name, method, params)
+        if isinstance(result, dict) and result.get('error'):
+            print(f"[ERROR] {action_name}: {result['error']}")
+            failures.append((action_name, None, None))
+        for sql in statements:
+            shape = LITERALS.sub('?', sql)
+            if shape in shapes:
+                continue
+            shapes.add(shape)
+            plan, scanned = full_scans(sql)
+            problems = [table for table in scanned if (action_name, table) not in ALLOWED_SCANS]
+            if verbose or problems:
+                print(f"[{'FAIL' if problems else 'ok'}] {action_name}: {shape}")
+                for line in plan:
+                    print(f"        {line}")
+            failures.extend((action_name, table, sql) for table in problems)
+
+    print(f"{len(shapes)} query shapes audited, {len(failures)} problem(s).")
+    return failures
+
+
+if __name__ == '__main__':
+    sys.exit(1 if run_audit(verbose='-q' not in sys.argv) else 0)
@@ -1,32 +1,101 @@
-from py4web import action, request, abort, redirect, URL
+import io
+import re
+import gzip
+import json
+import uuid
+import contextlib
+import datetime
+from py4web import action, request, response, abort, redirect, URL, HTTP
 from yatl.helpers import A
-from .common import db, session, T, cache, auth, logger, authenticated, unauthenticated, flash
+from .common import db, session, T, cache, auth, logger, authenticated, unauthenticated, flash, settings
 from py4web.utils.url_signer import URLSigner
-from .models import get_user_email
+from .models import (get_user_email, DataSeeder, mirror_user_checklist,
+                     user_checklist_identifier, link_sighting_references, get_species_id)
+from . import (ingest, spatial, tiles, formats, aggregates, analytics, regions, sketches, species_search,
+               pagination)
+from .user_stats import UserStatistics
+from .response_cache import responses
+
+def species_filter(species_name):
+    """Query matching the sightings of one species through its integer id"""
+    return db.sightings.species_id.belongs(
+        db(db.species.COMMON_NAME == species_name)._select(db.species.id)
+    )
+
+def species_names(species_ids):
+    """
+    Resolve species ids to common names
+
+    Aggregates group sightings on species_id; names are looked up only for
+    the rows that are actually returned.
+
+    Returns:
+        dict: Common name by species id
+    """
+    rows = db(db.species.id.belongs(set(species_ids))).select(db.species.id, db.species.COMMON_NAME)
+    return {row.id: row.COMMON_NAME for row in rows}
 
 class ChecklistManager:
     url_signer = URLSigner(session)
 
     @classmethod
-    def get_checklists(cls, table=db.checklist):
+    def get_checklists(cls, table=db.checklist, query=None):
         """
-        Retrieve checklists from a specified table
-        
-       Args:
+        Retrieve one page of checklists from a specified table
+
+        Pages are read in keyset order (see pagination.py), from the request's
+        query parameters:
+        - limit: Rows per page (default: settings.LIST_PAGE_SIZE, at most
+          settings.LIST_MAX_PAGE_SIZE)
+        - after: The next cursor returned with the previous page
+        - sort: id (default) or a field of pagination.SORT_FIELDS, prefixed
+          with - for descending order
+        - fields: Comma-separated names of the fields to return (default: all)
+
+        Args:
             table: Database table to retrieve checklists from (default: checklist)
-        
+            query (optional): Only retrieve the rows matching it
+
         Returns:
-            dict: Checklists or error information
+            dict: Checklists and the cursor of the next page (None on the
+                last page), or error information
         """
         try:
-            checklists = db(table).select().as_list()
-            return dict(checklists=checklists)
+            limit = int(request.params.get("limit") or settings.LIST_PAGE_SIZE)
+            if limit < 1:
+                return dict(error="limit must be positive")
+            fields = request.params.get("fields")
+            checklists, cursor = pagination.paginate(
+                db, table, query,
+                limit=min(limit, settings.LIST_MAX_PAGE_SIZE),
+                after=request.params.get("after") or None,
+                sort=request.params.get("sort") or 'id',
+                fields=[name.strip() for name in fields.split(',') if name.strip()] if fields else None
+            )
+            return dict(checklists=checklists, next=cursor)
         except Exception as e:
             logger.error(f"Error retrieving checklists: {str(e)}")
             return dict(error=str(e))
 
+    @classmethod
+    def stream_checklists(cls, table=db.checklist):
+        """
+        Stream checklists from a specified table as NDJSON
+
+        Rows are read lazily from the cursor, one JSON object per line, so
+        memory use does not grow with the size of the table.
+
+        Args:
+            table: Database table to retrieve checklists from (default: checklist)
+
+        Returns:
+            generator: NDJSON response body
+        """
+        return formats.ndjson_response(lambda: db(table).iterselect())
+
     @classmethod
     def submit_checklist(cls, data):
+        version = None
         try:
             # Validate required fields
             if not all(key in data for key in ['speciesName', 'latitude', 'longitude', 'observationDate']):
@@ -43,102 +112,62 @@ class ChecklistManager:
                 "OBSERVER_ID": get_user_email()
             }
             checklist_id = db.my_checklist.insert(**checklist_data)
+            event_id = mirror_user_checklist(checklist_id)
 
             # Add species sightings
             for species in data.get("species", []):
                 db.sightings.insert(
-                    SAMPLING_EVENT_IDENTIFIER=checklist_id,
+                    SAMPLING_EVENT_IDENTIFIER=user_checklist_identifier(checklist_id),
+                    checklist_id=event_id,
                     COMMON_NAME=species.get("COMMON_NAME"),
+                    species_id=get_species_id(species.get("COMMON_NAME")),
                     OBSERVATION_COUNT=int(species.get("count", 1))  # Ensure this uses the correct count
                 )
-            
+            aggregates.apply_checklists([event_id], 1)
+            sketches.add_checklists([event_id])
+            version = responses.bump('checklist')['checklist']
+            # The in-memory columns take the change (and log it for the other
+            # processes) before the new version is visible, so no response is
+            # cached under it from older data
+            analytics.engine.refresh_checklists([event_id], version)
+            added = regions.grid.contributions([event_id])
+
             db.commit()
+            regions.grid.apply([], added, version)
+            tiles.tile_cache.invalidate_point(checklist_data["LATITUDE"], checklist_data["LONGITUDE"])
+            UserStatistics.invalidate(checklist_data["OBSERVER_ID"])
+            spatial.checklist_index.add(event_id, checklist_data["LATITUDE"], checklist_data["LONGITUDE"])
             return dict(status="success", checklist_id=checklist_id)
         
         except Exception as e:
             db.rollback()
+            if version is not None:
+                # The in-memory columns may hold the rolled back change
+                analytics.engine.invalidate()
             logger.error(f"Checklist submission error: {str(e)}")
             return dict(status="error", message=str(e))
         
     
 
     @classmethod
-    def get_user_bird_statistics():
+    def get_user_bird_statistics(cls):
         """
         Retrieve comprehensive bird-watching statistics for the logged-in user
         using my_checklist and sightings tables
+
+        Returns:
+            dict: Species summary, monthly trends, location data and date range
         """
         # Ensure user is logged in
         if not auth.user:
             return {"error": "Please log in to view your statistics"}
         
-        # Get current user's email
-        user_email = get_user_email()
-        
-        # Fetch all checklists for the user
-        user_checklists = db(db.my_checklist.OBSERVER_ID == user_email).select()
-        
-        # Aggregate species statistics
-        species_summary = {}
-        total_observations = 0
-        observation_dates = []
-        location_data = []
-        
-        for checklist in user_checklists:
-            # Find sightings for this checklist
-            checklist_sightings = db(
-                db.sightings.SAMPLING_EVENT_IDENTIFIER == checklist.id
-            ).select()
-            
-            for sighting in checklist_sightings:
-                species = sighting.COMMON_NAME
-                count = sighting.OBSERVATION_COUNT or 1
-                
-                # Update species summary
-                species_summary[species] = species_summary.get(species, 0) + count
-                total_observations += count
-                
-                # Track observation date
-                observation_dates.append(checklist.OBSERVATION_DATE)
-                
-                # Track location data
-                location_data.append({
-                    "species": species,
-                    "avg_latitude": checklist.LATITUDE,
-                    "avg_longitude": checklist.LONGITUDE,
-                    "location_count": count
-                })
-        
-        # Convert species summary to list of dictionaries
-        species_summary_list = [
-            {
-                "species": species, 
-                "total_count": count, 
-                "percentage": (count / total_observations) * 100 if total_observations > 0 else 0
-            } 
-            for species, count in species_summary.items()
-        ]
-        
-        # Sort species summary by total count descending
-        species_summary_list.sort(key=lambda x: x['total_count'], reverse=True)
-        
-        # Temporal trends
-        from datetime import datetime
-        observation_dates.sort()
-        
-        # Group observations by month/year
-        monthly_observations = {}
-        for date in observation_dates:
-            month_key = date.strftime("%Y-%m")
-            monthly_observations[month_key] = monthly_observations.get(month_key, 0) + 1
-        
+        statistics = UserStatistics.get(get_user_email())
         return {
-            "total_observations": total_observations,
-            "species_summary": species_summary_list,
-            "monthly_trends": monthly_observations,
-            "location_data": location_data,
-            "first_observation": min(observation_dates) if observation_dates else None,
-            "last_observation": max(observation_dates) if observation_dates else None
+            key: statistics[key] for key in (
+                "total_observations", "species_summary", "monthly_trends",
+                "location_data", "first_observation", "last_observation"
+            )
         }
 
     @classmethod
@@ -154,16 +183,29 @@ class ChecklistManager:
         Returns:
             dict: Modification status
         """
+        version = None
         try:
             checklist = db.my_checklist(checklist_id)
             if not checklist:
                 return dict(status="error", message="Checklist not found")
 
             if action_type == 'delete':
-                # Delete associated sightings first
-                db(db.sightings.SAMPLING_EVENT_IDENTIFIER == checklist_id).delete()
+                # Delete associated sightings and the mirroring checklist first
+                removed = regions.grid.contributions([checklist.checklist_id])
+                if checklist.checklist_id:
+                    aggregates.apply_checklists([checklist.checklist_id], -1)
+                    db(db.sightings.checklist_id == checklist.checklist_id).delete()
+                    db(db.checklist.id == checklist.checklist_id).delete()
                 db(db.my_checklist.id == checklist_id).delete()
+                sketches.refresh_cells([sketches.cell_of(checklist.LATITUDE, checklist.LONGITUDE)])
+                version = responses.bump('checklist')['checklist']
+                analytics.engine.refresh_checklists([checklist.checklist_id], version)
                 db.commit()
+                regions.grid.apply(removed, [], version)
+                tiles.tile_cache.invalidate_point(checklist.LATITUDE, checklist.LONGITUDE)
+                if checklist.checklist_id:
+                    spatial.checklist_index.remove(checklist.checklist_id)
+                UserStatistics.invalidate(checklist.user_email)
                 return dict(status="success", message="Checklist deleted successfully")
             
             elif action_type == 'edit':
@@ -175,12 +217,32 @@ class ChecklistManager:
                     "TIME_OBSERVATIONS_STARTED": data.get("TIME_OBSERVATIONS_STARTED", checklist.TIME_OBSERVATIONS_STARTED),
                     "DURATION_MINUTES": float(data.get("DURATION_MINUTES", checklist.DURATION_MINUTES))
                 }
+                removed = regions.grid.contributions([checklist.checklist_id])
+                if checklist.checklist_id:
+                    aggregates.apply_checklists([checklist.checklist_id], -1)
                 db(db.my_checklist.id == checklist_id).update(**update_data)
+                event_id = mirror_user_checklist(checklist.id)
+                aggregates.apply_checklists([event_id], 1)
+                sketches.refresh_cells([
+                    sketches.cell_of(checklist.LATITUDE, checklist.LONGITUDE),
+                    sketches.cell_of(update_data["LATITUDE"], update_data["LONGITUDE"])
+                ])
+                version = responses.bump('checklist')['checklist']
+                analytics.engine.refresh_checklists([event_id], version)
+                added = regions.grid.contributions([event_id])
                 db.commit()
+                regions.grid.apply(removed, added, version)
+                tiles.tile_cache.invalidate_point(checklist.LATITUDE, checklist.LONGITUDE)
+                tiles.tile_cache.invalidate_point(update_data["LATITUDE"], update_data["LONGITUDE"])
+                spatial.checklist_index.add(event_id, update_data["LATITUDE"], update_data["LONGITUDE"])
+                UserStatistics.invalidate(checklist.user_email)
                 return dict(status="success", message="Checklist updated successfully")
         
         except Exception as e:
             db.rollback()
+            if version is not None:
+                # The in-memory columns may hold the rolled back change
+                analytics.engine.invalidate()
             logger.error(f"Checklist modification error: {str(e)}")
             return dict(status="error", message=f"Error processing checklist: {str(e)}")
             
@@ -198,9 +260,24 @@ def get_bird_sightings():
         'south': float,
         'east': float,
         'west': float,
-        'species': optional species filter
+        'species': optional species filter,
+        'zoom': optional map zoom level,
+        'format': optional 'json' (default), 'binary' or 'ndjson'
     }
+
+    When a zoom level is given and the view holds more than
+    settings.MAP_RAW_POINT_LIMIT sightings, grid cells sized for that zoom
+    are returned instead of individual sightings, with the same keys plus
+    the number of sightings per cell ('clustered' is then true).
+
+    The binary format (also selected by an Accept header of
+    formats.POINTS_MEDIA_TYPE) returns the same points or cells as typed
+    columns, see formats.py. The ndjson format (or an Accept header of
+    formats.NDJSON_MEDIA_TYPE) streams them one JSON object per line.
     """
+    # From the Accept header until the body is read: errors must also be
+    # answered in the requested format
+    response_format = formats.requested_format()
     try:
         bounds = request.json
         
@@ -210,120 +287,226 @@ def get_bird_sightings():
         east = bounds.get('east')
         west = bounds.get('west')
         selected_species = bounds.get('species')
+        zoom = bounds.get('zoom')
+        response_format = formats.requested_format(bounds.get('format'))
         
         if not all([north, south, east, west]):
+            if response_format == 'binary':
+                raise HTTP(400, "Invalid geographic bounds")
             return dict(error="Invalid geographic bounds", sightings=[])
         
-        # Modify query to use both my_checklist and checklist tables with explicit joins
+        # Seeded and user checklists are both in the checklist table
         query = (
-            (db.sightings.SAMPLING_EVENT_IDENTIFIER == db.checklist.SAMPLING_EVENT_IDENTIFIER) &
-            (db.checklist.LATITUDE <= north) & 
-            (db.checklist.LATITUDE >= south) & 
-            (db.checklist.LONGITUDE <= east) & 
-            (db.checklist.LONGITUDE >= west)
+            (db.sightings.checklist_id == db.checklist.id) &
+            spatial.bounds_query(south, north, west, east)
         )
         
         # Add species filtering if specified
         if selected_species:
-            query &= (db.sightings.COMMON_NAME == selected_species)
+            query &= species_filter(selected_species)
         
-        # Perform comprehensive join and selection
-        observations = db(query).select(
+        if zoom is not None:
+            # Raw points only while the view is sparse enough
+            probe = db.executesql(db(query)._select(
+                db.sightings.id, limitby=(0, settings.MAP_RAW_POINT_LIMIT + 1), orderby_on_limitby=False
+            ))
+            if len(probe) > settings.MAP_RAW_POINT_LIMIT:
+                cell = spatial.cell_size(int(zoom))
+                clusters = spatial.cluster_sightings(query, int(zoom))
+                if response_format == 'binary':
+                    return formats.points_response(
+                        [cluster['lat'] for cluster in clusters],
+                        [cluster['lon'] for cluster in clusters],
+                        [cluster['intensity'] for cluster in clusters],
+                        [cluster['species_id'] for cluster in clusters],
+                        species_names,
+                        sightings=[cluster['sightings'] for cluster in clusters]
+                    )
+                names = species_names(cluster['species_id'] for cluster in clusters)
+                sightings = [
+                    {
+                        'lat': cluster['lat'],
+                        'lon': cluster['lon'],
+                        'species': names.get(cluster['species_id']),
+                        'intensity': cluster['intensity'],
+                        'sightings': cluster['sightings']
+                    } for cluster in clusters
+                ]
+                if response_format == 'ndjson':
+                    return formats.ndjson_response(lambda: sightings, dict)
+                return dict(sightings=sightings, clustered=True, cell_size=cell)
+
+        if response_format == 'binary':
+            # Plain column tuples: no Row objects or per-point dicts
+            rows = db.executesql(db(query)._select(
+                db.checklist.LATITUDE,
+                db.checklist.LONGITUDE,
+                db.sightings.OBSERVATION_COUNT,
+                db.sightings.species_id
+            ))
+            lat, lon, counts, species_ids = zip(*rows) if rows else ((), (), (), ())
+            return formats.points_response(
+                lat, lon, [min(count or 1, 10) for count in counts], species_ids, species_names
+            )
+
+        fields = (
             db.checklist.LATITUDE, 
             db.checklist.LONGITUDE, 
             db.sightings.COMMON_NAME,
             db.sightings.OBSERVATION_COUNT
         )
-        
-        # Process observations into heat map format with better error handling
-        sightings = []
-        for obs in observations:
+
+        def heat_point(obs):
+            # Ensure we have valid data before processing
             try:
-                # Ensure we have valid data before processing
                 if obs.checklist.LATITUDE and obs.checklist.LONGITUDE and obs.sightings.COMMON_NAME:
                     count = int(obs.sightings.OBSERVATION_COUNT or 1)
-                    sightings.append({
+                    return {
                         'lat': obs.checklist.LATITUDE,
                         'lon': obs.checklist.LONGITUDE,
                         'species': obs.sightings.COMMON_NAME,
                         'intensity': min(count, 10)  # Cap intensity for visual clarity
-                    })
+                    }
             except (ValueError, TypeError, AttributeError) as e:
                 logger.warning(f"Skipping invalid observation: {e}")
+            return None
+
+        if response_format == 'ndjson':
+            return formats.ndjson_response(lambda: db(query).iterselect(*fields), heat_point)
+
+        # Perform comprehensive join and selection
+        observations = db(query).select(*fields)
         
-        return dict(sightings=sightings)
+        # Process observations into heat map format with better error handling
+        sightings = [point for point in map(heat_point, observations) if point is not None]
+        
+        return dict(sightings=sightings, clustered=False)
     
     except Exception as e:
         logger.error(f"Error in get_bird_sightings: {str(e)}")
+        if response_format == 'binary':
+            # A JSON body would be decoded as points: fail with a status instead
+            raise HTTP(500, str(e))
         return dict(error=str(e), sightings=[])
 
+@action("tiles/<z:int>/<x:int>/<y:int>", method=["GET"])
+@action.uses(db)
+def get_heatmap_tile(z, x, y):
+    """
+    Retrieve the aggregated sighting density of one z/x/y map tile
+
+    The tile holds grid cells sized for its zoom level (see
+    get_bird_sightings) and is served from the tile cache; cached tiles are
+    dropped when a checklist inside them is submitted, edited or deleted.
+
+    Query parameters:
+    - species: Optional species filter
+
+    Returns:
+    - JSON {z, x, y, cells: [{lat, lon, species, intensity, sightings}]}
+    """
+    try:
+        if not (0 <= z <= settings.TILE_MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            return dict(error="Tile out of range", cells=[])
+
+        species_id = None
+        variant = 'all'
+        species = request.params.get('species')
+        if species:
+            row = db(db.species.COMMON_NAME == species).select(db.species.id).first()
+            if row is None:
+                return dict(z=z, x=x, y=y, cells=[])
+            species_id = row.id
+            variant = f"species_{species_id}"
+
+        key = (z, x, y, variant)
+        payload = tiles.tile_cache.get(key)
+        if payload is None:
+            south, north, west, east = tiles.tile_bounds(z, x, y)
+            query = (
+                (db.sightings.checklist_id == db.checklist.id) &
+                spatial.bounds_query(south, north, west, east)
+            )
+            if species_id is not None:
+                query &= (db.sightings.species_id == species_id)
+            clusters = spatial.cluster_sightings(query, z)
+            names = species_names(cluster['species_id'] for cluster in clusters)
+            payload = json.dumps(dict(z=z, x=x, y=y, cells=[
+                {
+                    'lat': cluster['lat'],
+                    'lon': cluster['lon'],
+                    'species': names.get(cluster['species_id']),
+                    'intensity': cluster['intensity'],
+                    'sightings': cluster['sightings']
+                } for cluster in clusters
+            ]))
+            tiles.tile_cache.put(key, payload)
+
+        response.headers['Content-Type'] = 'application/json'
+        return payload
+
+    except Exception as e:
+        logger.error(f"Error in get_heatmap_tile: {str(e)}")
+        return dict(error=str(e), cells=[])
+
 @action("get_hotspot_details", method=["POST"])
 @action.uses(db)
 def get_hotspot_details():
     """
     Retrieve detailed information for a specific geographic point
+
+    Expected JSON payload:
+    {
+        'lat': float,
+        'lon': float,
+        'species': optional species filter,
+        'radius_km': optional radius (default: settings.HOTSPOT_RADIUS_KM),
+        'nearest': optional number of nearest checklists to use instead of a radius
+    }
+
+    Checklists are found with the in-memory spatial.checklist_index, by true
+    (great-circle) distance, and their sightings are then aggregated per
+    species in the database.
     """
     try:
         data = request.json
-        lat = data.get('lat')
-        lon = data.get('lon')
+        lat = float(data.get('lat'))
+        lon = float(data.get('lon'))
         species = data.get('species')
+        radius_km = min(float(data.get('radius_km') or settings.HOTSPOT_RADIUS_KM), settings.HOTSPOT_MAX_RADIUS_KM)
+        nearest = data.get('nearest')
 
-        # Use a tighter tolerance for matching coordinates
-        query = (
-            (db.checklist.LATITUDE >= lat - 0.01) & 
-            (db.checklist.LATITUDE <= lat + 0.01) & 
-            (db.checklist.LONGITUDE >= lon - 0.01) & 
-            (db.checklist.LONGITUDE <= lon + 0.01)
-        )
+        if nearest:
+            nearby = spatial.checklist_index.nearest(lat, lon, min(int(nearest), settings.HOTSPOT_MAX_NEAREST))
+        else:
+            nearby = spatial.checklist_index.within(lat, lon, radius_km)
+
+        query = db.sightings.checklist_id.belongs([checklist_id for checklist_id, _ in nearby])
 
-        # Create join condition for sightings
-        join_condition = (db.sightings.SAMPLING_EVENT_IDENTIFIER == db.checklist.SAMPLING_EVENT_IDENTIFIER)
-        
         # Apply species filter if provided
         if species:
-            join_condition &= (db.sightings.COMMON_NAME == species)
+            query &= species_filter(species)
 
-        # Fetch observations with comprehensive selection
-        observations = db(query).select(
-            db.checklist.SAMPLING_EVENT_IDENTIFIER,
-            db.checklist.LATITUDE, 
-            db.checklist.LONGITUDE,
-            db.sightings.COMMON_NAME, 
-            db.sightings.OBSERVATION_COUNT,
-            left=db.sightings.on(join_condition)
-        )
-
-        # Prepare detailed species information
-        species_details = {}
-        species_checklists = set()
-
-        for obs in observations:
-            if obs.sightings.COMMON_NAME:  # Ensure we have a valid species name
-                species_name = obs.sightings.COMMON_NAME
-                count = obs.sightings.OBSERVATION_COUNT or 1
-                checklist_id = obs.checklist.SAMPLING_EVENT_IDENTIFIER
-                species_checklists.add(checklist_id)
-                
-                if species_name not in species_details:
-                    species_details[species_name] = {
-                        'total_count': count,
-                        'observation_count': 1,
-                        'checklists': {checklist_id}
-                    }
-                else:
-                    species_details[species_name]['total_count'] += count
-                    species_details[species_name]['observation_count'] += 1
-                    species_details[species_name]['checklists'].add(checklist_id)
+        # Observation counts default to 1 when missing
+        count = (db.sightings.OBSERVATION_COUNT > 0).case(db.sightings.OBSERVATION_COUNT, 1)
+        rows = db.executesql(db(query)._select(
+            db.sightings.species_id,
+            count.sum(),
+            db.sightings.id.count(),
+            db.sightings.checklist_id.count(distinct=True),
+            groupby=db.sightings.species_id
+        )) if nearby else []
+        checklist_count = db(query).count(distinct=db.sightings.checklist_id) if rows else 0
 
         # Convert to list for easier frontend processing
+        names = species_names(row[0] for row in rows)
         formatted_species_details = [
             {
-                'species': species, 
-                'total_count': details['total_count'],
-                'observation_count': details['observation_count'],
-                'unique_checklists': len(details['checklists'])
-            } for species, details in species_details.items()
+                'species': names.get(species_id),
+                'total_count': total_count,
+                'observation_count': observation_count,
+                'unique_checklists': unique_checklists
+            } for species_id, total_count, observation_count, unique_checklists in rows
         ]
 
         # Sort by total count in descending order
@@ -332,16 +515,27 @@ def get_hotspot_details():
         return dict(
             species_count=len(formatted_species_details),
             species_details=formatted_species_details,
-            total_observations=sum(details['total_count'] for details in formatted_species_details) if formatted_species_details else 0,
+            total_observations=sum(details['total_count'] for details in formatted_species_details),
             location_lat=lat,
             location_lon=lon,
-            unique_checklists=len(species_checklists)
+            radius_km=nearby[-1][1] if nearest and nearby else radius_km,
+            unique_checklists=checklist_count
         )
 
     except Exception as e:
         logger.error(f"Error in get_hotspot_details: {str(e)}")
         return dict(error=str(e), species_count=0, species_details=[], total_observations=0)
     
+@action("get_user_bird_statistics", method=["GET"])
+@action.uses(db, auth.user)
+def get_user_bird_statistics():
+    """Retrieve the logged-in user's species summary, monthly trends and locations"""
+    try:
+        return ChecklistManager.get_user_bird_statistics()
+    except Exception as e:
+        logger.error(f"Error in get_user_bird_statistics: {str(e)}")
+        return dict(error=str(e))
+
 @action("get_user_checklist_statistics", method=["GET"])
 @action.uses(db, auth.user)
 def get_user_checklist_statistics():
@@ -362,56 +556,15 @@ def get_user_checklist_statistics():
         if not user_email:
             return dict(error="User not authenticated")
         
-        # Query my_checklist and sightings tables for user's data
-        query = (db.my_checklist.user_email == user_email)
-        
-        # Aggregate species statistics
-        species_summary = db(query).select(
-            db.sightings.COMMON_NAME, 
-            db.sightings.OBSERVATION_COUNT.sum().with_alias('total_count'),
-            groupby=db.sightings.COMMON_NAME,
-            orderby=~db.sightings.OBSERVATION_COUNT.sum()
-        )
-        
-        # Fetch user's checklists
-        user_checklists = db(query).select(
-            db.my_checklist.OBSERVATION_DATE,
-            orderby=db.my_checklist.OBSERVATION_DATE
-        )
-        
-        # Calculate total observations and unique species
-        total_observations = sum(row.total_count for row in species_summary)
-        unique_species = len(species_summary)
-        total_checklists = len(user_checklists)
-        
-        # Find most frequently observed species
-        most_observed_species = species_summary[0] if species_summary else None
-        
-        # Find date range of observations
-        if user_checklists:
-            first_observation = min(checklist.OBSERVATION_DATE for checklist in user_checklists)
-            last_observation = max(checklist.OBSERVATION_DATE for checklist in user_checklists)
-        else:
-            first_observation = last_observation = None
-        
-        return dict(
-            total_observations=total_observations,
-            unique_species=unique_species,
-            total_checklists=total_checklists,
-            most_observed_species={
-                'name': most_observed_species.sightings.COMMON_NAME if most_observed_species else None,
-                'count': most_observed_species.total_count if most_observed_species else 0
-            },
-            first_observation=first_observation,
-            last_observation=last_observation,
-            species_summary=[
-                {
-                    'species': row.sightings.COMMON_NAME, 
-                    'total_count': row.total_count,
-                    'percentage': (row.total_count / total_observations * 100) if total_observations > 0 else 0
-                } for row in species_summary
-            ]
-        )
+        # Computed in one query and cached per user (see user_stats.py)
+        statistics = UserStatistics.get(user_email)
+        return {
+            key: statistics[key] for key in (
+                "total_observations", "unique_species", "total_checklists",
+                "most_observed_species", "first_observation", "last_observation",
+                "species_summary"
+            )
+        }
     
     except Exception as e:
         logger.error(f"Error in get_user_checklist_statistics: {str(e)}")
@@ -421,46 +574,59 @@ def get_user_checklist_statistics():
 # Species and Checklist Routes
 @action("get_species", method=["GET"])
 @action.uses(db)
+@responses.cached('species')
 def get_species():
-    """Retrieve all species"""
+    """Retrieve species one page at a time (all of them streamed as NDJSON with format=ndjson)"""
+    if formats.requested_format() == 'ndjson':
+        return ChecklistManager.stream_checklists(db.species)
     return ChecklistManager.get_checklists(db.species)
 
 @action('get_checklists', method=["GET"])
 @action.uses(db, auth.user)
 def get_checklists():
-    """Retrieve all checklists"""
+    """Retrieve checklists one page at a time (all of them streamed as NDJSON with format=ndjson)"""
+    if formats.requested_format() == 'ndjson':
+        return ChecklistManager.stream_checklists()
     return ChecklistManager.get_checklists()
 
 @action('get_my_checklists', method=["GET"])
 @action.uses(db, auth.user)
 def get_my_checklists():
-    """Retrieve user's personal checklists"""
-    return ChecklistManager.get_checklists(db.my_checklist)
+    """Retrieve the current user's personal checklists, one page at a time"""
+    return ChecklistManager.get_checklists(db.my_checklist, db.my_checklist.user_email == get_user_email())
 
 @action("search_species", method=["GET"])
 @action.uses(db)
 def search_species():
     """
     Search for species with optional filtering
-    
+
+    Matches come from the in-memory index in species_search.py: prefix
+    matches first, then word-boundary and other substring matches, each by
+    popularity, then close misspellings.
+
     Query parameters:
-    - q: Search query
+    - q: Search query (empty: every species, by id)
     - min_obs: Minimum number of observations
+    - limit: Maximum number of species (default: settings.SPECIES_SEARCH_LIMIT
+      when searching, every species otherwise; at most
+      settings.SPECIES_SEARCH_MAX_LIMIT)
     """
-    query = request.params.get("q", "").strip().lower()
-    min_observations = int(request.params.get("min_obs", 0))
-    
-    # Base query
-    species_query = db.species.COMMON_NAME.contains(query)
-    
-    # Optional observation count filter
-    if min_observations > 0:
-        species_with_obs = db.sightings.groupby(db.sightings.COMMON_NAME).having(
-            db.sightings.OBSERVATION_COUNT.sum() >= min_observations
-        )
-        species_query &= (db.species.COMMON_NAME.belongs(species_with_obs))
-    
-    species = db(species_query).select().as_list()
+    query = request.params.get("q", "").strip()
+    try:
+        min_observations = int(request.params.get("min_obs") or 0)
+        limit = request.params.get("limit")
+        limit = int(limit) if limit else None
+    except ValueError:
+        return dict(error="min_obs and limit must be integers")
+    if limit is not None:
+        if limit < 1:
+            return dict(error="limit must be positive")
+        limit = min(limit, settings.SPECIES_SEARCH_MAX_LIMIT)
+    elif query:
+        limit = settings.SPECIES_SEARCH_LIMIT
+
+    species = species_search.index.search(query, limit or None, min_observations)
     return dict(species=species)
 
 @action("submit_checklist", method=["POST"])
@@ -485,6 +651,194 @@ def edit_checklist(checklist_id):
     """Edit a specific checklist"""
     return ChecklistManager.modify_checklist(checklist_id, 'edit', request.json)
 
+# Bulk import routes
+UPLOAD_FORMATS = {
+    'checklists': dict(
+        table=db.checklist,
+        mapper=ingest.map_checklist_row,
+        validator=ingest.validate_checklist_rows,
+        unique_field='SAMPLING_EVENT_IDENTIFIER'
+    ),
+    'sightings': dict(
+        table=db.sightings,
+        mapper=ingest.map_sighting_row,
+        validator=ingest.validate_sighting_rows,
+        unique_field=None
+    ),
+}
+
+# Upload ids name files (see ingest.CSVPipeline), so only uuid4().hex is accepted
+UPLOAD_ID = re.compile(r'[0-9a-f]{32}')
+
+# Number of uploads whose progress is kept
+UPLOAD_PROGRESS_KEPT = 100
+
+def upload_status(progress):
+    """The progress of an upload (an upload_progress row) as returned to its owner"""
+    status = dict(upload_id=progress.upload_id, status=progress.status, kind=progress.kind, **(progress.stats or {}))
+    if progress.message:
+        status['message'] = progress.message
+    return status
+
+class UploadBatches:
+    """
+    Keeps what depends on the checklist and sightings tables current as an upload commits batches
+
+    Each batch is applied as a user checklist change is: the summary tables,
+    sketches and in-memory columns take it inside the batch's transaction
+    (see DataSeeder.load_stream), the region grid and the hotspot index once
+    it is committed.
+    """
+    def __init__(self):
+        self._committed = None
+
+    @contextlib.contextmanager
+    def apply(self, rows):
+        sightings, checklist = db.sightings, db.checklist
+        events = list({row.get('SAMPLING_EVENT_IDENTIFIER') for row in rows})
+        unlinked = sightings.SAMPLING_EVENT_IDENTIFIER.belongs(events) & (sightings.checklist_id == None)
+        existing = db(checklist.SAMPLING_EVENT_IDENTIFIER.belongs(events)).select(
+            checklist.id, checklist.LATITUDE, checklist.LONGITUDE
+        )
+        existing_ids = {row.id for row in existing}
+        had_unlinked = not db(unlinked).isempty()
+        removed = regions.grid.contributions(existing_ids)
+        aggregates.apply_checklists(existing_ids, -1)
+        aggregates.apply_unlinked_sightings(events, -1)
+        yield
+        link_sighting_references(events)
+        current = db(checklist.SAMPLING_EVENT_IDENTIFIER.belongs(events)).select(
+            checklist.id, checklist.LATITUDE, checklist.LONGITUDE
+        )
+        checklist_ids = [row.id for row in current]
+        added_checklists = [row for row in current if row.id not in existing_ids]
+        aggregates.apply_checklists(checklist_ids, 1)
+        aggregates.apply_unlinked_sightings(events, 1)
+        sketches.add_checklists([row.id for row in added_checklists])
+        sketches.refresh_cells([sketches.cell_of(row.LATITUDE, row.LONGITUDE) for row in existing])
+        version = responses.bump('checklist')['checklist']
+        if had_unlinked or not db(unlinked).isempty():
+            # The columns hold sightings by checklist: ones without (or just
+            # given) one are left to a reload, which the unlogged version
+            # also starts in the other processes
+            analytics.engine.invalidate()
+        else:
+            analytics.engine.refresh_checklists(checklist_ids, version)
+        added = regions.grid.contributions(checklist_ids)
+        self._committed = (removed, added, version, added_checklists)
+
+    def committed(self):
+        """Apply the last batch to the region grid and the hotspot index, once committed"""
+        if self._committed is None:
+            return
+        removed, added, version, added_checklists = self._committed
+        self._committed = None
+        regions.grid.apply(removed, added, version)
+        for row in added_checklists:
+            spatial.checklist_index.add(row.id, row.LATITUDE, row.LONGITUDE)
+
+def open_upload_stream(raw):
+    """
+    Wrap an uploaded byte stream as CSV text, un-gzipping it if needed
+
+    Args:
+        raw: Binary file-like object holding the upload
+
+    Returns:
+        io.TextIOWrapper: Text stream over the (decompressed) CSV
+    """
+    if raw.seekable():
+        magic = raw.read(2)
+        raw.seek(0)
+    else:
+        raw = io.BufferedReader(raw)
+        magic = raw.peek(2)[:2]
+    if magic == b'\x1f\x8b':
+        raw = gzip.GzipFile(fileobj=raw, mode='rb')
+    return io.TextIOWrapper(raw, encoding='utf-8-sig', newline='')
+
+@action("upload_observations", method=["POST"])
+@action.uses(db, auth.user)
+def upload_observations():
+    """
+    Bulk load an eBird-format checklists or sightings CSV
+
+    The body is either the CSV itself (optionally gzip-compressed) or a
+    multipart form with the file in a 'file' field. Rows are streamed through
+    the seeding mappers and committed in batches, each applied to the summary
+    tables and indexes as it commits (see UploadBatches).
+
+    Query parameters:
+    - kind: 'checklists' or 'sightings'
+    - upload_id: Optional id to poll with upload_progress/<upload_id>, 32
+      lowercase hex digits (as uuid.uuid4().hex) not used by another upload
+    """
+    # Only the query string is read: request.params would parse the body
+    kind = request.query.get('kind')
+    upload_format = UPLOAD_FORMATS.get(kind)
+    if not upload_format:
+        return dict(status="error", message=f"kind must be one of {sorted(UPLOAD_FORMATS)}")
+
+    upload_id = request.query.get('upload_id') or uuid.uuid4().hex
+    if not UPLOAD_ID.fullmatch(upload_id):
+        return dict(status="error", message="upload_id must be 32 lowercase hex digits")
+    if not db(db.upload_progress.upload_id == upload_id).isempty():
+        return dict(status="error", message="upload_id is already in use")
+    progress_id = db.upload_progress.insert(upload_id=upload_id, owner=get_user_email(), kind=kind, status="running")
+    db(db.upload_progress.id <= progress_id - UPLOAD_PROGRESS_KEPT).delete()
+    db.commit()
+    progress = db.upload_progress(progress_id)
+    batches = UploadBatches()
+
+    def committed(stats):
+        batches.committed()
+        progress.update_record(stats=stats)
+        db.commit()
+
+    try:
+        if request.content_type.startswith('multipart/'):
+            upload = request.files.get('file')
+            if upload is None:
+                progress.update_record(status="error", message="No 'file' field in upload")
+                return upload_status(progress)
+            raw = upload.file
+        else:
+            raw = request.body
+
+        stats = DataSeeder.load_stream(
+            upload_format['table'],
+            open_upload_stream(raw),
+            upload_format['mapper'],
+            validator=upload_format['validator'],
+            name=f"upload_{upload_id}_{kind}",
+            unique_field=upload_format['unique_field'],
+            apply=batches.apply,
+            progress=committed
+        )
+        tiles.tile_cache.clear()
+        UserStatistics.clear()
+        progress.update_record(stats=stats, status="success")
+        responses.warm()
+        logger.info(f"Upload {upload_id} ({kind}) by {get_user_email()}: {stats}")
+        return upload_status(progress)
+
+    except Exception as e:
+        db.rollback()
+        # The in-memory columns may hold the rolled back batch
+        analytics.engine.invalidate()
+        progress.update_record(status="error", message=str(e))
+        logger.error(f"Upload error: {str(e)}")
+        return upload_status(progress)
+
+@action("upload_progress/<upload_id>", method=["GET"])
+@action.uses(db, auth.user)
+def upload_progress(upload_id):
+    """Retrieve the progress of one of the current user's bulk uploads"""
+    progress = db(db.upload_progress.upload_id == upload_id).select(limitby=(0, 1)).first()
+    if progress is None or progress.owner != get_user_email():
+        return dict(status="error", message="Unknown upload id")
+    return upload_status(progress)
+
 @action("get_checklist_species_count", method=["GET"])
 @action.uses(db)
 def get_checklist_species_count():
@@ -502,7 +856,8 @@ def get_checklist_species_count():
         
         # Query to get species count and total observations for the checklist
         species_data = db(
-            db.sightings.SAMPLING_EVENT_IDENTIFIER == int(checklist_id)
+            (db.my_checklist.id == int(checklist_id)) &
+            (db.sightings.checklist_id == db.my_checklist.checklist_id)
         ).select(
             db.sightings.COMMON_NAME, 
             db.sightings.OBSERVATION_COUNT.sum().with_alias('total_count'),
@@ -618,6 +973,7 @@ def location():
     return dict()
 @action("get_species_statistics", method=["POST"])
 @action.uses(db)
+@responses.cached('checklist', 'species')
 def get_species_statistics():
     """
     Retrieve comprehensive statistics for a specific species
@@ -628,38 +984,35 @@ def get_species_statistics():
         if not species_name:
             return dict(error="No species specified")
         
-        # Calculate total species observations specifically for this species
-        total_species_observations = db(
-            (db.sightings.COMMON_NAME == species_name)
-        ).select(
-            db.sightings.OBSERVATION_COUNT.sum().with_alias('total_count')
-        ).first().total_count or 0
+        # Summed counts and number of sightings per species are kept in species_totals
+        species_ids = db(db.species.COMMON_NAME == species_name)._select(db.species.id)
+        totals = db(db.species_totals.species_id.belongs(species_ids)).select(
+            db.species_totals.total_count.sum().with_alias('total_count'),
+            db.species_totals.sightings.sum().with_alias('sightings')
+        ).first()
+        total_species_observations = totals.total_count or 0
+        total_species_observations_global = totals.sightings or 0
         
         # Find top hotspot specifically for this species
         top_hotspot = db(
-            (db.sightings.COMMON_NAME == species_name) &
-            (db.sightings.SAMPLING_EVENT_IDENTIFIER == db.my_checklist.id)
+            species_filter(species_name) &
+            (db.sightings.checklist_id == db.checklist.id)
         ).select(
-            db.my_checklist.LATITUDE, 
-            db.my_checklist.LONGITUDE,
+            db.checklist.LATITUDE, 
+            db.checklist.LONGITUDE,
             db.sightings.OBSERVATION_COUNT.sum().with_alias('total_count'),
-            groupby=(db.my_checklist.LATITUDE, db.my_checklist.LONGITUDE),
+            groupby=(db.checklist.LATITUDE, db.checklist.LONGITUDE),
             orderby=~db.sightings.OBSERVATION_COUNT.sum(),
             limitby=(1,0)
         ).first()
         
-        # Total species observations globally
-        total_species_observations_global = db(
-            db.sightings.COMMON_NAME == species_name
-        ).count()
-        
         # Prepare top hotspot data
         top_hotspot_data = None
         if top_hotspot:
             top_hotspot_data = {
-                'latitude': top_hotspot.my_checklist.LATITUDE,
-                'longitude': top_hotspot.my_checklist.LONGITUDE,
-                'location': f"Lat {top_hotspot.my_checklist.LATITUDE}, Lon {top_hotspot.my_checklist.LONGITUDE}",
+                'latitude': top_hotspot.checklist.LATITUDE,
+                'longitude': top_hotspot.checklist.LONGITUDE,
+                'location': f"Lat {top_hotspot.checklist.LATITUDE}, Lon {top_hotspot.checklist.LONGITUDE}",
                 'count': top_hotspot.total_count
             }
         
@@ -674,9 +1027,25 @@ def get_species_statistics():
         logger.error(f"Error in get_species_statistics: {str(e)}")
         return dict(error=str(e))
     
+def wants_approximate():
+    """Whether the request opted into the approximate, sketch-based answers"""
+    return str(request.params.get('approximate', '')).lower() in ('1', 'true', 'yes')
+
+
 @action("get_region_statistics", method=["GET"])
 @action.uses(db)
+@responses.cached('checklist', 'species')
 def get_region_statistics():
+    """
+    Top 10 species by summed observation count inside a bounding box
+
+    Query parameters:
+    - north, south, east, west: The box (default: the whole world)
+    - approximate: 'true' to answer from the region sketches (see
+      sketches.py): the box is widened to whole cells, each species' count
+      comes with the error it may be over by, and distinct species and
+      observer estimates are added with their ~95% intervals
+    """
     try:
         # Parse region bounds from query parameters
         north = float(request.params.get('north', 90))
@@ -684,34 +1053,64 @@ def get_region_statistics():
         east = float(request.params.get('east', 180))
         west = float(request.params.get('west', -180))
 
-        # Region bounds query
-        query = (
-            (db.checklist.LATITUDE <= north) & 
-            (db.checklist.LATITUDE >= south) & 
-            (db.checklist.LONGITUDE <= east) & 
-            (db.checklist.LONGITUDE >= west)
-        )
+        bounds = (south, north, west, east)
+        if wants_approximate():
+            summary = sketches.region_summary(bounds, 10)
+            names = species_names(species_id for species_id, _, _ in summary['top_species'])
+            total_observations = sum(upper for _, upper, _ in summary['top_species'])
+            return dict(
+                approximate=True,
+                bounds=summary['bounds'],
+                species_summary=[
+                    {
+                        'species': names.get(species_id),
+                        'total_count': upper,
+                        'error': upper - lower,
+                        'percentage': (upper / total_observations * 100) if total_observations > 0 else 0
+                    } for species_id, upper, lower in summary['top_species']
+                ],
+                total_observations=total_observations,
+                unique_species=len(summary['top_species']),
+                checklists=summary['checklists'],
+                distinct_species=summary['distinct_species'],
+                distinct_observers=summary['distinct_observers']
+            )
 
-        # Aggregate species statistics
-        species_summary = db(query).select(
-            db.sightings.COMMON_NAME, 
-            db.sightings.OBSERVATION_COUNT.sum().with_alias('total_count'),
-            groupby=db.sightings.COMMON_NAME,
-            orderby=~db.sightings.OBSERVATION_COUNT.sum(),
-            limitby=(0, 10)  # Limit to top 10
-        )
+        # The grids return None when they cannot rank this region exactly or
+        # are behind, and the engine until it holds the current data
+        species_summary = regions.grid.top_species(bounds, 10) if regions.grid.available() else None
+        if species_summary is None and analytics.engine.available():
+            species_summary = analytics.engine.top_species('count', 10, bounds)
+        if species_summary is None:
+            # Region bounds query
+            query = (
+                (db.sightings.checklist_id == db.checklist.id) &
+                spatial.bounds_query(south, north, west, east)
+            )
+
+            # Aggregate species statistics
+            total_count = db.sightings.OBSERVATION_COUNT.sum()
+            species_summary = [(row.sightings.species_id, row[total_count]) for row in db(query).select(
+                db.sightings.species_id, 
+                total_count,
+                groupby=db.sightings.species_id,
+                # Ties by species id, as the grids and the engine rank them
+                orderby=~total_count | db.sightings.species_id,
+                limitby=(0, 10)  # Limit to top 10
+            )]
+        names = species_names(species_id for species_id, _ in species_summary)
 
         # Total observations and unique species
-        total_observations = sum(row.total_count for row in species_summary)
+        total_observations = sum(total_count or 0 for _, total_count in species_summary)
         unique_species = len(species_summary)
 
         return dict(
             species_summary=[
                 {
-                    'species': row.sightings.COMMON_NAME, 
-                    'total_count': row.total_count,
-                    'percentage': (row.total_count / total_observations * 100) if total_observations > 0 else 0
-                } for row in species_summary
+                    'species': names.get(species_id), 
+                    'total_count': total_count,
+                    'percentage': ((total_count or 0) / total_observations * 100) if total_observations > 0 else 0
+                } for species_id, total_count in species_summary
             ],
             total_observations=total_observations,
             unique_species=unique_species
@@ -724,63 +1123,135 @@ def get_region_statistics():
     
 @action("get_species_time_series", method=["POST"])
 @action.uses(db)
+@responses.cached('checklist', 'species')
 def get_species_time_series():
+    """
+    Summed observation counts of a species per period, latest period first
+
+    JSON body:
+    - species: Common name of the species
+    - granularity: 'day' (default), 'week', 'month' or 'year'; each period
+      is reported by its first day (weeks start on Monday)
+    - start, end: Optional inclusive ISO date range
+    - north, south, east, west: Optional bounding box
+    - limit: Number of most recent periods (default: 5 without a date range,
+      otherwise every period in it; between 1 and settings.TIME_SERIES_MAX_PERIODS)
+    """
     try:
-        species_name = request.json.get('species')
+        data = request.json
+        species_name = data.get('species')
         if not species_name:
             return dict(error="No species specified")
-        
-        # Query to get time series data
-        time_series_data = db(
-            (db.sightings.COMMON_NAME == species_name) &
-            (db.sightings.SAMPLING_EVENT_IDENTIFIER == db.checklist.SAMPLING_EVENT_IDENTIFIER)
-        ).select(
-            db.checklist.OBSERVATION_DATE,
-            db.sightings.OBSERVATION_COUNT.sum().with_alias('count'),
-            groupby=db.checklist.OBSERVATION_DATE,
-            orderby=~db.checklist.OBSERVATION_DATE,
-            limitby=(0, 5)  # Limit to the most recent 5 periods
-        )
-        
-        return dict(time_series=[{
-            'date': row.checklist.OBSERVATION_DATE,
-            'count': row.count
-        } for row in time_series_data])
+        granularity = data.get('granularity') or 'day'
+        if granularity not in aggregates.GRANULARITIES:
+            return dict(error=f"Unknown granularity: {granularity}")
+        start = datetime.date.fromisoformat(data['start']) if data.get('start') else None
+        end = datetime.date.fromisoformat(data['end']) if data.get('end') else None
+        default_limit = settings.TIME_SERIES_MAX_PERIODS if start or end else 5
+        limit = max(1, min(int(data.get('limit') or default_limit), settings.TIME_SERIES_MAX_PERIODS))
+        species_ids = [row.id for row in db(db.species.COMMON_NAME == species_name).select(db.species.id)]
+
+        if any(data.get(key) is not None for key in ('north', 'south', 'east', 'west')):
+            bounds = (
+                float(data.get('south', -90)), float(data.get('north', 90)),
+                float(data.get('west', -180)), float(data.get('east', 180))
+            )
+            # The engine returns None until it holds the current data
+            daily = analytics.engine.species_dates(species_ids, start, end, bounds) \
+                if analytics.engine.available() else None
+            if daily is None:
+                # The daily totals are not kept per location: group the checklists in the box
+                query = (
+                    db.sightings.species_id.belongs(species_ids) &
+                    (db.sightings.checklist_id == db.checklist.id) &
+                    spatial.bounds_query(*bounds)
+                )
+                if start:
+                    query &= db.checklist.OBSERVATION_DATE >= start
+                if end:
+                    query &= db.checklist.OBSERVATION_DATE <= end
+                total_count = db.sightings.OBSERVATION_COUNT.coalesce_zero().sum()
+                daily = [(row.checklist.OBSERVATION_DATE, row[total_count]) for row in db(query).select(
+                    db.checklist.OBSERVATION_DATE,
+                    total_count,
+                    groupby=db.checklist.OBSERVATION_DATE
+                )]
+        else:
+            # Daily totals are kept in species_daily_totals
+            daily = aggregates.daily_series(species_ids, start, end)
+
+        return dict(granularity=granularity, time_series=[{
+            'date': period,
+            'count': total_count
+        } for period, total_count in aggregates.roll_up(daily, granularity, limit)])
     
     except Exception as e:
         logger.error(f"Error in get_species_time_series: {str(e)}")
         return dict(error=str(e))
     
+# Named windows accepted by get_top_contributors' since parameter
+LEADERBOARD_WINDOWS = {
+    'week': datetime.timedelta(days=7),
+    'month': datetime.timedelta(days=30),
+    'all': None,
+}
+
+def leaderboard_since(since):
+    """
+    The first observation date counted for a since parameter
+
+    Returns:
+        datetime.date: None for all time
+
+    Raises:
+        ValueError: If since is neither a named window nor an ISO date
+    """
+    since = since or 'all'
+    if since in LEADERBOARD_WINDOWS:
+        window = LEADERBOARD_WINDOWS[since]
+        return datetime.date.today() - window if window else None
+    return datetime.date.fromisoformat(since)
+
+def resolve_leaderboard_window(parameters):
+    """Identify a leaderboard by the date its window starts on, so 'week' changes key every day"""
+    try:
+        since = leaderboard_since(parameters.get('since'))
+    except ValueError:
+        # Answered with an error, which is not cached
+        return parameters
+    return dict(parameters, since=since.isoformat() if since else 'all')
+
 @action("get_top_contributors", method=["GET"])
 @action.uses(db)
+@responses.cached('checklist', 'species', normalize=resolve_leaderboard_window)
 def get_top_contributors():
+    """
+    Retrieve the observers with the most checklists
+
+    Query parameters:
+    - limit: Number of observers (default: 5, between 1 and settings.LEADERBOARD_MAX_LIMIT)
+    - since: 'week', 'month', 'all' (default) or an ISO date; only checklists
+      observed from then on are counted
+    - approximate: 'true' to rank from the region sketches (see sketches.py):
+      each count comes with the error it may be over by, unique_species is
+      not known (None), and a distinct observer estimate is added
+    """
     try:
-        # Ensure the correct table and field names are used
-        contributors_data = db(db.checklist).select(
-            db.checklist.OBSERVER_ID,
-            db.checklist.id.count().with_alias('total_observations'),
-            groupby=db.checklist.OBSERVER_ID,
-            orderby=~db.checklist.id.count(),
-            limitby=(0, 5)  # Limit to top 5
-        )
-        
-        # Optionally, you can include unique species if needed
-        # This requires a join with the sightings table
-        contributors = []
-        for row in contributors_data:
-            unique_species_count = db(
-                (db.sightings.SAMPLING_EVENT_IDENTIFIER == db.checklist.SAMPLING_EVENT_IDENTIFIER) &
-                (db.checklist.OBSERVER_ID == row.checklist.OBSERVER_ID)
-            ).select(
-                db.sightings.COMMON_NAME.count(distinct=True).with_alias('unique_species')
-            ).first().unique_species or 0
-            
-            contributors.append({
-                'name': row.checklist.OBSERVER_ID,
-                'total_observations': row.total_observations,
-                'unique_species': unique_species_count
-            })
-        
+        limit = max(1, min(int(request.params.get("limit") or 5), settings.LEADERBOARD_MAX_LIMIT))
+        since = leaderboard_since(request.params.get("since"))
+
+        if wants_approximate():
+            ranking = sketches.top_contributors(limit, since)
+            return dict(
+                approximate=True,
+                contributors=[
+                    dict(name=observer, total_observations=upper, error=upper - lower, unique_species=None)
+                    for observer, upper, lower in ranking['contributors']
+                ],
+                distinct_observers=ranking['distinct_observers']
+            )
+
+        contributors = aggregates.leaderboard(limit, since)
         return dict(contributors=contributors)
     
     except Exception as e:
@@ -789,26 +1260,30 @@ def get_top_contributors():
 
 @action("get_top_observed_birds", method=["GET"])
 @action.uses(db)
+@responses.cached('checklist', 'species')
 def get_top_observed_birds():
     """
     Retrieve the top 10 most observed birds
     """
     try:
-        # Query sightings table to get the top 10 most observed birds
-        top_observed_birds = db(db.sightings).select(
-            db.sightings.COMMON_NAME, 
-            db.sightings.OBSERVATION_COUNT.sum().with_alias('total_count'),
-            groupby=db.sightings.COMMON_NAME,
-            orderby=~db.sightings.OBSERVATION_COUNT.sum(),
-            limitby=(0, 10)
-        )
+        # The engine returns None until it holds the current data
+        top_observed_birds = analytics.engine.top_species('count', 10) if analytics.engine.available() else None
+        if top_observed_birds is None:
+            # Per-species totals are kept in species_totals
+            top_observed_birds = [(row.species_id, row.total_count) for row in db(db.species_totals).select(
+                db.species_totals.species_id, 
+                db.species_totals.total_count,
+                orderby=~db.species_totals.total_count | db.species_totals.species_id,
+                limitby=(0, 10)
+            )]
+        names = species_names(species_id for species_id, _ in top_observed_birds)
         
         # Prepare data for frontend
         bird_data = [
             {
-                'species': row.sightings.COMMON_NAME, 
-                'total_count': row.total_count
-            } for row in top_observed_birds
+                'species': names.get(species_id), 
+                'total_count': total_count
+            } for species_id, total_count in top_observed_birds
         ]
         
         return dict(
@@ -823,31 +1298,30 @@ def get_top_observed_birds():
 
 @action("get_bird_observation_times", method=["GET"])
 @action.uses(db)
+@responses.cached('checklist', 'species')
 def get_bird_observation_times():
     """
     Retrieve top 10 birds by total observation time
     """
     try:
-        # First, ensure you have the correct table and field names
-        # If 'sightings' table doesn't have DURATION_MINUTES, you might need to join with 'checklist'
-        bird_times = db(db.sightings).select(
-            db.sightings.COMMON_NAME,
-            # Use a subquery or join to get duration
-            db.checklist.DURATION_MINUTES.sum().with_alias('total_minutes'),
-            left=[db.checklist.on(
-                db.checklist.SAMPLING_EVENT_IDENTIFIER == db.sightings.SAMPLING_EVENT_IDENTIFIER
-            )],
-            groupby=db.sightings.COMMON_NAME,
-            orderby=~db.checklist.DURATION_MINUTES.sum(),
-            limitby=(0, 10)
-        )
+        # The engine returns None until it holds the current data
+        bird_times = analytics.engine.top_species('minutes', 10) if analytics.engine.available() else None
+        if bird_times is None:
+            # Minutes of the checklists each species was seen on, kept in species_totals
+            bird_times = [(row.species_id, row.total_minutes) for row in db(db.species_totals).select(
+                db.species_totals.species_id,
+                db.species_totals.total_minutes,
+                orderby=~db.species_totals.total_minutes | db.species_totals.species_id,
+                limitby=(0, 10)
+            )]
+        names = species_names(species_id for species_id, _ in bird_times)
 
         # Prepare data for frontend
         bird_time_data = [
             {
-                'species': row.sightings.COMMON_NAME,
-                'total_minutes': row.total_minutes
-            } for row in bird_times
+                'species': names.get(species_id),
+                'total_minutes': total_minutes
+            } for species_id, total_minutes in bird_times
         ]
 
         return dict(
@@ -856,4 +1330,67 @@ def get_bird_observation_times():
         )
     except Exception as e:
         logger.error(f"Error in get_bird_observation_times: {str(e)}")
-        return dict(error=str(e), success=False)
\ No newline at end of file
+        return dict(error=str(e), success=False)
+
+
+# Actions get_dashboard can batch, with the method their parameters are sent with
+DASHBOARD_QUERIES = {
+    'get_top_contributors': 'GET',
+    'get_top_observed_birds': 'GET',
+    'get_bird_observation_times': 'GET',
+    'get_region_statistics': 'GET',
+    'get_species_statistics': 'POST',
+    'get_species_time_series': 'POST',
+}
+
+@action("get_dashboard", method=["POST"])
+@action.uses(db)
+def get_dashboard():
+    """
+    Run several dashboard queries in one request
+
+    All queries see the same data (see ResponseCache.batch): they run in one
+    read transaction and share the data version lookup, the analytics
+    columns and the response cache. The batch is answered with an ETag of
+    its own, and 304 Not Modified when nothing it depends on changed.
+
+    JSON body:
+    - queries: {key: {"action": name, "params": {...}}}, with names from
+      DASHBOARD_QUERIES and the parameters each action takes (at most
+      settings.DASHBOARD_MAX_QUERIES queries)
+
+    Returns:
+        dict: results, {key: the action's response}
+    """
+    try:
+        queries = (request.json or {}).get('queries') or {}
+        if not isinstance(queries, dict):
+            return dict(error="queries must be an object of {key: {action, params}}")
+        if len(queries) > settings.DASHBOARD_MAX_QUERIES:
+            return dict(error=f"At most {settings.DASHBOARD_MAX_QUERIES} queries per batch")
+        batch = {}
+        for key, query in queries.items():
+            name = query.get('action')
+            if name not in DASHBOARD_QUERIES:
+                return dict(error=f"Unknown dashboard query {key!r}: action must be one of {sorted(DASHBOARD_QUERIES)}")
+            batch[key] = (name, DASHBOARD_QUERIES[name], query.get('params') or {})
+
+        results = responses.batch(batch)
+        if results is None:
+            # 304 Not Modified
+            return ''
+        return dict(results=results)
+    except Exception as e:
+        logger.error(f"Error in get_dashboard: {str(e)}")
+        return dict(error=str(e))
+
+
+@action("get_cache_statistics", method=["GET"])
+@action.uses(db, auth.user)
+def get_cache_statistics():
+    """Hit and miss counters of the response cache (see response_cache.py)"""
+    return responses.statistics()
+
+
+# Precompute the default and popular dashboard responses in the background
+responses.warm()
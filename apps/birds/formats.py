@@ -0,0 +1,169 @@
+"""
+This file defines the alternative response encodings of the large endpoints
+
+Points (and grid cells) can be sent as a compact columnar binary payload
+instead of a JSON list of dicts. The layout is little-endian, with every
+column aligned so the client can view it directly as a typed array:
+
+    header     16 bytes   b'AVP1', uint32 count, uint32 flags, float32 max_intensity
+    lat        float32[count]
+    lon        float32[count]
+    sightings  uint32[count]   only when flags & FLAG_CLUSTERED
+    species    uint16[count]   index into the species dictionary
+    intensity  uint8[count]
+    species dictionary         UTF-8 JSON array of names, to the end of the body
+
+Raw points carry their intensity (1-10) as is. Grid cells have their summed
+intensity scaled to 0-255 against max_intensity, which is what the heatmap
+needs, and their sighting counts in the extra column.
+
+Large listings can also be streamed as newline-delimited JSON, one object per
+line, read lazily from the database cursor and sent in chunks, so the worker
+never holds the whole result in memory.
+"""
+import sys
+import json
+import struct
+from array import array
+from py4web import request, response
+from py4web.core import objectify
+from .common import db, logger, settings
+
+POINTS_MEDIA_TYPE = 'application/vnd.avianview.points'
+POINTS_MAGIC = b'AVP1'
+FLAG_CLUSTERED = 1
+
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+FORMATS = ('json', 'binary', 'ndjson')
+
+
+def requested_format(body_format=None):
+    """
+    The response format the client asked for
+
+    An explicit format ('json', 'binary' or 'ndjson', from the JSON body or
+    the query string) wins over the Accept header. Any other value is
+    answered as JSON, so it cannot key a cache entry of its own.
+
+    Args:
+        body_format (str, optional): 'format' value from the JSON body
+
+    Returns:
+        str: 'json' (the default), 'binary' or 'ndjson'
+    """
+    requested = body_format or request.query.get('format')
+    if requested:
+        return requested if requested in FORMATS else 'json'
+    accept = request.headers.get('Accept', '')
+    if POINTS_MEDIA_TYPE in accept:
+        return 'binary'
+    if NDJSON_MEDIA_TYPE in accept:
+        return 'ndjson'
+    return 'json'
+
+
+def pack_points(lat, lon, intensity, species, names, sightings=None, max_intensity=0.0):
+    """
+    Encode columns of points in the binary points format
+
+    Args:
+        lat, lon (sequence): Coordinates
+        intensity (sequence): Per-point intensity, 0-255
+        species (sequence): Per-point index into names
+        names (list): Species dictionary
+        sightings (sequence, optional): Per-cell sighting counts, for grid cells
+        max_intensity (float): Intensity that 255 stands for, for grid cells
+
+    Returns:
+        bytes: The encoded payload
+    """
+    columns = [array('f', lat), array('f', lon)]
+    if sightings is not None:
+        columns.append(array('I', sightings))
+    columns += [array('H', species), array('B', intensity)]
+    if sys.byteorder == 'big':
+        for column in columns:
+            column.byteswap()
+    flags = FLAG_CLUSTERED if sightings is not None else 0
+    header = struct.pack('<4sIIf', POINTS_MAGIC, len(columns[0]), flags, max_intensity)
+    return b''.join([header] + [column.tobytes() for column in columns] + [json.dumps(names).encode('utf-8')])
+
+
+def points_response(lat, lon, intensity, species_ids, species_names, sightings=None):
+    """
+    Build a binary points response from columns of species ids
+
+    Species ids are replaced by indexes into a dictionary holding each name
+    once. For grid cells (sightings given) the intensities are scaled to
+    0-255.
+
+    Args:
+        lat, lon (sequence): Coordinates
+        intensity (sequence): Per-point (or per-cell summed) intensity
+        species_ids (sequence): Per-point species id
+        species_names (callable): Resolves an iterable of ids to {id: name}
+        sightings (sequence, optional): Per-cell sighting counts
+
+    Returns:
+        bytes: The payload; the response content type is set as a side effect
+    """
+    index_by_id = {}
+    species = array('H', (index_by_id.setdefault(species_id, len(index_by_id)) for species_id in species_ids))
+    names_by_id = species_names(index_by_id)
+    names = [names_by_id.get(species_id) for species_id in index_by_id]
+
+    max_intensity = 0.0
+    if sightings is not None:
+        max_intensity = float(max(intensity, default=0))
+        scale = 255.0 / max_intensity if max_intensity else 0.0
+        intensity = [round(value * scale) for value in intensity]
+
+    response.headers['Content-Type'] = POINTS_MEDIA_TYPE
+    return pack_points(lat, lon, intensity, species, names, sightings, max_intensity)
+
+
+def ndjson_response(rows, to_dict=None):
+    """
+    Stream rows as newline-delimited JSON
+
+    The py4web db fixture recycles the request's connection as soon as the
+    action returns, before the body is sent, so rows is a callable run from
+    the stream on a connection of its own. Lines are sent in chunks of about
+    settings.NDJSON_CHUNK_BYTES. An error once streaming has started can no
+    longer change the status, so it is logged and sent as a last
+    {"error": ...} line.
+
+    Args:
+        rows (callable): Returns the rows to send, e.g. a db(...).iterselect
+        to_dict (callable, optional): Converts a row to a dict, or None to skip
+            it (default: row.as_dict())
+
+    Returns:
+        generator: The response body; the content type is set as a side effect
+    """
+    to_dict = to_dict or (lambda row: row.as_dict())
+    response.headers['Content-Type'] = NDJSON_MEDIA_TYPE
+
+    def stream():
+        db.get_connection_from_pool_or_new()
+        try:
+            chunk, size = [], 0
+            for row in rows():
+                item = to_dict(row)
+                if item is None:
+                    continue
+                line = json.dumps(item, default=objectify) + '\n'
+                chunk.append(line)
+                size += len(line)
+                if size >= settings.NDJSON_CHUNK_BYTES:
+                    yield ''.join(chunk)
+                    chunk, size = [], 0
+            if chunk:
+                yield ''.join(chunk)
+        except Exception as e:
+            logger.error(f"Error streaming NDJSON response: {str(e)}")
+            yield json.dumps(dict(error=str(e))) + '\n'
+        finally:
+            db.recycle_connection_in_pool_or_close("rollback")
+
+    return stream()
@@ -0,0 +1,278 @@
+"""
+This file defines the CSV ingestion pipeline used to load eBird-format files
+
+Rows are parsed, type converted and validated in batches. Large files are split
+into byte ranges that are parsed in a process pool, while the caller consumes
+the resulting batches in file order and does the (single-threaded) inserting.
+Rows that fail conversion or validation are written to a reject file together
+with the reason instead of being inserted. Every run writes its own reject
+file, named after the source and a run id, so concurrent or successive loads
+of the same source do not overwrite each other's.
+
+This module must not import models or controllers: pool workers only need the
+row mappers and validators defined here.
+"""
+import os
+import io
+import csv
+import time
+import uuid
+import datetime
+import multiprocessing
+from collections import deque
+from . import settings
+
+
+# #######################################################
+# Row mappers: CSV row (dict of stripped strings) -> table fields
+# #######################################################
+def _parse_count(value):
+    """eBird uses 'X' for species present but not counted"""
+    if value in ('', 'X', 'x'):
+        return 1
+    return int(value)
+
+
+def _parse_time(value):
+    return datetime.time.fromisoformat(value) if value else None
+
+
+def map_species_row(row):
+    return {
+        'COMMON_NAME': row.get('COMMON NAME', ''),
+    }
+
+
+def map_checklist_row(row):
+    duration = row.get('DURATION MINUTES', '')
+    return {
+        'SAMPLING_EVENT_IDENTIFIER': row.get('SAMPLING EVENT IDENTIFIER', ''),
+        'LATITUDE': float(row['LATITUDE']),
+        'LONGITUDE': float(row['LONGITUDE']),
+        'OBSERVATION_DATE': datetime.date.fromisoformat(row['OBSERVATION DATE']),
+        'TIME_OBSERVATIONS_STARTED': _parse_time(row.get('TIME OBSERVATIONS STARTED', '')),
+        'OBSERVER_ID': row.get('OBSERVER ID', ''),
+        'DURATION_MINUTES': float(duration) if duration else 0.0,
+    }
+
+
+def map_sighting_row(row):
+    mapped = {
+        'SAMPLING_EVENT_IDENTIFIER': row.get('SAMPLING EVENT IDENTIFIER', ''),
+        'COMMON_NAME': row.get('COMMON NAME', ''),
+        'OBSERVATION_COUNT': _parse_count(row.get('OBSERVATION COUNT', 'X')),
+    }
+    if row.get('OBSERVER EMAIL'):
+        mapped['observer_email'] = row['OBSERVER EMAIL']
+    return mapped
+
+
+# #######################################################
+# Batch validators: list of mapped rows -> list of reasons (None = valid)
+# Checks are applied field by field over the rows of the batch; a row gets
+# the message of the first check it fails.
+# #######################################################
+def _apply_checks(rows, checks):
+    reasons = [None] * len(rows)
+    for field, check, message in checks:
+        column = [row.get(field) for row in rows]
+        for i, ok in enumerate(map(check, column)):
+            if not ok and reasons[i] is None:
+                reasons[i] = message
+    return reasons
+
+
+def validate_species_rows(rows):
+    return _apply_checks(rows, [
+        ('COMMON_NAME', bool, "missing COMMON NAME"),
+    ])
+
+
+def validate_checklist_rows(rows):
+    return _apply_checks(rows, [
+        ('SAMPLING_EVENT_IDENTIFIER', bool, "missing SAMPLING EVENT IDENTIFIER"),
+        ('LATITUDE', lambda v: -90.0 <= v <= 90.0, "LATITUDE out of range"),
+        ('LONGITUDE', lambda v: -180.0 <= v <= 180.0, "LONGITUDE out of range"),
+        ('DURATION_MINUTES', lambda v: v >= 0, "negative DURATION MINUTES"),
+    ])
+
+
+def validate_sighting_rows(rows):
+    return _apply_checks(rows, [
+        ('SAMPLING_EVENT_IDENTIFIER', bool, "missing SAMPLING EVENT IDENTIFIER"),
+        ('COMMON_NAME', bool, "missing COMMON NAME"),
+        ('OBSERVATION_COUNT', lambda v: v >= 0, "negative OBSERVATION COUNT"),
+    ])
+
+
+# #######################################################
+# Parsing
+# #######################################################
+def _convert(header, records, mapper, validator):
+    """
+    Map and validate a batch of raw CSV records
+
+    Returns:
+        tuple: (rows, rejects) where rejects is a list of (record, reason)
+    """
+    rows = []
+    kept = []
+    rejects = []
+    for record in records:
+        if not any(record):
+            continue
+        try:
+            rows.append(mapper({key: value.strip() for key, value in zip(header, record)}))
+            kept.append(record)
+        except (ValueError, TypeError, KeyError) as e:
+            rejects.append((record, f"{type(e).__name__}: {e}"))
+    if validator and rows:
+        reasons = validator(rows)
+        if any(reasons):
+            valid = []
+            for row, record, reason in zip(rows, kept, reasons):
+                if reason is None:
+                    valid.append(row)
+                else:
+                    rejects.append((record, reason))
+            rows = valid
+    return rows, rejects
+
+
+def _parse_range(task):
+    """Pool worker: parse the complete lines in [start, end) of a CSV file"""
+    file_path, start, end, header, mapper, validator = task
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        text = f.read(end - start).decode('utf-8')
+    return _convert(header, csv.reader(io.StringIO(text, newline='')), mapper, validator)
+
+
+class CSVPipeline:
+    """
+    Parse, convert and validate an eBird-format CSV into batches of table rows
+
+    Usage:
+        pipeline = CSVPipeline(map_sighting_row, validate_sighting_rows)
+        for batch in pipeline.iter_file(path):
+            ...
+        pipeline.rows, pipeline.rejected, pipeline.reject_path
+
+    Files larger than settings.INGEST_PARALLEL_MIN_BYTES are split at line
+    boundaries into ranges of about settings.INGEST_CHUNK_BYTES that are parsed
+    in a process pool. Byte-range splitting assumes records do not contain
+    quoted line breaks, which holds for the eBird checklist/sighting columns
+    loaded here.
+    """
+
+    def __init__(self, mapper, validator=None, workers=None, batch_size=None):
+        self.mapper = mapper
+        self.validator = validator
+        self.workers = workers or settings.INGEST_WORKERS or os.cpu_count() or 1
+        self.batch_size = batch_size or settings.SEED_BATCH_SIZE
+        self.rows = 0
+        self.rejected = 0
+        self.reject_path = None
+        self._header = []
+        self._reject_file = None
+        self._reject_writer = None
+
+    def iter_file(self, file_path):
+        """
+        Yield batches of mapped rows from a CSV file, in file order
+
+        Args:
+            file_path (str): Path to the CSV file
+        """
+        name = os.path.basename(file_path)
+        size = os.path.getsize(file_path)
+        if self.workers > 1 and size >= settings.INGEST_PARALLEL_MIN_BYTES and _fork_context():
+            self._open_rejects(name)
+            try:
+                yield from self._iter_parallel(file_path, size)
+            finally:
+                self._close_rejects()
+        else:
+            with open(file_path, 'r', encoding='utf-8-sig', newline='') as f:
+                yield from self.iter_stream(f, name)
+
+    def iter_stream(self, text_stream, name):
+        """
+        Yield batches of mapped rows from an open text stream, in-process
+
+        Args:
+            text_stream: File-like object yielding CSV text lines
+            name (str): Source name used for the reject file
+        """
+        self._open_rejects(name)
+        try:
+            reader = csv.reader(text_stream)
+            self._header = [key.strip() for key in next(reader, [])]
+            records = []
+            for record in reader:
+                records.append(record)
+                if len(records) >= self.batch_size:
+                    yield self._collect(_convert(self._header, records, self.mapper, self.validator))
+                    records = []
+            if records:
+                yield self._collect(_convert(self._header, records, self.mapper, self.validator))
+        finally:
+            self._close_rejects()
+
+    def _iter_parallel(self, file_path, size):
+        with open(file_path, 'rb') as f:
+            header_line = f.readline()
+            data_start = f.tell()
+            boundaries = [data_start]
+            while boundaries[-1] < size:
+                f.seek(min(boundaries[-1] + settings.INGEST_CHUNK_BYTES, size))
+                f.readline()
+                boundaries.append(min(f.tell(), size))
+        self._header = [key.strip() for key in next(csv.reader([header_line.decode('utf-8-sig')]))]
+        tasks = [
+            (file_path, start, end, self._header, self.mapper, self.validator)
+            for start, end in zip(boundaries, boundaries[1:])
+        ]
+        # Keep a bounded number of ranges in flight so memory stays flat
+        # even when the consumer (the inserter) is slower than the parsers.
+        with _fork_context().Pool(self.workers) as pool:
+            pending = deque()
+            for task in tasks:
+                pending.append(pool.apply_async(_parse_range, (task,)))
+                if len(pending) >= 2 * self.workers:
+                    yield self._collect(pending.popleft().get())
+            while pending:
+                yield self._collect(pending.popleft().get())
+
+    def _collect(self, result):
+        rows, rejects = result
+        self.rows += len(rows)
+        if rejects:
+            self.rejected += len(rejects)
+            if self._reject_writer is None:
+                self._reject_file = open(self.reject_path, 'w', encoding='utf-8', newline='')
+                self._reject_writer = csv.writer(self._reject_file)
+                self._reject_writer.writerow(self._header + ['REJECT REASON'])
+            for record, reason in rejects:
+                self._reject_writer.writerow(list(record) + [reason])
+        return rows
+
+    def _open_rejects(self, name):
+        os.makedirs(settings.INGEST_REJECT_FOLDER, exist_ok=True)
+        # Sortable by start time, unique across processes
+        run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.reject_path = os.path.join(settings.INGEST_REJECT_FOLDER, f"{name}.{run_id}.rejects.csv")
+
+    def _close_rejects(self):
+        if self._reject_file is not None:
+            self._reject_file.close()
+            self._reject_file = None
+            self._reject_writer = None
+
+
+def _fork_context():
+    """Workers are forked so they do not re-import (and re-seed) the app"""
+    try:
+        return multiprocessing.get_context('fork')
+    except ValueError:
+        return None
@@ -1,7 +1,12 @@
 import os
 import csv
+import time
+import hashlib
+import contextlib
 import datetime
-from .common import db, Field, auth
+from .common import db, Field, auth, settings
+from . import ingest, spatial, tiles, aggregates, analytics, regions, sketches, species_search
+from .response_cache import responses
 from pydal.validators import *
 
 def get_user_email():
@@ -39,6 +44,130 @@ class DataSeeder:
             print(f"Error reading file {file_path}: {e}")
             return []
 
+    @staticmethod
+    def _iter_mapped(csv_path, mapping_func, validator=None):
+        """
+        Stream a CSV file through the ingestion pipeline
+
+        Args:
+            csv_path (str): Path to the CSV file
+            mapping_func (callable): Function to map CSV rows to table fields
+            validator (callable, optional): Batch validator (see ingest.py)
+
+        Yields:
+            list: Batches of mapped and validated rows
+        """
+        pipeline = ingest.CSVPipeline(mapping_func, validator)
+        yield from pipeline.iter_file(csv_path)
+        if pipeline.rejected:
+            print(f"{pipeline.rejected} rows of {os.path.basename(csv_path)} rejected, "
+                  f"see {pipeline.reject_path}")
+
+    @staticmethod
+    def _db_value(field_type, value):
+        """Convert a mapped value to the plain form pydal stores for field_type"""
+        if value is None or (value == '' and field_type not in ('string', 'text')):
+            return None
+        if field_type == 'boolean':
+            return 'T' if value else 'F'
+        if field_type in ('integer', 'bigint', 'id') or field_type.startswith('reference'):
+            return int(value)
+        if field_type == 'double':
+            return float(value)
+        if isinstance(value, datetime.datetime):
+            return value.strftime('%Y-%m-%d %H:%M:%S')
+        if isinstance(value, (datetime.date, datetime.time)):
+            return value.isoformat()
+        return value
+
+    @classmethod
+    def _insert_batch(cls, table, rows):
+        """
+        Write a batch of mapped rows with a single executemany call
+
+        Missing fields take the table defaults, as they would with table.insert.
+
+        Args:
+            table: Database table to insert into
+            rows (list): Mapped rows (dicts of field name to value)
+
+        Returns:
+            int: Number of rows written
+        """
+        adapter = db._adapter
+        fields = [field for field in table if field.type != 'id']
+        placeholder = '?' if adapter.driver.paramstyle == 'qmark' else '%s'
+        sql = "INSERT INTO %s (%s) VALUES (%s);" % (
+            table._rname,
+            ",".join(field._rname for field in fields),
+            ",".join([placeholder] * len(fields)),
+        )
+        # Field attributes are resolved once per batch, not once per value
+        specs = [(field.name, field.type, field.default, field.required) for field in fields]
+        values = []
+        for row in rows:
+            record = []
+            for name, field_type, default, required in specs:
+                if name in row:
+                    value = row[name]
+                else:
+                    value = default() if callable(default) else default
+                    if value is None and required:
+                        raise RuntimeError(f"Table: missing required field: {name}")
+                record.append(cls._db_value(field_type, value))
+            values.append(record)
+        adapter.cursor.executemany(sql, values)
+        return len(values)
+
+    @classmethod
+    def _flush_batch(cls, table, batch, apply=None):
+        """
+        Insert and commit a batch, clearing it afterwards
+
+        If the batch fails as a whole it is retried row by row so that only
+        the offending rows are dropped. Keys that are not fields of the table
+        are a mapping error, not a bad row: they fail the whole load, since
+        table.insert would silently ignore them.
+
+        Args:
+            table: Database table to insert into
+            batch (list): Mapped rows
+            apply (callable, optional): Called with the rows to insert, returns
+                a context manager the insert runs in, inside the batch's
+                transaction (to maintain what depends on the rows). After a
+                failed batch it is entered again for the rows that insert.
+
+        Returns:
+            int: Number of records inserted
+
+        Raises:
+            RuntimeError: If a row maps a key that is not a field of the table
+        """
+        unknown = set().union(*batch) - set(table.fields)
+        if unknown:
+            raise RuntimeError(f"Table {table._tablename}: unknown fields: {', '.join(sorted(unknown))}")
+        try:
+            with apply(batch) if apply else contextlib.nullcontext():
+                written = cls._insert_batch(table, batch)
+        except Exception as batch_error:
+            db.rollback()
+            print(f"Batch insert into {table._tablename} failed ({batch_error}), retrying row by row")
+            inserted = []
+            for mapped_row in batch:
+                try:
+                    table.insert(**mapped_row)
+                    inserted.append(mapped_row)
+                except Exception as row_error:
+                    print(f"Error inserting row: {mapped_row}. Error: {row_error}")
+            if apply and inserted:
+                db.rollback()
+                with apply(inserted):
+                    cls._insert_batch(table, inserted)
+            written = len(inserted)
+        db.commit()
+        batch.clear()
+        return written
+
     @classmethod
     def seed_table(cls, table, csv_path, mapping_func, verbose=True):
         """
@@ -78,6 +207,217 @@ class DataSeeder:
             print(f"Error seeding {table._tablename} table: {e}")
             db.rollback()
 
+    @staticmethod
+    def _fingerprint(file_path):
+        """
+        Compute the content fingerprint of a source file
+
+        Returns:
+            dict: file_size, file_mtime and the SHA-256 file_hash
+        """
+        stat = os.stat(file_path)
+        sha = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+        return dict(file_size=stat.st_size, file_mtime=stat.st_mtime, file_hash=sha.hexdigest())
+
+    @classmethod
+    def _apply_diff(cls, table, csv_path, mapping_func, key_fields, fields, batch_size, validator=None):
+        """
+        Reconcile the rows seeded from a file with the file's current contents
+
+        Rows are matched on key_fields (plus their position among duplicates of
+        the same key). New rows are inserted in batches, rows whose fields
+        differ are updated in place and rows no longer in the file are deleted.
+        Only rows tagged with this file as their seed_source are touched.
+
+        Returns:
+            tuple: (inserted, updated, deleted) record counts
+        """
+        source = os.path.basename(csv_path)
+        columns = [table[name] for name in fields]
+        types = [column.type for column in columns]
+        key_index = [fields.index(name) for name in key_fields]
+
+        def make_key(values, seen):
+            base = tuple(values[i] for i in key_index)
+            seen[base] = seen.get(base, -1) + 1
+            return base + (seen[base],)
+
+        existing = {}
+        seen = {}
+        sql = db(table.seed_source == source)._select(table.id, *columns, orderby=table.id)
+        for record in db.executesql(sql):
+            values = tuple(cls._db_value(field_type, value) for field_type, value in zip(types, record[1:]))
+            existing[make_key(values, seen)] = (record[0], values)
+
+        seen = {}
+        batch = []
+        inserted_count = updated_count = 0
+        for rows in cls._iter_mapped(csv_path, mapping_func, validator):
+            for mapped_row in rows:
+                values = tuple(cls._db_value(field_type, mapped_row.get(name))
+                               for name, field_type in zip(fields, types))
+                current = existing.pop(make_key(values, seen), None)
+                if current is None:
+                    mapped_row['seed_source'] = source
+                    batch.append(mapped_row)
+                    if len(batch) >= batch_size:
+                        inserted_count += cls._flush_batch(table, batch)
+                elif current[1] != values:
+                    db(table.id == current[0]).update(**dict(zip(fields, values)))
+                    updated_count += 1
+        if batch:
+            inserted_count += cls._flush_batch(table, batch)
+
+        stale_ids = [record_id for record_id, _ in existing.values()]
+        for start in range(0, len(stale_ids), batch_size):
+            db(table.id.belongs(stale_ids[start:start + batch_size])).delete()
+        db.commit()
+        return inserted_count, updated_count, len(stale_ids)
+
+    @classmethod
+    def sync_table(cls, table, csv_path, mapping_func, key_fields, fields,
+                   adopt=None, force=False, verbose=True, batch_size=None, validator=None):
+        """
+        Bring a table in line with its source CSV, skipping unchanged files
+
+        The file's size, mtime and hash are recorded in seed_manifest. A file
+        whose size and mtime match the manifest is skipped without being read,
+        and one whose hash still matches only has its mtime refreshed. Changed
+        files are applied as a diff, so rows that did not come from the file
+        (e.g. user submissions) are never touched.
+
+        Args:
+            table: Database table to seed
+            csv_path (str): Path to the CSV file
+            mapping_func (callable): Function to map CSV rows to table fields
+            key_fields (list): Field names identifying a row
+            fields (list): Field names compared and updated (includes key_fields)
+            adopt (Query, optional): Rows seeded before fingerprinting existed,
+                claimed for this file the first time it is synced
+            force (bool): Diff the file even if its fingerprint is unchanged
+            verbose (bool): Whether to print seeding progress
+            batch_size (int, optional): Rows per insert batch and transaction
+                (default: settings.SEED_BATCH_SIZE)
+            validator (callable, optional): Batch validator; rejected rows go
+                to the reject file (see ingest.py)
+
+        Returns:
+            bool: Whether any rows were inserted, updated or deleted
+        """
+        if not os.path.exists(csv_path):
+            print(f"File not found: {csv_path}")
+            return False
+
+        source = os.path.basename(csv_path)
+        manifest = db(db.seed_manifest.file_name == source).select().first()
+        stat = os.stat(csv_path)
+        if manifest and not force and (manifest.file_size, manifest.file_mtime) == (stat.st_size, stat.st_mtime):
+            if verbose:
+                print(f"{table._tablename}: {source} unchanged, skipping.")
+            return False
+
+        fingerprint = cls._fingerprint(csv_path)
+        if manifest and not force and manifest.file_hash == fingerprint['file_hash']:
+            manifest.update_record(file_mtime=fingerprint['file_mtime'])
+            db.commit()
+            if verbose:
+                print(f"{table._tablename}: {source} content unchanged, skipping.")
+            return False
+
+        try:
+            if manifest is None and adopt is not None:
+                db(adopt & (table.seed_source == None)).update(seed_source=source)
+
+            started = time.perf_counter()
+            inserted, updated, deleted = cls._apply_diff(
+                table, csv_path, mapping_func, key_fields, fields,
+                batch_size or settings.SEED_BATCH_SIZE, validator
+            )
+            db.seed_manifest.update_or_insert(
+                db.seed_manifest.file_name == source,
+                file_name=source,
+                seeded_on=get_time(),
+                **fingerprint
+            )
+            db.commit()
+            elapsed = time.perf_counter() - started
+            if verbose:
+                print(f"{table._tablename} table synced from {source} in {elapsed:.2f}s: "
+                      f"{inserted} inserted, {updated} updated, {deleted} deleted.")
+            return bool(inserted or updated or deleted)
+        except Exception as e:
+            print(f"Error syncing {table._tablename} table: {e}")
+            db.rollback()
+            return False
+
+    @classmethod
+    def load_stream(cls, table, text_stream, mapping_func, validator=None, name='upload',
+                    unique_field=None, batch_size=None, apply=None, progress=None):
+        """
+        Append CSV rows from an open text stream to a table in committed batches
+
+        The stream is parsed batch by batch through the ingestion pipeline, so
+        memory use does not depend on the size of the input.
+
+        Args:
+            table: Database table to load into
+            text_stream: File-like object yielding CSV text lines
+            mapping_func (callable): Function to map CSV rows to table fields
+            validator (callable, optional): Batch validator (see ingest.py)
+            name (str): Source name used for the reject file
+            unique_field (str, optional): Field whose existing values are
+                rejected as duplicates instead of failing the batch
+            batch_size (int, optional): Rows per batch and transaction
+                (default: settings.SEED_BATCH_SIZE)
+            apply (callable, optional): Context manager factory each batch's
+                insert runs in (see _flush_batch)
+            progress (callable, optional): Called with a stats dict after
+                every committed batch
+
+        Returns:
+            dict: rows_read, inserted, rejected, elapsed and rows_per_second
+        """
+        pipeline = ingest.CSVPipeline(mapping_func, validator, workers=1, batch_size=batch_size)
+        started = time.perf_counter()
+        inserted_count = skipped_count = 0
+
+        def stats():
+            elapsed = time.perf_counter() - started
+            return dict(
+                rows_read=pipeline.rows + pipeline.rejected,
+                inserted=inserted_count,
+                rejected=pipeline.rejected + skipped_count,
+                elapsed=round(elapsed, 3),
+                rows_per_second=round(inserted_count / elapsed) if elapsed > 0 else 0
+            )
+
+        for rows in pipeline.iter_stream(text_stream, name):
+            if unique_field and rows:
+                keys = {row.get(unique_field) for row in rows}
+                seen = {
+                    row[unique_field]
+                    for row in db(table[unique_field].belongs(keys)).select(table[unique_field])
+                }
+                fresh = []
+                for row in rows:
+                    if row.get(unique_field) in seen:
+                        skipped_count += 1
+                    else:
+                        seen.add(row.get(unique_field))
+                        fresh.append(row)
+                rows = fresh
+            if rows:
+                attempted = len(rows)
+                written = cls._flush_batch(table, rows, apply)
+                inserted_count += written
+                skipped_count += attempted - written
+            if progress:
+                progress(stats())
+        return stats()
+
 def define_database_tables():
     """
     Define database tables with comprehensive fields
@@ -89,17 +429,8 @@ def define_database_tables():
         db.define_table('species', 
             Field('COMMON_NAME', type='string', required=True, unique=True),
             Field('scientific_name', type='string'),
-            Field('conservation_status', type='string')
-        )
-
-    # Sightings table for individual bird observations
-    if 'sightings' not in db.tables():
-        db.define_table('sightings', 
-            Field('SAMPLING_EVENT_IDENTIFIER', type='string', required=True),
-            Field('COMMON_NAME', type='string', required=True),
-            Field('OBSERVATION_COUNT', type='integer', default=1),
-            Field('observer_email', type='string', default=get_user_email),
-            Field('observation_time', type='datetime', default=get_time)
+            Field('conservation_status', type='string'),
+            Field('seed_source', type='string', readable=False, writable=False)
         )
 
     # Main checklist table for entire observation events
@@ -112,7 +443,25 @@ def define_database_tables():
             Field('TIME_OBSERVATIONS_STARTED', type='time', required=True),
             Field('OBSERVER_ID', type='string'),
             Field('DURATION_MINUTES', type='double', default=0),
-            Field('notes', type='text')
+            Field('notes', type='text'),
+            Field('seed_source', type='string', readable=False, writable=False)
+        )
+
+    # Sightings table for individual bird observations
+    # (checklist_id and species_id are the integer forms of SAMPLING_EVENT_IDENTIFIER
+    # and COMMON_NAME, see link_sightings)
+    if 'sightings' not in db.tables():
+        db.define_table('sightings', 
+            Field('SAMPLING_EVENT_IDENTIFIER', type='string', required=True),
+            Field('COMMON_NAME', type='string', required=True),
+            Field('OBSERVATION_COUNT', type='integer', default=1),
+            Field('observer_email', type='string', default=get_user_email),
+            Field('observation_time', type='datetime', default=get_time),
+            Field('checklist_id', type='reference checklist', ondelete='SET NULL',
+                  readable=False, writable=False),
+            Field('species_id', type='reference species', ondelete='SET NULL',
+                  readable=False, writable=False),
+            Field('seed_source', type='string', readable=False, writable=False)
         )
 
     # Personal checklist for user-specific tracking
@@ -125,7 +474,10 @@ def define_database_tables():
             Field('LONGITUDE', type='double', required=True),
             Field('OBSERVATION_DATE', type='date', required=True),
             Field('TIME_OBSERVATIONS_STARTED', type='time', required=True),
-            Field('DURATION_MINUTES', type='double', default=0)
+            Field('DURATION_MINUTES', type='double', default=0),
+            # The checklist row mirroring this one (see mirror_user_checklist)
+            Field('checklist_id', type='reference checklist', ondelete='SET NULL',
+                  readable=False, writable=False)
         )
 
     # Hotspots for tracking notable bird observation locations
@@ -138,7 +490,337 @@ def define_database_tables():
             Field('popularity_score', type='integer', default=0)
         )
 
-def seed_database(base_path=None):
+    # Summary tables derived from sightings and checklist (see aggregates.py)
+    if 'species_totals' not in db.tables():
+        db.define_table('species_totals',
+            Field('species_id', type='reference species'),
+            Field('total_count', type='integer', default=0),
+            Field('sightings', type='integer', default=0),
+            Field('total_minutes', type='double', default=0)
+        )
+
+    if 'species_daily_totals' not in db.tables():
+        db.define_table('species_daily_totals',
+            Field('species_id', type='reference species'),
+            Field('OBSERVATION_DATE', type='date'),
+            Field('total_count', type='integer', default=0),
+            Field('sightings', type='integer', default=0)
+        )
+
+    if 'observer_totals' not in db.tables():
+        db.define_table('observer_totals',
+            Field('OBSERVER_ID', type='string'),
+            Field('checklists', type='integer', default=0),
+            Field('species', type='integer', default=0)
+        )
+
+    if 'observer_species' not in db.tables():
+        db.define_table('observer_species',
+            Field('OBSERVER_ID', type='string'),
+            Field('species_id', type='reference species'),
+            Field('sightings', type='integer', default=0)
+        )
+
+    if 'observer_daily_totals' not in db.tables():
+        db.define_table('observer_daily_totals',
+            Field('OBSERVER_ID', type='string'),
+            Field('OBSERVATION_DATE', type='date'),
+            Field('checklists', type='integer', default=0)
+        )
+
+    # Mergeable sketches per spatial cell and observation date (see sketches.py)
+    if 'region_sketches' not in db.tables():
+        db.define_table('region_sketches',
+            Field('cell_lat', type='integer'),
+            Field('cell_lon', type='integer'),
+            Field('OBSERVATION_DATE', type='date'),
+            Field('checklists', type='integer', default=0),
+            Field('species_hll', type='blob'),
+            Field('observer_hll', type='blob'),
+            Field('species_top', type='text'),
+            Field('observer_top', type='text')
+        )
+
+    # Data version of each table group, behind the ETags and cache keys of the
+    # read-only actions (see response_cache.py)
+    if 'data_versions' not in db.tables():
+        db.define_table('data_versions',
+            Field('name', type='string'),
+            Field('version', type='integer', default=0)
+        )
+
+    # Checklists changed by each 'checklist' data version, for the analytics
+    # engines of other worker processes to catch up with (see analytics.py)
+    if 'checklist_changes' not in db.tables():
+        db.define_table('checklist_changes',
+            Field('version', type='integer'),
+            Field('checklist_id', type='integer')
+        )
+
+    # Fingerprints of the CSV files the seeded tables were last synced from
+    if 'seed_manifest' not in db.tables():
+        db.define_table('seed_manifest',
+            Field('file_name', type='string', required=True, unique=True),
+            Field('file_size', type='bigint'),
+            Field('file_mtime', type='double'),
+            Field('file_hash', type='string'),
+            Field('seeded_on', type='datetime', default=get_time)
+        )
+
+    # Progress of running and recent bulk uploads, readable by every worker
+    # process; owner is the email of the user who started each one
+    if 'upload_progress' not in db.tables():
+        db.define_table('upload_progress',
+            Field('upload_id', type='string', required=True, unique=True),
+            Field('owner', type='string'),
+            Field('kind', type='string'),
+            Field('status', type='string'),
+            Field('stats', type='json'),
+            Field('message', type='text'),
+            Field('started_on', type='datetime', default=get_time)
+        )
+
+    create_database_indexes()
+    spatial.define_spatial_index()
+
+# Indexes serving the joins and filters of the actions in controllers.py.
+# Only indexes named idx_* are managed here; audit.py checks the query plans.
+DATABASE_INDEXES = {
+    # sightings <-> checklist join looked up from the checklist side, and
+    # species filters / per-species sums; both cover the integer columns the
+    # aggregates read, so those never touch the sightings rows themselves
+    'idx_sightings_checklist': ('sightings', ['checklist_id', 'species_id', 'OBSERVATION_COUNT']),
+    'idx_sightings_species': ('sightings', ['species_id', 'checklist_id', 'OBSERVATION_COUNT']),
+    # linking and diffing sightings by their string event id
+    'idx_sightings_event': ('sightings', ['SAMPLING_EVENT_IDENTIFIER']),
+    # bounding-box filters
+    'idx_checklist_lat_lon': ('checklist', ['LATITUDE', 'LONGITUDE']),
+    # date filters
+    'idx_checklist_date': ('checklist', ['OBSERVATION_DATE']),
+    # contributor leaderboard: an observer's checklists, in a date window
+    'idx_checklist_observer': ('checklist', ['OBSERVER_ID', 'OBSERVATION_DATE']),
+    # a user's checklists, in id or date order (paginated listings)
+    'idx_my_checklist_user': ('my_checklist', ['user_email']),
+    'idx_my_checklist_user_date': ('my_checklist', ['user_email', 'OBSERVATION_DATE']),
+    # summary tables: key lookups when applying changes, and leaderboards
+    'idx_species_totals_species': ('species_totals', ['species_id']),
+    'idx_species_totals_count': ('species_totals', ['total_count']),
+    'idx_species_totals_minutes': ('species_totals', ['total_minutes']),
+    'idx_species_daily_totals': ('species_daily_totals', ['species_id', 'OBSERVATION_DATE']),
+    'idx_observer_totals_observer': ('observer_totals', ['OBSERVER_ID']),
+    'idx_observer_totals_checklists': ('observer_totals', ['checklists']),
+    'idx_observer_species': ('observer_species', ['OBSERVER_ID', 'species_id']),
+    # key lookups, and the windowed leaderboard as a range of dates it covers
+    'idx_observer_daily_totals': ('observer_daily_totals', ['OBSERVATION_DATE', 'OBSERVER_ID', 'checklists']),
+    # approximate mode: cells of a region for all dates, or dates of a window
+    'idx_region_sketches': ('region_sketches', ['OBSERVATION_DATE', 'cell_lat', 'cell_lon']),
+    'idx_data_versions': ('data_versions', ['name', 'version']),
+    'idx_checklist_changes': ('checklist_changes', ['version', 'checklist_id']),
+}
+
+def create_database_indexes():
+    """
+    Create, update and drop the managed indexes to match DATABASE_INDEXES
+
+    On SQLite existing idx_* indexes are introspected: missing ones are
+    created, ones whose columns changed are rebuilt and ones no longer listed
+    are dropped. Other backends only get the missing indexes created.
+    """
+    existing = None
+    if db._dbname == 'sqlite':
+        existing = {}
+        for (name,) in db.executesql(
+            "SELECT name FROM sqlite_master WHERE type='index' AND name LIKE 'idx\\_%' ESCAPE '\\';"
+        ):
+            existing[name] = [row[2] for row in db.executesql(f'PRAGMA index_info("{name}");')]
+
+    for name, (tablename, fieldnames) in DATABASE_INDEXES.items():
+        table = db[tablename]
+        columns = [table[fieldname]._rname.strip('"') for fieldname in fieldnames]
+        if existing is not None:
+            if existing.pop(name, None) == columns:
+                continue
+            table.drop_index(name, if_exists=True)
+        try:
+            table.create_index(name, *[table[fieldname] for fieldname in fieldnames])
+        except RuntimeError as e:
+            if existing is not None:
+                raise
+            # Other backends may not support IF NOT EXISTS; the index is there
+            print(f"Index {name} not created: {e}")
+
+    for name in existing or {}:
+        print(f"Dropping obsolete index {name}")
+        db.executesql(f'DROP INDEX IF EXISTS "{name}";')
+    db.commit()
+
+def user_checklist_identifier(my_checklist_id):
+    """SAMPLING_EVENT_IDENTIFIER of the checklist row mirroring a user checklist"""
+    return f"U{my_checklist_id}"
+
+def user_observer_id(user_email):
+    """
+    OBSERVER_ID of the checklist rows mirroring a user's checklists
+
+    Mirrors are public (leaderboards, approximate-mode sketches), so users
+    appear under an opaque id derived from their account, never their email.
+
+    Returns:
+        str: 'U' followed by the auth_user id, or None without an account
+    """
+    user = db(db.auth_user.email == user_email).select(db.auth_user.id, limitby=(0, 1)).first()
+    return f"U{user.id}" if user else None
+
+def mirror_user_checklist(my_checklist_id):
+    """
+    Create or update the checklist row mirroring a my_checklist record
+
+    User checklists are mirrored into the checklist table so that their
+    sightings reference checklists the same way seeded sightings do.
+
+    Args:
+        my_checklist_id (int): ID of the user checklist
+
+    Returns:
+        int: ID of the mirroring checklist row
+    """
+    record = db.my_checklist(my_checklist_id)
+    values = dict(
+        SAMPLING_EVENT_IDENTIFIER=user_checklist_identifier(record.id),
+        LATITUDE=record.LATITUDE,
+        LONGITUDE=record.LONGITUDE,
+        OBSERVATION_DATE=record.OBSERVATION_DATE,
+        TIME_OBSERVATIONS_STARTED=record.TIME_OBSERVATIONS_STARTED,
+        OBSERVER_ID=user_observer_id(record.user_email),
+        DURATION_MINUTES=record.DURATION_MINUTES or 0
+    )
+    if record.checklist_id and db(db.checklist.id == record.checklist_id).update(**values):
+        return record.checklist_id
+    checklist_id = db.checklist.insert(**values)
+    record.update_record(
+        checklist_id=checklist_id,
+        SAMPLING_EVENT_IDENTIFIER=values['SAMPLING_EVENT_IDENTIFIER']
+    )
+    return checklist_id
+
+def get_species_id(common_name):
+    """Returns the id of a species by common name, adding the species if it is new"""
+    row = db(db.species.COMMON_NAME == common_name).select(db.species.id).first()
+    if row:
+        return row.id
+    species_id = db.species.insert(COMMON_NAME=common_name)
+    species_search.index.invalidate()
+    responses.bump('species')
+    return species_id
+
+def link_sightings():
+    """
+    Fill in sightings.checklist_id and sightings.species_id where still missing
+
+    User checklists without a mirror (submitted before mirroring existed) are
+    mirrored first, and their sightings, which store the my_checklist id as
+    SAMPLING_EVENT_IDENTIFIER, are pointed at the mirror. All other unlinked
+    sightings are then resolved against checklist.SAMPLING_EVENT_IDENTIFIER
+    in a single statement.
+
+    Species names not yet in the species table are added, and species_id is
+    then resolved from COMMON_NAME the same way.
+
+    Mirrors made when they carried the user's email as OBSERVER_ID are also
+    given the opaque id (see user_observer_id).
+
+    Returns:
+        int: Number of references filled in and mirrors updated
+    """
+    linked_count = 0
+    mirrors = db(
+        (db.checklist.id == db.my_checklist.checklist_id) &
+        (db.checklist.OBSERVER_ID == db.my_checklist.user_email)
+    ).select(db.my_checklist.user_email, distinct=True)
+    for row in mirrors:
+        linked_count += db(db.checklist.id.belongs(
+            db(db.my_checklist.user_email == row.user_email)._select(db.my_checklist.checklist_id)
+        )).update(OBSERVER_ID=user_observer_id(row.user_email))
+
+    for record in db(db.my_checklist.checklist_id == None).select(db.my_checklist.id):
+        checklist_id = mirror_user_checklist(record.id)
+        linked_count += db(
+            (db.sightings.SAMPLING_EVENT_IDENTIFIER == str(record.id)) &
+            (db.sightings.seed_source == None)
+        ).update(
+            SAMPLING_EVENT_IDENTIFIER=user_checklist_identifier(record.id),
+            checklist_id=checklist_id
+        )
+
+    linked_count += link_sighting_references()
+    db.commit()
+    return linked_count
+
+def link_sighting_references(events=None):
+    """
+    Fill in sightings.checklist_id and sightings.species_id from the event ids and names
+
+    Species names not yet in the species table are added. Runs in the
+    caller's transaction; the caller commits.
+
+    Args:
+        events (list, optional): Only link the sightings of these
+            SAMPLING_EVENT_IDENTIFIER values (default: every sighting)
+
+    Returns:
+        int: Number of references filled in
+    """
+    linked_count = 0
+    sightings, checklist, species = db.sightings, db.checklist, db.species
+    scope = ""
+    if events is not None:
+        if not events:
+            return 0
+        scope = f"AND {sightings.SAMPLING_EVENT_IDENTIFIER.belongs(list(events))} "
+    event = f"{sightings._rname}.{sightings.SAMPLING_EVENT_IDENTIFIER._rname}"
+    db.executesql(
+        f"UPDATE {sightings._rname} SET {sightings.checklist_id._rname} = ("
+        f"SELECT {checklist.id._rname} FROM {checklist._rname} "
+        f"WHERE {checklist.SAMPLING_EVENT_IDENTIFIER._rname} = {event}) "
+        f"WHERE {sightings.checklist_id._rname} IS NULL {scope}AND {event} IN ("
+        f"SELECT {checklist.SAMPLING_EVENT_IDENTIFIER._rname} FROM {checklist._rname});"
+    )
+    linked_count += max(db._adapter.cursor.rowcount, 0)
+
+    name = f"{sightings._rname}.{sightings.COMMON_NAME._rname}"
+    unlinked = f"{sightings.species_id._rname} IS NULL {scope}"
+    known_names = f"SELECT {species.COMMON_NAME._rname} FROM {species._rname}"
+    db.executesql(
+        f"INSERT INTO {species._rname} ({species.COMMON_NAME._rname}) "
+        f"SELECT DISTINCT {name} FROM {sightings._rname} "
+        f"WHERE {unlinked}AND {name} NOT IN ({known_names});"
+    )
+    if db._adapter.cursor.rowcount > 0:
+        species_search.index.invalidate()
+        responses.bump('species')
+    db.executesql(
+        f"UPDATE {sightings._rname} SET {sightings.species_id._rname} = ("
+        f"SELECT {species.id._rname} FROM {species._rname} "
+        f"WHERE {species.COMMON_NAME._rname} = {name}) "
+        f"WHERE {unlinked}AND {name} IN ({known_names});"
+    )
+    linked_count += max(db._adapter.cursor.rowcount, 0)
+    return linked_count
+
+def seed_database(base_path=None, force=False):
+    """
+    Sync the species, checklist and sightings tables from the upload CSVs
+
+    Files whose fingerprint matches the last sync are skipped; changed files
+    are applied as a diff (see DataSeeder.sync_table). Sightings are then
+    linked to their checklists (see link_sightings), the heatmap tile cache
+    is cleared and the summary tables are rebuilt if any data changed, and
+    the hotspot index is rebuilt.
+
+    Args:
+        base_path (str, optional): Folder holding the CSV files
+        force (bool): Diff every file even if its fingerprint is unchanged
+    """
     if base_path is None:
         base_path = os.path.join(os.getcwd(), "apps/birds/uploads")
 
@@ -150,53 +832,101 @@ def seed_database(base_path=None):
         {
             'table': db.species,
             'file': os.path.join(base_path, 'species.csv'),
-            'mapper': lambda row: {
-                'SAMPLING_EVENT_IDENTIFIER': row.get('SAMPLING EVENT IDENTIFIER', '').strip(),
-                'COMMON_NAME': row.get('COMMON NAME', '').strip(),
-                'OBSERVATION_COUNT': 1 if row.get('OBSERVATION COUNT', 'X') == 'X' else int(row.get('OBSERVATION COUNT', 1)),
-                'observer_email': row.get('OBSERVER EMAIL', '').strip() or get_user_email(),
-                'observation_time': get_time()
-            }
+            'key': ['COMMON_NAME'],
+            'fields': ['COMMON_NAME'],
+            'adopt': db.species.id > 0,
+            'mapper': ingest.map_species_row,
+            'validator': ingest.validate_species_rows
         },
         {
             'table': db.checklist,
             'file': os.path.join(base_path, 'checklists.csv'),
-            'mapper': lambda row: {
-                'SAMPLING_EVENT_IDENTIFIER': row.get('SAMPLING EVENT IDENTIFIER', str(get_time())).strip(),
-                'LATITUDE': float(row.get('LATITUDE', 0)),
-                'LONGITUDE': float(row.get('LONGITUDE', 0)),
-                'OBSERVATION_DATE': row.get('OBSERVATION DATE', datetime.date.today()),
-                'TIME_OBSERVATIONS_STARTED': row.get('TIME OBSERVATIONS STARTED', datetime.time()),
-                'OBSERVER_ID': row.get('OBSERVER ID', '').strip(),
-                'DURATION_MINUTES': float(row.get('DURATION MINUTES', 0)) if row.get('DURATION MINUTES', '').strip() else 0.0
-            }
+            'key': ['SAMPLING_EVENT_IDENTIFIER'],
+            'fields': ['SAMPLING_EVENT_IDENTIFIER', 'LATITUDE', 'LONGITUDE', 'OBSERVATION_DATE',
+                       'TIME_OBSERVATIONS_STARTED', 'OBSERVER_ID', 'DURATION_MINUTES'],
+            # Everything except the mirrors of user checklists
+            'adopt': ~db.checklist.id.belongs(
+                db(db.my_checklist.checklist_id != None)._select(db.my_checklist.checklist_id)
+            ),
+            'mapper': ingest.map_checklist_row,
+            'validator': ingest.validate_checklist_rows
         },
         {
             'table': db.sightings,
             'file': os.path.join(base_path, 'sightings.csv'),
-            'mapper': lambda row: {
-                'SAMPLING_EVENT_IDENTIFIER': row.get('SAMPLING EVENT IDENTIFIER', '').strip(),
-                'COMMON_NAME': row.get('COMMON NAME', '').strip(),
-                'OBSERVATION_COUNT': 1 if row.get('OBSERVATION COUNT', 'X') == 'X' else int(row.get('OBSERVATION COUNT', 1)),
-                'observer_email': row.get('OBSERVER EMAIL', '').strip() or get_user_email(),
-                'observation_time': get_time()
-            }
+            'key': ['SAMPLING_EVENT_IDENTIFIER', 'COMMON_NAME'],
+            'fields': ['SAMPLING_EVENT_IDENTIFIER', 'COMMON_NAME', 'OBSERVATION_COUNT'],
+            # Sightings seeded before fingerprinting are those of seeded checklists
+            'adopt': db.sightings.SAMPLING_EVENT_IDENTIFIER.belongs(
+                db(db.checklist.seed_source != None)._select(db.checklist.SAMPLING_EVENT_IDENTIFIER)
+            ),
+            'mapper': ingest.map_sighting_row,
+            'validator': ingest.validate_sighting_rows
         }
     ]
 
     # Seed tables with error handling and logging
+    changed = False
     for config in seeding_config:
         try:
             print(f"Seeding {config['table']._tablename}...")
-            DataSeeder.seed_table(
+            changed |= DataSeeder.sync_table(
                 config['table'], 
                 config['file'], 
                 config['mapper'],
-                verbose=True
+                config['key'],
+                config['fields'],
+                adopt=config['adopt'],
+                force=force,
+                verbose=True,
+                validator=config['validator']
             )
         except Exception as e:
             print(f"Error seeding {config['table']._tablename}: {e}")
 
+    try:
+        linked_count = link_sightings()
+        if linked_count:
+            print(f"Linked {linked_count} sighting references to checklists and species.")
+            changed = True
+    except Exception as e:
+        print(f"Error linking sightings: {e}")
+        db.rollback()
+
+    # Rendered heatmap tiles, cached responses, the analytics columns, the
+    # region grids, the species search index, the summary tables and the
+    # region sketches may show the old data
+    if changed:
+        tiles.tile_cache.clear()
+        analytics.engine.invalidate()
+        regions.grid.invalidate()
+        species_search.index.invalidate()
+    if changed or aggregates.needs_rebuild():
+        try:
+            print("Rebuilding summary tables...")
+            aggregates.rebuild()
+        except Exception as e:
+            print(f"Error rebuilding summary tables: {e}")
+            db.rollback()
+    if changed or sketches.needs_rebuild():
+        try:
+            print("Rebuilding region sketches...")
+            sketches.rebuild()
+        except Exception as e:
+            print(f"Error rebuilding region sketches: {e}")
+            db.rollback()
+    if changed:
+        # Only once the summary tables and sketches are rebuilt, so that no
+        # response is cached under the new versions from the old ones
+        responses.bump()
+        db.commit()
+
+    # (Re)build the in-memory hotspot index from the seeded checklists
+    try:
+        spatial.checklist_index.load()
+    except Exception as e:
+        print(f"Error building the hotspot index: {e}")
+
     print("Database seeding completed.")
 
 # Initialize database tables and seed
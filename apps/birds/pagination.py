@@ -0,0 +1,135 @@
+"""
+This file defines keyset pagination for the listing actions
+
+Pages are read in (sort field, id) order. Instead of an OFFSET, which makes
+the database walk every earlier row, each page ends with an opaque cursor
+holding the sort value and id of its last row; the next page starts right
+after that key, so every page is one index range read of limit + 1 rows
+however deep it is.
+
+Cursors are URL-safe base64 of [sort, value, id]: clients pass them back
+as-is in the after parameter, and one made for another sort is rejected.
+"""
+import json
+import base64
+import operator
+import functools
+
+# Sortable fields of each listed table; ids break ties, and are always sortable
+SORT_FIELDS = {
+    'checklist': ['OBSERVATION_DATE'],
+    'my_checklist': ['OBSERVATION_DATE'],
+    'species': ['COMMON_NAME'],
+}
+
+
+def encode_cursor(sort, value, row_id):
+    """The opaque cursor of a row (see module docstring)"""
+    data = json.dumps([sort, value, row_id], default=str).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, sort):
+    """
+    The (sort value, id) a cursor points after
+
+    Raises:
+        ValueError: If the cursor is malformed or was made for another sort
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        cursor_sort, value, row_id = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        row_id = int(row_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if cursor_sort != sort:
+        raise ValueError("The cursor was made for another sort order")
+    return value, row_id
+
+
+def _segments(field, id_field, value, row_id, descending, nulls_low):
+    """
+    Queries matching the rows after a key, in (field, id) order
+
+    Rows without a sort value sort lowest where the database sorts NULL first
+    (SQLite, MySQL) and highest elsewhere, so the rows after a key are split
+    into the rest of its segment (with or without a value) and possibly the
+    whole other segment. Each is a range on the sort field, read in turn,
+    so the index on it is used rather than walking every earlier row.
+
+    Returns:
+        list: Queries, in order
+    """
+    next_id = id_field < row_id if descending else id_field > row_id
+    if field is id_field:
+        return [next_id]
+    # Whether rows without a sort value come after every other row in this order
+    nulls_after = descending == nulls_low
+    if value is None:
+        return [(field == None) & next_id] + ([] if nulls_after else [field != None])
+    if descending:
+        segment = (field <= value) & ((field < value) | next_id)
+    else:
+        segment = (field >= value) & ((field > value) | next_id)
+    return [segment] + ([field == None] if nulls_after else [])
+
+
+def paginate(db, table, query=None, limit=100, after=None, sort='id', fields=None):
+    """
+    One page of a table, in keyset order
+
+    Args:
+        db: The database
+        table: Table to list
+        query (optional): Only list the rows matching it
+        limit (int): Rows per page
+        after (str, optional): Cursor returned with the previous page
+        sort (str): 'id' or one of SORT_FIELDS[table], prefixed with '-' for
+            descending order
+        fields (list, optional): Names of the readable fields to return (the
+            id and sort field are always included); default: every field
+
+    Returns:
+        tuple: (list of row dicts, cursor of the next page or None)
+
+    Raises:
+        ValueError: On an unknown sort or field, or an invalid cursor
+    """
+    descending = sort.startswith('-')
+    sort_name = sort.lstrip('-')
+    if sort_name != 'id' and sort_name not in SORT_FIELDS.get(table._tablename, []):
+        raise ValueError(f"sort must be id or one of {SORT_FIELDS.get(table._tablename, [])}, optionally prefixed with -")
+    sort_field = table[sort_name]
+
+    if fields:
+        unknown = [name for name in fields if name not in table.fields or not table[name].readable]
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+        selected = [table.id] + [table[name] for name in dict.fromkeys([sort_name, *fields]) if name != 'id']
+    else:
+        selected = [table[name] for name in table.fields]
+
+    orderby = [~sort_field, ~table.id] if descending else [sort_field, table.id]
+    if sort_field is table.id:
+        orderby = orderby[:1]
+
+    # The first page is the start of the whole order: the id range, or the
+    # sort field's index read from its start (no condition, so it is used)
+    segments = [table.id > 0 if sort_field is table.id else None]
+    if after:
+        value, row_id = decode_cursor(after, sort)
+        nulls_low = db._dbname in ('sqlite', 'mysql')
+        segments = _segments(sort_field, table.id, value, row_id, descending, nulls_low)
+    rows = []
+    for segment in segments:
+        conditions = [condition for condition in (query, segment) if condition is not None]
+        selection = db(functools.reduce(operator.and_, conditions)) if conditions else db(table)
+        rows += selection.select(*selected, orderby=orderby, limitby=(0, limit + 1 - len(rows))).as_list()
+        if len(rows) > limit:
+            break
+
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(sort, last[sort_name], last['id'])
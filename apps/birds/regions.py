@@ -0,0 +1,551 @@
+"""
+This file defines the summed-area grids behind region statistics
+
+Observation counts are binned into square cells of settings.REGION_GRID_DEGREES
+over the extent of the checklists: one layer for all species, one for each of
+the settings.REGION_GRID_SPECIES most common species, and a last one holding
+per cell the largest count of any other single species, which bounds how far
+those species can rank. Each layer is
+stored as prefix sums, layer[i, j] holding the total of the cells south and
+west of cell (i, j), so the total over any block of whole cells is four
+lookups per layer, however many sightings it holds. Only the strips of
+partial cells along the edges of a box are summed from the sightings.
+
+The layers are one read-only memory-mapped .npy file in
+settings.REGION_GRID_FOLDER, named by grid.json, which also records the
+grid's origin, shape, species and the 'checklist' data version it holds (see
+response_cache.py). Grid files are never modified once written: checklist
+writes, once committed, copy the current file with their change patched in
+and point grid.json at the copy, moving it to the version they bumped. So
+other processes never see uncommitted or rolled back counts, and one still
+reading the old file keeps a consistent grid. grid.json is only replaced
+under an exclusive lock on grid.lock (where fcntl exists), so a patch or a
+rebuild never overwrites a newer grid.
+
+A grid that is behind the committed version is not used: region statistics
+fall back on the analytics engine or SQL. A missing grid (seeding and
+uploads remove grid.json), or one left behind for more than
+settings.REGION_GRID_MAX_LAG seconds, is rebuilt in a background thread.
+Only one process builds at a time, the one holding the grid.building marker.
+
+Without NumPy, grid.available() is False and region statistics are computed
+by the analytics engine or SQL.
+"""
+import os
+import json
+import math
+import time
+import uuid
+import threading
+import contextlib
+from .common import db, logger, settings
+from . import spatial, analytics
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+META_FILE = 'grid.json'
+LOCK_FILE = 'grid.lock'
+BUILDING_FILE = 'grid.building'
+LOAD_CHUNK_ROWS = 50000
+
+# Past this share of a box's count lying in its partial cells, summing the
+# edges costs about as much as summing the whole box
+MAX_EDGE_SHARE = 0.5
+
+# Attempts at reading the sightings with no write committed meanwhile
+BUILD_ATTEMPTS = 3
+
+
+class RegionGrid:
+    """
+    Prefix-sum grids of observation counts, stored under a folder
+
+    Cell edges are multiples of the cell size, which should be a power of
+    two (0.25, 0.5, 1...) so that latitude / degrees, and so the cell of a
+    point, is exact.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._lock = threading.Lock()
+        # Held while this process replaces grid.json (with the folder's lock)
+        self._write_lock = threading.Lock()
+        # Held while this process builds a grid
+        self._build_lock = threading.Lock()
+        self._meta = None
+        self._layers = None
+        self._stamp = None
+        # (grid version, time) when this process first found the grid behind
+        self._behind = None
+
+    def available(self):
+        """Whether the grids can be used (NumPy installed and enabled)"""
+        return np is not None and settings.REGION_GRID
+
+    def _path(self, name):
+        return os.path.join(self.folder, name)
+
+    def _meta_path(self):
+        return self._path(META_FILE)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Hold the grid folder's lock, shared by the processes using it"""
+        os.makedirs(self.folder, exist_ok=True)
+        with self._write_lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self._path(LOCK_FILE), 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                yield
+
+    def _read_meta(self):
+        """The current grid.json, or None without a grid"""
+        try:
+            with open(self._meta_path(), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _open(self):
+        """
+        Map the current grid file, if it holds the committed data
+
+        A missing grid, or one behind for more than settings.REGION_GRID_MAX_LAG
+        seconds, is rebuilt in a background thread.
+
+        Returns:
+            tuple: (meta dict, layers array), or (None, None) without a
+                current grid
+        """
+        try:
+            meta, layers = self._map(self._meta_path())
+        except FileNotFoundError:
+            # Unless grid.json was just pointed at a new file
+            if not os.path.exists(self._meta_path()):
+                self.rebuild_in_background()
+            return None, None
+        version = analytics.data_version()
+        if meta.get('version', -1) >= version:
+            self._behind = None
+            return meta, layers
+        # Writes patch the grid just after committing: only a grid that
+        # stays behind needs rebuilding
+        behind = self._behind
+        if behind is None or behind[0] != meta.get('version'):
+            self._behind = (meta.get('version'), time.monotonic())
+        elif time.monotonic() - behind[1] > settings.REGION_GRID_MAX_LAG:
+            self.rebuild_in_background()
+        return None, None
+
+    def _map(self, path):
+        """Map the grid file named by a grid.json, unless already mapped"""
+        stat = os.stat(path)
+        stamp = (stat.st_ino, stat.st_mtime_ns)
+        with self._lock:
+            if stamp == self._stamp:
+                return self._meta, self._layers
+        with open(path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        layers = np.load(self._path(meta['file']), mmap_mode='r')
+        with self._lock:
+            self._meta, self._layers, self._stamp = meta, layers, stamp
+        return meta, layers
+
+    def _read_points(self):
+        """
+        The sightings as (species id, latitude, longitude, count) rows, and
+        the data version they hold
+
+        Returns:
+            tuple: (points array, version), or (None, None) if writes kept
+                committing while they were read
+        """
+        sightings, checklist = db.sightings, db.checklist
+        for _ in range(BUILD_ATTEMPTS):
+            version = analytics.data_version()
+            db._adapter.execute(db(
+                (sightings.checklist_id == checklist.id) &
+                (sightings.species_id != None) &
+                (checklist.LATITUDE != None) &
+                (checklist.LONGITUDE != None)
+            )._select(
+                sightings.species_id,
+                checklist.LATITUDE,
+                checklist.LONGITUDE,
+                sightings.OBSERVATION_COUNT.coalesce_zero()
+            ))
+            cursor = db._adapter.cursor
+            chunks = []
+            while True:
+                batch = cursor.fetchmany(LOAD_CHUNK_ROWS)
+                if not batch:
+                    break
+                chunks.append(np.array(batch, dtype='float64').reshape(-1, 4))
+            # Patches are added to the grid of the version before theirs, so
+            # the grid must hold exactly its version: no write committed
+            # between reading the version and the rows
+            if analytics.data_version() == version:
+                return (np.concatenate(chunks) if chunks else np.zeros((0, 4))), version
+        return None, None
+
+    def rebuild(self):
+        """
+        Recompute every layer from the sightings and write a new grid file
+
+        Returns:
+            bool: Whether a grid was built; False while another process
+                builds one, or if writes kept committing during the read
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        marker = self._path(BUILDING_FILE)
+        try:
+            os.close(os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(marker) < settings.REGION_GRID_BUILD_TIMEOUT:
+                    return False
+            except FileNotFoundError:
+                pass
+            # Left by a build that died: take it over
+            os.utime(marker)
+        try:
+            return self._build()
+        finally:
+            try:
+                os.remove(marker)
+            except FileNotFoundError:
+                pass
+
+    def _build(self):
+        """Build and install a grid; the caller holds the building marker"""
+        degrees = settings.REGION_GRID_DEGREES
+        species_totals = db.species_totals
+        species = [row.species_id for row in db(species_totals).select(
+            species_totals.species_id,
+            orderby=~species_totals.total_count | species_totals.species_id,
+            limitby=(0, settings.REGION_GRID_SPECIES)
+        )]
+        points, version = self._read_points()
+        if points is None:
+            return False
+
+        cell_rows = np.floor(points[:, 1] / degrees).astype('int64')
+        cell_cols = np.floor(points[:, 2] / degrees).astype('int64')
+        row0 = int(cell_rows.min()) if len(points) else 0
+        col0 = int(cell_cols.min()) if len(points) else 0
+        rows = int(cell_rows.max()) - row0 + 1 if len(points) else 1
+        cols = int(cell_cols.max()) - col0 + 1 if len(points) else 1
+
+        # Layer 0 holds all species, layer k the k-th most common one and the
+        # last layer the largest per-cell count of any other species
+        cells = rows * cols
+        flat = (cell_rows - row0) * cols + (cell_cols - col0)
+        species_ids = points[:, 0].astype('int64')
+        layer_of = np.zeros(max(max(species, default=0), int(species_ids.max(initial=0))) + 1, dtype='int64')
+        for layer, species_id in enumerate(species, 1):
+            layer_of[species_id] = layer
+        layer = layer_of[species_ids]
+        layered = layer > 0
+        counts = np.bincount(
+            layer[layered] * cells + flat[layered],
+            weights=points[layered, 3],
+            minlength=(len(species) + 2) * cells
+        )
+        counts[:cells] = np.bincount(flat, weights=points[:, 3], minlength=cells)
+        keys, positions = np.unique(species_ids[~layered] * cells + flat[~layered], return_inverse=True)
+        other_counts = np.bincount(positions, weights=points[~layered, 3], minlength=len(keys))
+        np.maximum.at(counts[-cells:], keys % cells, other_counts)
+        counts = counts.reshape(len(species) + 2, rows, cols).astype('int64')
+
+        layers = np.zeros((len(species) + 2, rows + 1, cols + 1), dtype='int64')
+        layers[:, 1:, 1:] = counts.cumsum(axis=1).cumsum(axis=2)
+        meta = dict(degrees=degrees, row0=row0, col0=col0, rows=rows, cols=cols, species=species, version=version)
+        with self._locked():
+            current = self._read_meta()
+            if current is not None and current.get('version', -1) >= version:
+                # Patched past this build meanwhile
+                return True
+            self._install(meta, layers)
+        return True
+
+    def _install(self, meta, layers):
+        """Write a grid file and point grid.json at it; the caller holds the folder lock"""
+        name = f"grid-{uuid.uuid4().hex}.npy"
+        np.save(self._path(name), layers)
+        self._write_meta(dict(meta, file=name))
+        # Processes still mapping the old files keep reading them until they
+        # notice grid.json changed
+        for other in os.listdir(self.folder):
+            if other.startswith('grid-') and other != name:
+                try:
+                    os.remove(self._path(other))
+                except OSError:
+                    pass
+
+    def _rebuild_in_background(self):
+        try:
+            # This runs in its own thread: connect to the db
+            db._adapter.reconnect()
+            self.rebuild()
+        except Exception as e:
+            logger.error(f"Error rebuilding the region grid: {str(e)}")
+        finally:
+            db.rollback()
+            # Release this thread's connection (DAL.close only works in the
+            # thread that created the DAL)
+            db._adapter.close()
+            self._build_lock.release()
+
+    def rebuild_in_background(self):
+        """Rebuild the grid in a background thread, unless this process is already building one"""
+        if self.available() and self._build_lock.acquire(blocking=False):
+            try:
+                threading.Thread(target=self._rebuild_in_background, daemon=True).start()
+            except Exception:
+                self._build_lock.release()
+                raise
+
+    def _write_meta(self, meta):
+        """Atomically replace grid.json"""
+        temp_path = f"{self._meta_path()}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(temp_path, self._meta_path())
+
+    def invalidate(self):
+        """Rebuild on next use (after bulk changes such as seeding or uploads)"""
+        try:
+            os.remove(self._meta_path())
+        except FileNotFoundError:
+            pass
+
+    def contributions(self, checklist_ids):
+        """
+        Summed counts of checklists' sightings, per species and position
+
+        Read before checklists change (and after), to be applied once the
+        change is committed.
+
+        Args:
+            checklist_ids (list): IDs of the checklist rows
+
+        Returns:
+            list: (species id, latitude, longitude, count) tuples
+        """
+        checklist_ids = [checklist_id for checklist_id in checklist_ids if checklist_id]
+        if not checklist_ids or not self.available() or not os.path.exists(self._meta_path()):
+            return []
+        sightings, checklist = db.sightings, db.checklist
+        return db.executesql(db(
+            sightings.checklist_id.belongs(checklist_ids) &
+            (sightings.checklist_id == checklist.id) &
+            (sightings.species_id != None)
+        )._select(
+            sightings.species_id,
+            checklist.LATITUDE,
+            checklist.LONGITUDE,
+            sightings.OBSERVATION_COUNT.coalesce_zero().sum(),
+            groupby=[sightings.species_id, checklist.id, checklist.LATITUDE, checklist.LONGITUDE]
+        ))
+
+    def apply(self, removed, added, version):
+        """
+        Patch a committed change into a new grid file
+
+        Called after the writing transaction committed. The grid is patched
+        only if it holds the version just before the change's; otherwise it
+        is left behind, to be rebuilt. A point outside the grid's extent
+        removes the grid instead, to be rebuilt over a larger one. The bound
+        layer only ever grows, so it stays an upper bound until the next
+        rebuild.
+
+        Args:
+            removed (list): Contributions (see contributions) the change
+                removed, read before it
+            added (list): Contributions it added, read after it
+            version (int): The 'checklist' version the change was bumped to
+        """
+        if not self.available():
+            return
+        try:
+            with self._locked():
+                meta = self._read_meta()
+                if meta is None or meta.get('version') != version - 1:
+                    return
+                layers = np.load(self._path(meta['file']))
+                degrees = meta['degrees']
+                layer_of = {species_id: layer for layer, species_id in enumerate(meta['species'], 1)}
+                changes = [(contribution, -1) for contribution in removed]
+                changes += [(contribution, 1) for contribution in added]
+                for (species_id, lat, lon, count), sign in changes:
+                    if lat is None or lon is None or not count:
+                        continue
+                    row = math.floor(lat / degrees) - meta['row0']
+                    col = math.floor(lon / degrees) - meta['col0']
+                    if not (0 <= row < meta['rows'] and 0 <= col < meta['cols']):
+                        self.invalidate()
+                        return
+                    species_layer = layer_of.get(species_id)
+                    if species_layer is None and sign > 0:
+                        species_layer = len(layers) - 1
+                    for layer in (0, species_layer):
+                        if layer is not None:
+                            layers[layer, row + 1:, col + 1:] += sign * count
+                self._install(dict(meta, version=version), layers)
+        except Exception as e:
+            # The grid stays behind and is rebuilt
+            logger.error(f"Error patching the region grid: {str(e)}")
+
+    @staticmethod
+    def _edge_totals(bounds, inner):
+        """
+        Summed counts per species of the sightings in a box but outside an inner box
+
+        The outside is read as four strips (south, north, west, east of the
+        inner box), each through the spatial index; the exact half-open
+        predicates on the inner box's edges keep the strips disjoint.
+
+        Args:
+            bounds (tuple): (south, north, west, east)
+            inner (tuple): (south, north, west, east) of the whole cells, or None
+
+        Returns:
+            dict: {species id: total count}
+        """
+        sightings, checklist = db.sightings, db.checklist
+        latitude, longitude = checklist.LATITUDE, checklist.LONGITUDE
+        south, north, west, east = bounds
+        if inner is None:
+            strips = [(bounds, None)]
+        else:
+            inner_south, inner_north, inner_west, inner_east = inner
+            middle = (latitude >= inner_south) & (latitude < inner_north)
+            strips = [
+                ((south, inner_south, west, east), latitude < inner_south),
+                ((inner_north, north, west, east), latitude >= inner_north),
+                ((inner_south, inner_north, west, inner_west), middle & (longitude < inner_west)),
+                ((inner_south, inner_north, inner_east, east), middle & (longitude >= inner_east)),
+            ]
+        total_count = sightings.OBSERVATION_COUNT.coalesce_zero().sum()
+        totals = {}
+        for strip, outside in strips:
+            query = (
+                (sightings.species_id != None) &
+                (sightings.checklist_id == checklist.id) &
+                spatial.bounds_query(*strip)
+            )
+            if outside is not None:
+                query &= outside
+            for row in db(query).select(sightings.species_id, total_count, groupby=sightings.species_id):
+                species_id = row.sightings.species_id
+                totals[species_id] = totals.get(species_id, 0) + row[total_count]
+        return totals
+
+    def top_species(self, bounds, limit):
+        """
+        Species with the highest summed observation count inside a bounding box
+
+        Whole cells are read from the grids, and the partial cells along the
+        edges from the sightings. Species without a layer of their own cannot
+        be ranked from the grids: when one of them might still reach the
+        ranking (its edge count plus the bound layer over the whole cells,
+        capped by its overall total), None is returned. So it is when most
+        of the box's count lies in partial cells, where summing the whole
+        box directly costs no more.
+
+        Args:
+            bounds (tuple): (south, north, west, east)
+            limit (int): Number of species
+
+        Returns:
+            list: (species id, total) tuples, largest total first, or None
+                when the grids cannot rank the region exactly, or hold no
+                current grid
+        """
+        meta, layers = self._open()
+        if meta is None:
+            return None
+        south, north, west, east = bounds
+        degrees = meta['degrees']
+
+        def clamp(value, size):
+            return min(max(value, 0), size)
+
+        def block(row_lo, row_hi, col_lo, col_hi):
+            """Per-layer totals of a block of whole cells, or None if it is empty"""
+            if row_lo >= row_hi or col_lo >= col_hi:
+                return None
+            return (
+                layers[:, row_hi, col_hi] - layers[:, row_lo, col_hi] -
+                layers[:, row_hi, col_lo] + layers[:, row_lo, col_lo]
+            ).tolist()
+
+        # The cells inside the box, and those overlapping it
+        row_lo = clamp(math.ceil(south / degrees) - meta['row0'], meta['rows'])
+        row_hi = clamp(math.floor(north / degrees) - meta['row0'], meta['rows'])
+        col_lo = clamp(math.ceil(west / degrees) - meta['col0'], meta['cols'])
+        col_hi = clamp(math.floor(east / degrees) - meta['col0'], meta['cols'])
+        inside = block(row_lo, row_hi, col_lo, col_hi)
+        overlapping = block(
+            clamp(math.floor(south / degrees) - meta['row0'], meta['rows']),
+            clamp(math.floor(north / degrees) - meta['row0'] + 1, meta['rows']),
+            clamp(math.floor(west / degrees) - meta['col0'], meta['cols']),
+            clamp(math.floor(east / degrees) - meta['col0'] + 1, meta['cols'])
+        )
+
+        def ranked(totals):
+            return sorted(totals.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+        if not inside or not inside[0]:
+            # No whole cell holds any count: sum the whole box from the sightings
+            return ranked(self._edge_totals(bounds, None))
+        if overlapping[0] - inside[0] > MAX_EDGE_SHARE * overlapping[0]:
+            return None
+        others = inside[0] - sum(inside[1:-1])
+        if others:
+            # Largest possible total of a species without a layer, before edges
+            species_totals = db.species_totals
+            largest = db(~species_totals.species_id.belongs(meta['species'])).select(
+                species_totals.total_count, orderby=~species_totals.total_count, limitby=(0, 1)
+            ).first()
+            bound = min(others, inside[-1], largest.total_count if largest else 0)
+            # The edges rarely change the outcome when whole cells already tie
+            if bound >= sorted(inside[1:-1] + [0] * limit, reverse=True)[limit - 1]:
+                return None
+
+        edges = self._edge_totals(bounds, (
+            (meta['row0'] + row_lo) * degrees, (meta['row0'] + row_hi) * degrees,
+            (meta['col0'] + col_lo) * degrees, (meta['col0'] + col_hi) * degrees
+        ))
+        totals = {
+            species_id: total + edges.get(species_id, 0)
+            for species_id, total in zip(meta['species'], inside[1:-1])
+        }
+        layered = set(totals)
+        unlayered = {species_id: total for species_id, total in edges.items() if species_id not in layered}
+        if not others:
+            totals.update(unlayered)
+        totals = {species_id: total for species_id, total in totals.items() if total > 0}
+        top = ranked(totals)
+        if len(top) < limit:
+            # Species present with a zero count still rank; the grids do not know them
+            return None
+        if others:
+            bound = min(others, inside[-1]) + max(unlayered.values(), default=0)
+            bound = min(bound, largest.total_count if largest else 0)
+            if bound >= top[-1][1]:
+                return None
+        return top
+
+
+grid = RegionGrid(settings.REGION_GRID_FOLDER)
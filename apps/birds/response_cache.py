@@ -0,0 +1,385 @@
+"""
+This file defines the response cache of the read-only analytic actions
+
+Each decorated action declares the tables its answers depend on:
+
+    @responses.cached('checklist', 'species')
+
+Every table group has a data version in the data_versions table (see
+define_database_tables): 'checklist' covers checklists and their sightings,
+'species' the species list. Writes bump the versions they affect (bump) in
+their own transaction, so every worker process sees them as soon as they
+are committed. The in-memory copies of the data (analytics.engine,
+regions.grid) record the version they hold: writers update the columns
+before committing and log the checklists they changed, which readers in
+other processes finding the columns behind catch up with, and they patch
+the region grid just after committing. Neither is used while behind: the
+actions answer from SQL instead. So no response is computed from data older
+than the version it is stored under.
+
+A response is identified by the action name, the versions of its tables and
+the normalised request parameters (query string, or JSON body for POST,
+plus the requested format, and with parameters relative to today resolved
+by the action's normalize function), hashed into a strong ETag:
+
+- a request whose If-None-Match holds that ETag is answered 304 Not
+  Modified without running the action
+- otherwise the result is taken from the app's LRU cache (common.cache,
+  bounded to its size), or computed and stored there; entries also expire
+  after settings.RESPONSE_CACHE_SECONDS
+
+A bumped version changes every ETag and cache key built from it, so older
+entries become unreachable and age out of the LRU.
+
+Only successful dict results are cached and get an ETag: errors and streamed
+responses (NDJSON) are recomputed on every request.
+
+After startup and after bulk changes, warm() recomputes in the background
+the settings.RESPONSE_CACHE_WARM default requests and the
+settings.RESPONSE_CACHE_WARM_ITEMS most requested entries.
+"""
+import io
+import json
+import contextlib
+import hashlib
+import functools
+import threading
+from collections import Counter
+from urllib.parse import urlencode
+from py4web import request, response
+from .common import db, cache, logger, settings
+from . import formats, analytics
+
+# Table groups with a data version
+DATA_TABLES = ('checklist', 'species')
+
+# Number of distinct requests whose counts are kept for warming
+TRACKED_REQUESTS = 1000
+
+
+def bind_request(method, parameters):
+    """Point the (thread-local) global request at a synthetic GET query or POST JSON body"""
+    if method == 'POST':
+        body, query_string = json.dumps(parameters).encode('utf-8'), ''
+    else:
+        body = b''
+        query_string = urlencode(parameters)
+    request.__init__({
+        'REQUEST_METHOD': method,
+        'PATH_INFO': '/internal',
+        'QUERY_STRING': query_string,
+        'CONTENT_TYPE': 'application/json',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': io.BytesIO(body),
+    })
+
+
+@contextlib.contextmanager
+def snapshot():
+    """
+    Run the enclosed reads in one transaction, so they all see the same
+    committed state (SQLite: one deferred transaction; PostgreSQL: repeatable
+    read). On SQLite, writers wait until the block ends.
+    """
+    if db._dbname in ('sqlite', 'postgres'):
+        # End the implicit transaction, if any, so the snapshot starts here
+        db.commit()
+        db.executesql('BEGIN' if db._dbname == 'sqlite' else 'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+    try:
+        yield
+    finally:
+        db.commit()
+
+
+class Uncacheable(Exception):
+    """Carries an action result that must not be cached out of the cache callback"""
+
+    def __init__(self, result):
+        super().__init__()
+        self.result = result
+
+
+class ResponseCache:
+    """Caches the results of read-only actions until the data they depend on changes"""
+
+    def __init__(self, store):
+        self._store = store
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._not_modified_count = 0
+        # action name -> (undecorated action body, tables, normalize), for warming
+        self._actions = {}
+        # (action name, method, parameters) -> number of requests
+        self._requests = Counter()
+
+    @staticmethod
+    def versions(tables=DATA_TABLES):
+        """
+        The current data versions of some table groups
+
+        Returns:
+            dict: {table group: version}, 0 for groups never bumped
+        """
+        data_versions = db.data_versions
+        rows = db(data_versions.name.belongs(tables)).select(
+            data_versions.name, data_versions.version.max(), groupby=data_versions.name
+        )
+        current = {row.data_versions.name: row[data_versions.version.max()] for row in rows}
+        return {table: current.get(table) or 0 for table in tables}
+
+    @staticmethod
+    def bump(*tables):
+        """
+        Change the data version of some table groups (all when none given)
+
+        Called inside the transaction making the change; the caller commits.
+
+        Returns:
+            dict: {table group: new version}
+        """
+        data_versions = db.data_versions
+        tables = tables or DATA_TABLES
+        for table in tables:
+            if not db(data_versions.name == table).update(version=data_versions.version + 1):
+                data_versions.insert(name=table, version=1)
+        return ResponseCache.versions(tables)
+
+    @staticmethod
+    def request_parameters(normalize=None):
+        """
+        The normalised parameters of the current request
+
+        The response format is included, since it may come from the Accept
+        header rather than the parameters.
+
+        Args:
+            normalize (callable, optional): Maps the parameters dict to the
+                one identifying the result (see cached)
+
+        Returns:
+            tuple: (method, parameters as a canonical JSON string)
+        """
+        method = request.method
+        if method == 'POST':
+            parameters = dict(request.json or {})
+        else:
+            parameters = {key: value.strip() for key, value in request.query.items()}
+        parameters['format'] = formats.requested_format(parameters.get('format'))
+        if normalize is not None:
+            parameters = normalize(parameters)
+        return method, json.dumps(parameters, sort_keys=True, default=str)
+
+    @staticmethod
+    def _matches(etag):
+        """Whether the request's If-None-Match matches an ETag"""
+        header = request.headers.get('If-None-Match')
+        if not header:
+            return False
+        return header.strip() == '*' or etag in (tag.strip() for tag in header.split(','))
+
+    def cached(self, *tables, normalize=None):
+        """
+        Decorator caching an action's successful dict results, with ETags
+
+        Args:
+            tables (str): Table groups (see DATA_TABLES) the results depend on
+            normalize (callable, optional): Maps the request's parameters dict
+                to the one identifying the result, for parameters whose
+                meaning changes over time (such as a window ending today)
+        """
+        def decorator(func):
+            self._actions[func.__name__] = (func, tables, normalize)
+
+            @functools.wraps(func)
+            def wrapper():
+                return self._respond(func, tables, normalize)
+
+            return wrapper
+
+        return decorator
+
+    def _count(self, name, method, parameters):
+        with self._lock:
+            self._requests[(name, method, parameters)] += 1
+            if len(self._requests) > TRACKED_REQUESTS:
+                # Keep the counters bounded: forget the least requested half
+                self._requests = Counter(dict(self._requests.most_common(TRACKED_REQUESTS // 2)))
+
+    @staticmethod
+    def _etag(name, tables, versions, method, parameters):
+        """Strong ETag of an action's response, given the current data versions"""
+        versions = json.dumps({table: versions[table] for table in tables}, sort_keys=True)
+        return '"%s"' % hashlib.sha1(f"{name}:{versions}:{method}:{parameters}".encode('utf-8')).hexdigest()
+
+    def _lookup(self, func, etag, counted=True, prepare=None):
+        """
+        The result of an action for the current request, from the cache or computed
+
+        Args:
+            prepare (callable, optional): Called before computing the result,
+                only when it is not in the cache
+
+        Returns:
+            tuple: (result, whether it was cacheable)
+        """
+        computed = []
+
+        def compute():
+            computed.append(True)
+            if prepare is not None:
+                prepare()
+            result = func()
+            if not isinstance(result, dict) or 'error' in result:
+                raise Uncacheable(result)
+            return result
+
+        try:
+            result = self._store.get(f"response:{etag}", compute, expiration=settings.RESPONSE_CACHE_SECONDS)
+            cacheable = True
+        except Uncacheable as uncached:
+            result, cacheable = uncached.result, False
+        if counted:
+            with self._lock:
+                if computed:
+                    self._misses += 1
+                else:
+                    self._hits += 1
+        return result, cacheable
+
+    def _not_modified(self, etag):
+        """Answer 304 Not Modified if the request's If-None-Match holds an ETag"""
+        if not self._matches(etag):
+            return False
+        with self._lock:
+            self._not_modified_count += 1
+        response.status = 304
+        response.headers['ETag'] = etag
+        return True
+
+    @staticmethod
+    def _set_etag(etag):
+        response.headers['ETag'] = etag
+        # Clients may keep the response but must revalidate it
+        response.headers['Cache-Control'] = 'no-cache'
+
+    def _respond(self, func, tables, normalize=None, counted=True):
+        """The response of an action for the current request"""
+        name = func.__name__
+        method, parameters = self.request_parameters(normalize)
+        etag = self._etag(name, tables, self.versions(tables), method, parameters)
+        if not counted:
+            return self._lookup(func, etag, counted=False)[0]
+
+        self._count(name, method, parameters)
+        if self._not_modified(etag):
+            return ''
+        result, cacheable = self._lookup(func, etag)
+        if cacheable:
+            self._set_etag(etag)
+        return result
+
+    def batch(self, queries):
+        """
+        Answer several cached actions at once, from a single consistent state
+
+        All sub-queries run in one read transaction (see snapshot), share one
+        data version lookup, and are taken from the cache when possible; those
+        computed share one analytics column snapshot, taken on the first miss.
+        The batch gets its own ETag, combined from those of its sub-queries,
+        and is answered 304 Not Modified without running any of them when
+        If-None-Match holds it.
+
+        Args:
+            queries (dict): {key: (action name, method, parameters dict)}
+
+        Returns:
+            dict: {key: result of the action}, or None once answered 304
+        """
+        environ = request.environ
+        try:
+            with snapshot(), contextlib.ExitStack() as pinning:
+                versions = self.versions()
+                planned = {}
+                for key, (name, method, parameters) in queries.items():
+                    func, tables, normalize = self._actions[name]
+                    bind_request(method, parameters)
+                    method, parameters = self.request_parameters(normalize)
+                    self._count(name, method, parameters)
+                    planned[key] = (
+                        func, method, json.loads(parameters),
+                        self._etag(name, tables, versions, method, parameters)
+                    )
+                etag = '"%s"' % hashlib.sha1(json.dumps(
+                    {key: plan[3] for key, plan in planned.items()}, sort_keys=True
+                ).encode('utf-8')).hexdigest()
+
+                request.__init__(environ)
+                if self._not_modified(etag):
+                    return None
+                results, all_cacheable = {}, True
+                # Pinning again inside the block is a no-op
+                pin = lambda: pinning.enter_context(analytics.engine.pinned())
+                for key, (func, method, parameters, sub_etag) in planned.items():
+                    bind_request(method, parameters)
+                    results[key], cacheable = self._lookup(func, sub_etag, prepare=pin)
+                    all_cacheable = all_cacheable and cacheable
+        finally:
+            request.__init__(environ)
+        if all_cacheable:
+            self._set_etag(etag)
+        return results
+
+    def statistics(self):
+        """
+        Hit and miss counters of the cache
+
+        Returns:
+            dict: versions, hits, misses, not_modified (304 answers), hit_ratio
+                (hits and 304s over all requests) and the most requested entries
+        """
+        versions = self.versions()
+        with self._lock:
+            requests = self._hits + self._misses + self._not_modified_count
+            return dict(
+                versions=versions,
+                hits=self._hits,
+                misses=self._misses,
+                not_modified=self._not_modified_count,
+                hit_ratio=(self._hits + self._not_modified_count) / requests if requests else None,
+                popular=[
+                    dict(action=name, method=method, parameters=json.loads(parameters), requests=count)
+                    for (name, method, parameters), count in self._requests.most_common(10)
+                ]
+            )
+
+    def _warm(self):
+        with self._lock:
+            popular = [entry for entry, _ in self._requests.most_common(settings.RESPONSE_CACHE_WARM_ITEMS)]
+        entries = [(name, method, json.dumps(parameters, sort_keys=True))
+                   for name, method, parameters in settings.RESPONSE_CACHE_WARM]
+        entries += [entry for entry in popular if entry not in entries]
+        try:
+            # This runs in its own thread: connect to the db
+            db._adapter.reconnect()
+            for name, method, parameters in entries:
+                if name not in self._actions:
+                    continue
+                bind_request(method, json.loads(parameters))
+                self._respond(*self._actions[name], counted=False)
+            db.rollback()
+        except Exception as e:
+            logger.error(f"Error warming the response cache: {str(e)}")
+            db.rollback()
+        finally:
+            # Release this thread's connection (DAL.close only works in the
+            # thread that created the DAL)
+            db._adapter.close()
+
+    def warm(self):
+        """Recompute the default and most requested entries in a background thread"""
+        if settings.RESPONSE_CACHE_WARM or settings.RESPONSE_CACHE_WARM_ITEMS:
+            threading.Thread(target=self._warm, daemon=True).start()
+
+
+responses = ResponseCache(cache)
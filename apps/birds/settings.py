@@ -19,12 +19,124 @@ DB_POOL_SIZE = 1
 DB_MIGRATE = True
 DB_FAKE_MIGRATE = False  # maybe?
 
+# SEED_BATCH_SIZE: rows per multi-row INSERT and per transaction when
+#                  seeding tables from the CSV files in UPLOAD_FOLDER
+SEED_BATCH_SIZE = 5000
+
 # location where static files are stored:
 STATIC_FOLDER = required_folder(APP_FOLDER, "static")
 
 # location where to store uploaded files:
 UPLOAD_FOLDER = required_folder(APP_FOLDER, "uploads")
 
+# CSV ingestion pipeline (see ingest.py)
+# INGEST_WORKERS:            parser processes (None = one per CPU core)
+# INGEST_PARALLEL_MIN_BYTES: files smaller than this are parsed in-process
+# INGEST_CHUNK_BYTES:        size of the byte ranges handed to each parser
+# INGEST_REJECT_FOLDER:      where rejected rows are written as <file>.<run id>.rejects.csv
+INGEST_WORKERS = None
+INGEST_PARALLEL_MIN_BYTES = 32 * 1024 * 1024
+INGEST_CHUNK_BYTES = 8 * 1024 * 1024
+INGEST_REJECT_FOLDER = os.path.join(UPLOAD_FOLDER, "rejects")
+
+# Map clustering (see spatial.py)
+# MAP_RAW_POINT_LIMIT: viewports with more sightings than this are returned
+#                      as grid cells instead of individual points
+# MAP_CLUSTER_CELL_PX: approximate size of a grid cell on screen, in pixels
+MAP_RAW_POINT_LIMIT = 2000
+MAP_CLUSTER_CELL_PX = 32
+
+# Hotspot lookups (see spatial.PointIndex)
+# HOTSPOT_RADIUS_KM:      default radius of get_hotspot_details
+# HOTSPOT_MAX_RADIUS_KM:  largest radius a client may ask for
+# HOTSPOT_MAX_NEAREST:    largest number of nearest checklists a client may ask for
+# HOTSPOT_INDEX_MAX_AGE:  seconds before the index reloads to pick up other workers' writes
+HOTSPOT_RADIUS_KM = 1.0
+HOTSPOT_MAX_RADIUS_KM = 100.0
+HOTSPOT_MAX_NEAREST = 500
+HOTSPOT_INDEX_MAX_AGE = 300
+
+# LEADERBOARD_MAX_LIMIT: largest number of observers get_top_contributors returns
+LEADERBOARD_MAX_LIMIT = 500
+
+# TIME_SERIES_MAX_PERIODS: largest number of periods get_species_time_series returns
+TIME_SERIES_MAX_PERIODS = 3660
+
+# Per-user statistics cache (see user_stats.py)
+# USER_STATS_CACHE_ITEMS:   users whose statistics are kept in memory, per process
+# USER_STATS_CACHE_SECONDS: age after which cached statistics are recomputed
+USER_STATS_CACHE_ITEMS = 1000
+USER_STATS_CACHE_SECONDS = 300
+
+# Response cache of the read-only analytic actions (see response_cache.py)
+# RESPONSE_CACHE_SECONDS:    age after which a cached response is recomputed
+# RESPONSE_CACHE_WARM:       (action, method, parameters) requests computed after startup and uploads
+# RESPONSE_CACHE_WARM_ITEMS: most requested entries recomputed along with them
+RESPONSE_CACHE_SECONDS = 300
+RESPONSE_CACHE_WARM = [
+    ("get_top_observed_birds", "GET", {}),
+    ("get_bird_observation_times", "GET", {}),
+    ("get_top_contributors", "GET", {}),
+    ("get_region_statistics", "GET", {}),
+]
+RESPONSE_CACHE_WARM_ITEMS = 20
+
+# DASHBOARD_MAX_QUERIES: most queries get_dashboard runs in one batch
+DASHBOARD_MAX_QUERIES = 20
+
+# In-memory analytics engine (see analytics.py)
+# ANALYTICS_ENGINE:  serve the dashboard aggregates from NumPy columns when NumPy is installed
+# ANALYTICS_MAX_AGE: seconds before the columns reload, as a safety net for other workers' writes
+# ANALYTICS_CHANGE_LOG_VERSIONS: data versions of checklist changes kept for other workers to catch up
+ANALYTICS_ENGINE = True
+ANALYTICS_MAX_AGE = 300
+ANALYTICS_CHANGE_LOG_VERSIONS = 1000
+
+# Summed-area grids for region statistics (see regions.py)
+# REGION_GRID:         answer get_region_statistics from the grids when NumPy is installed
+# REGION_GRID_DEGREES: cell size; a power of two (0.25, 0.5, 1...) so cell edges are exact
+# REGION_GRID_SPECIES: most common species given a grid of their own
+# REGION_GRID_FOLDER:  where the grid files are stored
+# REGION_GRID_MAX_LAG: seconds a grid may stay behind the committed data before it is rebuilt
+# REGION_GRID_BUILD_TIMEOUT: seconds after which a build that left its marker is presumed dead
+REGION_GRID = True
+REGION_GRID_DEGREES = 0.25
+REGION_GRID_SPECIES = 64
+REGION_GRID_FOLDER = os.path.join(APP_FOLDER, "cache", "regions")
+REGION_GRID_MAX_LAG = 30
+REGION_GRID_BUILD_TIMEOUT = 600
+
+# SKETCH_CELL_DEGREES: cell size of the approximate-mode sketches (see sketches.py)
+SKETCH_CELL_DEGREES = 1.0
+
+# Species search (see species_search.py)
+# SPECIES_SEARCH_LIMIT:     species returned for a query when no limit is given
+# SPECIES_SEARCH_MAX_LIMIT: largest limit accepted
+# SPECIES_SEARCH_MAX_AGE:   seconds before the index rebuilds to pick up other workers' writes
+SPECIES_SEARCH_LIMIT = 20
+SPECIES_SEARCH_MAX_LIMIT = 200
+SPECIES_SEARCH_MAX_AGE = 300
+
+# Paginated listings: get_species, get_checklists, get_my_checklists (see pagination.py)
+# LIST_PAGE_SIZE:     rows per page when no limit is given
+# LIST_MAX_PAGE_SIZE: largest limit accepted
+LIST_PAGE_SIZE = 500
+LIST_MAX_PAGE_SIZE = 5000
+
+# Heatmap tile cache (see tiles.py)
+# TILE_MAX_ZOOM:           highest z served by the tiles/<z>/<x>/<y> action
+# TILE_CACHE_FOLDER:       where rendered tiles are stored
+# TILE_CACHE_MEMORY_ITEMS: tiles kept in memory, per process
+# TILE_CACHE_DISK_ITEMS:   tile files kept on disk before the oldest are pruned
+TILE_MAX_ZOOM = 18
+TILE_CACHE_FOLDER = os.path.join(APP_FOLDER, "cache", "tiles")
+TILE_CACHE_MEMORY_ITEMS = 2000
+TILE_CACHE_DISK_ITEMS = 50000
+
+# Streamed NDJSON responses (format=ndjson, see formats.py)
+# NDJSON_CHUNK_BYTES: lines are buffered up to about this size before being sent
+NDJSON_CHUNK_BYTES = 64 * 1024
+
 # send email on regstration
 VERIFY_EMAIL = True
 
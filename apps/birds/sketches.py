@@ -0,0 +1,431 @@
+"""
+This file maintains the sketches behind the approximate analytics mode
+
+Exact distinct counts and rankings over a large region touch every sighting
+in it. With approximate=true, get_region_statistics and get_top_contributors
+instead merge small per-cell summaries kept in region_sketches (see
+define_database_tables), one row per cell of settings.SKETCH_CELL_DEGREES and
+observation date, plus one row per cell for all dates (OBSERVATION_DATE
+NULL). Each row holds:
+
+    checklists      number of checklists
+    species_hll     HyperLogLog of the species seen
+    observer_hll    HyperLogLog of the observers
+    species_top     top-k summary of summed observation counts per species
+    observer_top    top-k summary of checklists per observer
+
+Both sketch types merge across cells and dates without losing their error
+guarantees, and each answer carries its error bounds. A region is answered
+from the cells overlapping it, so it is widened to whole cells.
+
+Submitted checklists are added to their rows in the same transaction;
+edits and deletes, which sketches cannot subtract, recompute the rows of
+the cells they touch. Seeding and uploads rebuild the table, which can also
+be run by hand, from the folder containing apps/:
+
+    python -m apps.birds.sketches
+"""
+import json
+import math
+import hashlib
+from functools import lru_cache
+from .common import db, settings
+
+HLL_PRECISION = 10
+HLL_REGISTERS = 1 << HLL_PRECISION
+# Relative standard error of a HyperLogLog estimate
+HLL_ERROR = 1.04 / math.sqrt(HLL_REGISTERS)
+TOP_ITEMS = 64
+
+
+@lru_cache(maxsize=65536)
+def _hash(value):
+    """Stable 64-bit hash of a value"""
+    return int.from_bytes(hashlib.blake2b(str(value).encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class HyperLogLog:
+    """
+    Distinct-count sketch (Flajolet et al.)
+
+    HLL_REGISTERS one-byte registers; merging keeps the largest of each.
+    Stored sparse (index, rank) triples while few registers are set.
+    """
+
+    def __init__(self, registers=None):
+        self.registers = bytearray(registers or HLL_REGISTERS)
+
+    def add(self, value):
+        hashed = _hash(value)
+        rest_bits = 64 - HLL_PRECISION
+        rest = hashed & ((1 << rest_bits) - 1)
+        rank = rest_bits - rest.bit_length() + 1
+        index = hashed >> rest_bits
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, other):
+        """Merge another sketch into this one"""
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def update_bytes(self, data):
+        """Merge a stored sketch (see to_bytes) into this one without decoding it"""
+        if not data:
+            return
+        if isinstance(data, str):
+            # pydal hands back blobs that happen to be valid UTF-8 as text
+            data = data.encode('utf-8')
+        if data[:1] == b'D':
+            self.registers = bytearray(map(max, self.registers, data[1:]))
+            return
+        registers = self.registers
+        for offset in range(1, len(data), 3):
+            index = (data[offset] << 8) | data[offset + 1]
+            if data[offset + 2] > registers[index]:
+                registers[index] = data[offset + 2]
+
+    def estimate(self):
+        """Estimated number of distinct values"""
+        m = HLL_REGISTERS
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -rank for rank in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Small range: linear counting is more accurate
+            estimate = m * math.log(m / zeros)
+        return estimate
+
+    def bounds(self):
+        """Estimate with an interval of two standard errors (about 95%)"""
+        estimate = self.estimate()
+        return dict(
+            estimate=round(estimate),
+            low=round(estimate * (1 - 2 * HLL_ERROR)),
+            high=round(estimate * (1 + 2 * HLL_ERROR))
+        )
+
+    def to_bytes(self):
+        used = [(index, rank) for index, rank in enumerate(self.registers) if rank]
+        if len(used) * 3 < HLL_REGISTERS:
+            return b'S' + bytes(byte for index, rank in used for byte in (index >> 8, index & 0xFF, rank))
+        return b'D' + bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data):
+        sketch = cls()
+        sketch.update_bytes(data)
+        return sketch
+
+
+class TopItems:
+    """
+    Top-k summary with count bounds (Space-Saving, Metwally et al.)
+
+    Keeps at most TOP_ITEMS items as item -> [count, error]: the item's true
+    weight lies in [count - error, count]. Any item not kept weighs at most
+    floor, which stays 0 until an item has had to be dropped.
+    """
+
+    def __init__(self, items=None, floor=0):
+        self.items = items or {}
+        self.floor = floor
+
+    def add(self, item, weight=1):
+        entry = self.items.get(item)
+        if entry is not None:
+            entry[0] += weight
+            return
+        if len(self.items) >= TOP_ITEMS:
+            dropped = min(self.items, key=lambda key: self.items[key][0])
+            self.floor = max(self.floor, self.items.pop(dropped)[0])
+        self.items[item] = [self.floor + weight, self.floor]
+
+    @classmethod
+    def from_counts(cls, counts):
+        """Exact summary of {item: weight}, keeping the TOP_ITEMS heaviest"""
+        ranked = sorted(counts.items(), key=lambda item: -item[1])
+        floor = ranked[TOP_ITEMS][1] if len(ranked) > TOP_ITEMS else 0
+        return cls({item: [weight, 0] for item, weight in ranked[:TOP_ITEMS]}, floor)
+
+    @staticmethod
+    def merge(summaries):
+        """
+        Bounds on the total weight of every item kept by any summary
+
+        Args:
+            summaries (iterable): TopItems, or their to_json strings (merged
+                without building the intermediate summaries)
+
+        Returns:
+            dict: {item: (upper bound, lower bound)}
+        """
+        total_floor = 0
+        # item -> [sum of count - floor, sum of count - error]
+        totals = {}
+        for summary in summaries:
+            if isinstance(summary, TopItems):
+                floor, items = summary.floor, [[item, *entry] for item, entry in summary.items.items()]
+            elif summary:
+                data = json.loads(summary)
+                floor, items = data['floor'], data['items']
+            else:
+                continue
+            total_floor += floor
+            for item, count, error in items:
+                entry = totals.get(item)
+                if entry is None:
+                    totals[item] = [count - floor, count - error]
+                else:
+                    entry[0] += count - floor
+                    entry[1] += count - error
+        return {item: (total_floor + upper, lower) for item, (upper, lower) in totals.items()}
+
+    def to_json(self):
+        return json.dumps(dict(floor=self.floor, items=[[item, *entry] for item, entry in self.items.items()]))
+
+    @classmethod
+    def from_json(cls, data):
+        if not data:
+            return cls()
+        data = json.loads(data)
+        return cls({item: [count, error] for item, count, error in data['items']}, data['floor'])
+
+
+def cell_of(lat, lon):
+    """The (cell_lat, cell_lon) of a point, or None without coordinates"""
+    if lat is None or lon is None:
+        return None
+    degrees = settings.SKETCH_CELL_DEGREES
+    return math.floor(float(lat) / degrees), math.floor(float(lon) / degrees)
+
+
+def _rows(query):
+    """Checklists matching a query with their sightings, as raw tuples"""
+    sightings, checklist = db.sightings, db.checklist
+    return db.executesql(db(query)._select(
+        checklist.id,
+        checklist.LATITUDE,
+        checklist.LONGITUDE,
+        checklist.OBSERVATION_DATE,
+        checklist.OBSERVER_ID,
+        sightings.species_id,
+        sightings.OBSERVATION_COUNT.coalesce_zero(),
+        left=sightings.on((sightings.checklist_id == checklist.id) & (sightings.species_id != None))
+    ))
+
+
+def _groups(rows):
+    """
+    Group raw rows by cell and date, and by cell for all dates
+
+    Returns:
+        dict: {(cell_lat, cell_lon, date or None): dict of checklist ids,
+            exact weights per species and observer, and HyperLogLogs}
+    """
+    groups = {}
+    for checklist_id, lat, lon, date, observer, species_id, count in rows:
+        cell = cell_of(lat, lon)
+        if cell is None:
+            continue
+        # Raw dates are strings on SQLite and date objects elsewhere
+        date = str(date)[:10] if date else None
+        for key in {(*cell, date), (*cell, None)}:
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = dict(
+                    checklists=set(), species={}, observers={},
+                    species_hll=HyperLogLog(), observer_hll=HyperLogLog()
+                )
+            if checklist_id not in group['checklists']:
+                group['checklists'].add(checklist_id)
+                if observer is not None:
+                    group['observers'][observer] = group['observers'].get(observer, 0) + 1
+                    group['observer_hll'].add(observer)
+            if species_id is not None:
+                group['species'][species_id] = group['species'].get(species_id, 0) + count
+                group['species_hll'].add(species_id)
+    return groups
+
+
+def _fields(key, group):
+    """The region_sketches row of a group"""
+    return dict(
+        cell_lat=key[0],
+        cell_lon=key[1],
+        OBSERVATION_DATE=key[2],
+        checklists=len(group['checklists']),
+        species_hll=group['species_hll'].to_bytes(),
+        observer_hll=group['observer_hll'].to_bytes(),
+        species_top=TopItems.from_counts(group['species']).to_json(),
+        observer_top=TopItems.from_counts(group['observers']).to_json()
+    )
+
+
+def _cell_query(cell):
+    degrees = settings.SKETCH_CELL_DEGREES
+    cell_lat, cell_lon = cell
+    return (
+        (db.checklist.LATITUDE >= cell_lat * degrees) &
+        (db.checklist.LATITUDE < (cell_lat + 1) * degrees) &
+        (db.checklist.LONGITUDE >= cell_lon * degrees) &
+        (db.checklist.LONGITUDE < (cell_lon + 1) * degrees)
+    )
+
+
+def add_checklists(checklist_ids):
+    """
+    Add newly inserted checklists (and their sightings) to their sketch rows
+
+    Called inside the transaction inserting them; the caller commits.
+
+    Args:
+        checklist_ids (list): IDs of the checklist rows
+    """
+    checklist_ids = [checklist_id for checklist_id in checklist_ids if checklist_id]
+    if not checklist_ids:
+        return
+    table = db.region_sketches
+    for key, group in _groups(_rows(db.checklist.id.belongs(checklist_ids))).items():
+        cell_lat, cell_lon, date = key
+        row = db(
+            (table.cell_lat == cell_lat) & (table.cell_lon == cell_lon) & (table.OBSERVATION_DATE == date)
+        ).select(limitby=(0, 1)).first()
+        if row is None:
+            table.insert(**_fields(key, group))
+            continue
+        species_hll = HyperLogLog.from_bytes(row.species_hll)
+        species_hll.update(group['species_hll'])
+        observer_hll = HyperLogLog.from_bytes(row.observer_hll)
+        observer_hll.update(group['observer_hll'])
+        species_top = TopItems.from_json(row.species_top)
+        for species_id, count in group['species'].items():
+            species_top.add(species_id, count)
+        observer_top = TopItems.from_json(row.observer_top)
+        for observer, count in group['observers'].items():
+            observer_top.add(observer, count)
+        row.update_record(
+            checklists=row.checklists + len(group['checklists']),
+            species_hll=species_hll.to_bytes(),
+            observer_hll=observer_hll.to_bytes(),
+            species_top=species_top.to_json(),
+            observer_top=observer_top.to_json()
+        )
+
+
+def refresh_cells(cells):
+    """
+    Recompute every sketch row of some cells from their checklists
+
+    Called after checklists in them changed or were deleted, inside the same
+    transaction; the caller commits.
+
+    Args:
+        cells (iterable): (cell_lat, cell_lon) tuples, as from cell_of
+    """
+    table = db.region_sketches
+    for cell in {cell for cell in cells if cell is not None}:
+        db((table.cell_lat == cell[0]) & (table.cell_lon == cell[1])).delete()
+        for key, group in _groups(_rows(_cell_query(cell))).items():
+            table.insert(**_fields(key, group))
+
+
+def rebuild(verbose=True):
+    """
+    Recompute the whole region_sketches table, in one transaction
+
+    Args:
+        verbose (bool): Print the number of rows written
+    """
+    table = db.region_sketches
+    db(table).delete()
+    table.bulk_insert([_fields(key, group) for key, group in _groups(_rows(db.checklist.id > 0)).items()])
+    if verbose:
+        print(f"region_sketches: {db(table).count()} rows.")
+    db.commit()
+
+
+def needs_rebuild():
+    """Whether the sketches are empty while there are checklists to summarise"""
+    return db(db.region_sketches).isempty() and not db(db.checklist).isempty()
+
+
+def region_summary(bounds, limit):
+    """
+    Approximate statistics of the cells overlapping a bounding box
+
+    Args:
+        bounds (tuple): (south, north, west, east)
+        limit (int): Number of species to rank
+
+    Returns:
+        dict: bounds (the box widened to whole cells), checklists, top_species
+            ((species id, upper bound, lower bound) tuples, heaviest first),
+            distinct_species and distinct_observers (see HyperLogLog.bounds)
+    """
+    degrees = settings.SKETCH_CELL_DEGREES
+    south, north, west, east = bounds
+    south_cell, west_cell = cell_of(south, west)
+    north_cell, east_cell = cell_of(north, east)
+    table = db.region_sketches
+    rows = db(
+        (table.OBSERVATION_DATE == None) &
+        (table.cell_lat >= south_cell) & (table.cell_lat <= north_cell) &
+        (table.cell_lon >= west_cell) & (table.cell_lon <= east_cell)
+    ).select(table.checklists, table.species_hll, table.observer_hll, table.species_top)
+
+    species_hll, observer_hll = HyperLogLog(), HyperLogLog()
+    for row in rows:
+        species_hll.update_bytes(row.species_hll)
+        observer_hll.update_bytes(row.observer_hll)
+    merged = TopItems.merge(row.species_top for row in rows)
+    top_species = sorted(
+        ((species_id, upper, lower) for species_id, (upper, lower) in merged.items()),
+        key=lambda item: (-item[1], item[0])
+    )[:limit]
+
+    return dict(
+        bounds=dict(
+            south=south_cell * degrees, north=(north_cell + 1) * degrees,
+            west=west_cell * degrees, east=(east_cell + 1) * degrees
+        ),
+        checklists=sum(row.checklists for row in rows),
+        top_species=top_species,
+        distinct_species=species_hll.bounds(),
+        distinct_observers=observer_hll.bounds()
+    )
+
+
+def top_contributors(limit, since=None):
+    """
+    Approximate observer ranking by number of checklists
+
+    Args:
+        limit (int): Number of observers to return
+        since (datetime.date, optional): Only count checklists observed on or after this date
+
+    Returns:
+        dict: contributors ((observer, upper bound, lower bound) tuples,
+            most checklists first) and distinct_observers (see HyperLogLog.bounds)
+    """
+    table = db.region_sketches
+    if since is None:
+        query = table.OBSERVATION_DATE == None
+    else:
+        query = table.OBSERVATION_DATE >= since
+    rows = db(query).select(table.observer_hll, table.observer_top)
+
+    observer_hll = HyperLogLog()
+    for row in rows:
+        observer_hll.update_bytes(row.observer_hll)
+    merged = TopItems.merge(row.observer_top for row in rows)
+    contributors = sorted(
+        ((observer, upper, lower) for observer, (upper, lower) in merged.items()),
+        key=lambda item: (-item[1], item[0])
+    )[:limit]
+    return dict(contributors=contributors, distinct_observers=observer_hll.bounds())
+
+
+if __name__ == '__main__':
+    # Importing the models defines (and seeds) the tables
+    from . import models
+    rebuild()
@@ -0,0 +1,504 @@
+"""
+This file defines the spatial index used by the bounding-box queries
+
+On SQLite the checklist coordinates are mirrored into an R*Tree virtual table
+kept in sync by triggers, so every write to checklist (seeding, uploads, user
+submissions, edits and deletes) updates it without extra code at the call
+sites. A bounding box is then answered from the R*Tree in time proportional
+to the checklists inside it, instead of a range scan over one B-tree axis.
+
+On other backends, or SQLite builds without the R*Tree module, the same
+queries fall back to plain range predicates on checklist.LATITUDE/LONGITUDE.
+
+Dense map views are aggregated into grid cells sized from the web-map zoom
+level, so the response size depends on the viewport, not on the data. The
+cells divide the Web Mercator pixel grid of that zoom level, so every cell
+lies inside one map tile.
+
+Radius and nearest-neighbour lookups around a point are answered from an
+in-process KD-tree over the checklist coordinates (checklist_index), which is
+rebuilt after seeding and updated as user checklists change.
+"""
+import math
+import heapq
+import sqlite3
+import threading
+import time
+from pydal.objects import Expression
+from .common import db, Field, settings
+from .tiles import MAX_LATITUDE
+
+RTREE_TABLE = 'checklist_rtree'
+
+
+def define_spatial_index():
+    """
+    Create the checklist R*Tree and its sync triggers if they do not exist
+
+    A newly created R*Tree is filled from the existing checklists.
+
+    Returns:
+        bool: Whether the R*Tree is available
+    """
+    if db._dbname != 'sqlite':
+        return False
+
+    checklist = db.checklist._rname
+    lat, lon = db.checklist.LATITUDE._rname, db.checklist.LONGITUDE._rname
+    created = not db.executesql(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?;", placeholders=(RTREE_TABLE,)
+    )
+    try:
+        db.executesql(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {RTREE_TABLE} "
+            f"USING rtree(id, min_lat, max_lat, min_lon, max_lon);"
+        )
+    except sqlite3.OperationalError as e:
+        print(f"R*Tree spatial index unavailable, using range queries: {e}")
+        return False
+
+    # Points are stored as degenerate boxes; rows without coordinates are left out
+    db.executesql(
+        f"CREATE TRIGGER IF NOT EXISTS {RTREE_TABLE}_insert AFTER INSERT ON {checklist} "
+        f"WHEN new.{lat} IS NOT NULL AND new.{lon} IS NOT NULL BEGIN "
+        f"INSERT OR REPLACE INTO {RTREE_TABLE} VALUES (new.id, new.{lat}, new.{lat}, new.{lon}, new.{lon}); "
+        f"END;"
+    )
+    db.executesql(
+        f"CREATE TRIGGER IF NOT EXISTS {RTREE_TABLE}_update AFTER UPDATE OF {lat}, {lon} ON {checklist} BEGIN "
+        f"DELETE FROM {RTREE_TABLE} WHERE id = old.id; "
+        f"INSERT INTO {RTREE_TABLE} SELECT new.id, new.{lat}, new.{lat}, new.{lon}, new.{lon} "
+        f"WHERE new.{lat} IS NOT NULL AND new.{lon} IS NOT NULL; "
+        f"END;"
+    )
+    db.executesql(
+        f"CREATE TRIGGER IF NOT EXISTS {RTREE_TABLE}_delete AFTER DELETE ON {checklist} BEGIN "
+        f"DELETE FROM {RTREE_TABLE} WHERE id = old.id; "
+        f"END;"
+    )
+    if created:
+        db.executesql(
+            f"INSERT INTO {RTREE_TABLE} SELECT id, {lat}, {lat}, {lon}, {lon} FROM {checklist} "
+            f"WHERE {lat} IS NOT NULL AND {lon} IS NOT NULL;"
+        )
+    db.commit()
+
+    if RTREE_TABLE not in db.tables:
+        # The virtual table is managed above, never migrated by pydal
+        db.define_table(RTREE_TABLE,
+            Field('min_lat', type='double'),
+            Field('max_lat', type='double'),
+            Field('min_lon', type='double'),
+            Field('max_lon', type='double'),
+            migrate=False
+        )
+    return True
+
+
+def bounds_query(south, north, west, east):
+    """
+    Query selecting the checklists inside a bounding box
+
+    With the R*Tree the checklists come from the spatial index and are joined
+    by id. Its 32-bit coordinates are rounded outwards, which can admit points
+    less than a metre outside the box; the plain range predicates are not
+    added back, as the planner would then prefer the lat/lon B-tree.
+
+    Args:
+        south, north (float): Latitude bounds
+        west, east (float): Longitude bounds
+
+    Returns:
+        Query: Condition on db.checklist (and the R*Tree, if available)
+    """
+    if RTREE_TABLE in db.tables:
+        rtree = db[RTREE_TABLE]
+        return (
+            (rtree.max_lat >= south) &
+            (rtree.min_lat <= north) &
+            (rtree.max_lon >= west) &
+            (rtree.min_lon <= east) &
+            (rtree.id == db.checklist.id)
+        )
+    return (
+        (db.checklist.LATITUDE >= south) &
+        (db.checklist.LATITUDE <= north) &
+        (db.checklist.LONGITUDE >= west) &
+        (db.checklist.LONGITUDE <= east)
+    )
+
+
+def grid_cells(zoom):
+    """
+    Number of grid cells across the map (on each axis) at a web-map zoom level
+
+    Each 256 pixel tile is split into a whole number of cells about
+    settings.MAP_CLUSTER_CELL_PX pixels wide, so cell edges fall on tile edges.
+
+    Args:
+        zoom (int): Web-map zoom level
+
+    Returns:
+        int: Cells across the 2**zoom tiles of each axis
+    """
+    return 2 ** zoom * max(1, round(256 / settings.MAP_CLUSTER_CELL_PX))
+
+
+def cell_size(zoom):
+    """
+    Grid cell width in degrees of longitude for a web-map zoom level
+
+    Cells are square on the map, so their height in degrees of latitude
+    shrinks away from the equator.
+
+    Args:
+        zoom (int): Web-map zoom level
+
+    Returns:
+        float: Cell width in degrees
+    """
+    return 360.0 / grid_cells(zoom)
+
+
+_math_functions = None
+
+
+def _has_math_functions():
+    """Whether the database has LN, TAN and RADIANS (SQLite: only if built with them)"""
+    global _math_functions
+    if _math_functions is None:
+        try:
+            db.executesql("SELECT LN(TAN(PI() / 4 + RADIANS(45.0) / 2));")
+            _math_functions = True
+        except Exception:
+            db.rollback()
+            _math_functions = False
+    return _math_functions
+
+
+def _grid_row(cells):
+    """
+    Expression of the grid row of a checklist's latitude
+
+    The row is counted down from the top of the Web Mercator map, like tile
+    rows; latitudes beyond the map's edges fall in its first or last row.
+    Without SQL math functions, rows are equal latitude bands instead, which
+    may straddle tile edges.
+    """
+    lat = db.checklist.LATITUDE
+    if not _has_math_functions():
+        return ((lat + 90) / (180.0 / cells)).cast('integer')
+    clamped = (lat > MAX_LATITUDE).case(MAX_LATITUDE, (lat < -MAX_LATITUDE).case(-MAX_LATITUDE, lat))
+    # Mercator y in [0, 1]: (1 - ln(tan(pi / 4 + lat / 2)) / pi) / 2
+    mercator_y = Expression(
+        db, f"(1 - LN(TAN(PI() / 4 + RADIANS({db._adapter.expand(clamped)}) / 2)) / PI()) / 2", type='double'
+    )
+    return (mercator_y * cells).cast('integer')
+
+
+def cluster_sightings(query, zoom):
+    """
+    Aggregate the sightings matched by query into the grid cells of a zoom level
+
+    A single grouped query returns one row per (cell, species); the rows are
+    then folded into one entry per cell. Each entry is placed at the mean
+    position of its sightings and carries the summed intensity (observation
+    counts capped at 10 per sighting, as for raw points) and the species with
+    the highest total count.
+
+    Args:
+        query (Query): Condition joining sightings to checklist
+        zoom (int): Web-map zoom level (see grid_cells)
+
+    Returns:
+        list: Dicts with lat, lon, species_id, intensity and sightings
+    """
+    cells = grid_cells(zoom)
+    cell_row = _grid_row(cells)
+    cell_col = ((db.checklist.LONGITUDE + 180) / (360.0 / cells)).cast('integer')
+    count = db.sightings.OBSERVATION_COUNT.coalesce(1)
+    intensity = (count > 10).case(10, count)
+    sql = db(query)._select(
+        cell_row, cell_col, db.sightings.species_id,
+        db.sightings.id.count(), db.checklist.LATITUDE.sum(), db.checklist.LONGITUDE.sum(),
+        intensity.sum(), count.sum(),
+        groupby=(cell_row, cell_col, db.sightings.species_id)
+    )
+
+    cells = {}
+    for row, col, species_id, sightings, lat_sum, lon_sum, intensity_sum, count_sum in db.executesql(sql):
+        cluster = cells.get((row, col))
+        if cluster is None:
+            cluster = cells[(row, col)] = dict(
+                lat_sum=0.0, lon_sum=0.0, sightings=0, intensity=0, species_id=None, top_count=0
+            )
+        cluster['lat_sum'] += lat_sum
+        cluster['lon_sum'] += lon_sum
+        cluster['sightings'] += sightings
+        cluster['intensity'] += intensity_sum
+        if count_sum > cluster['top_count']:
+            cluster['species_id'], cluster['top_count'] = species_id, count_sum
+
+    return [
+        dict(
+            lat=cluster['lat_sum'] / cluster['sightings'],
+            lon=cluster['lon_sum'] / cluster['sightings'],
+            species_id=cluster['species_id'],
+            intensity=cluster['intensity'],
+            sightings=cluster['sightings']
+        )
+        for cluster in cells.values()
+    ]
+
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance between two points, in kilometres"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (
+        math.sin((phi2 - phi1) / 2) ** 2 +
+        math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _unit_vector(lat, lon):
+    phi, lam = math.radians(lat), math.radians(lon)
+    return (math.cos(phi) * math.cos(lam), math.cos(phi) * math.sin(lam), math.sin(phi))
+
+
+class PointIndex:
+    """
+    KD-tree of points on the sphere, for radius and k-nearest queries
+
+    Points are stored as 3D unit vectors, so the straight-line (chord)
+    distance between them grows with the great-circle distance and the tree
+    needs no special case at the poles or the antimeridian.
+
+    Points added or moved after the last build are kept in a pending list
+    that is searched linearly, and removed points are skipped; once more than
+    a sixteenth of the points are pending or removed, the tree is rebuilt in
+    a background thread, so the write that crossed the threshold does not
+    wait for it and searches keep using the old tree and pending list.
+    Other worker processes do not see this process's updates, so the index
+    also reloads from the database every settings.HOTSPOT_INDEX_MAX_AGE
+    seconds: one thread reloads while the others keep searching the old tree,
+    and points added or removed during the reload are replayed onto the new
+    one.
+    """
+
+    LEAF_SIZE = 16
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Held while loading, so concurrent requests do not each read every checklist
+        self._load_lock = threading.Lock()
+        self._points = {}
+        self._tree = None
+        self._pending = []
+        self._stale = 0
+        self._loaded = None
+        # Bumped by every load, so a background rebuild of older points is dropped
+        self._generation = 0
+        self._rebuilding = False
+        # Changes made while a load is in flight, as (point id, entry or None
+        # when removed), to replay onto the new tree
+        self._changes = None
+
+    @staticmethod
+    def _build(entries):
+        if len(entries) <= PointIndex.LEAF_SIZE:
+            return (None, entries)
+        # Split the widest axis at its median
+        axis = max(range(3), key=lambda i: max(e[i + 1] for e in entries) - min(e[i + 1] for e in entries))
+        entries.sort(key=lambda e: e[axis + 1])
+        middle = len(entries) // 2
+        return (axis, entries[middle][axis + 1], PointIndex._build(entries[:middle]), PointIndex._build(entries[middle:]))
+
+    def _rebuild_in_background(self):
+        """Rebuild the tree from the current points, then drop the pending entries it holds"""
+        try:
+            with self._lock:
+                generation, stale, built = self._generation, self._stale, len(self._pending)
+                entries = list(self._points.values())
+            tree = self._build(entries)
+            with self._lock:
+                if generation == self._generation:
+                    # Points changed during the build stay pending
+                    self._tree, self._pending = tree, self._pending[built:]
+                    self._stale -= stale
+        finally:
+            with self._lock:
+                self._rebuilding = False
+
+    def load(self):
+        """Rebuild the index from the coordinates in the checklist table"""
+        with self._load_lock:
+            self._load()
+
+    def _load(self):
+        """Rebuild the index; the caller holds the load lock"""
+        with self._lock:
+            self._changes = []
+        try:
+            rows = db.executesql(db(
+                (db.checklist.LATITUDE != None) & (db.checklist.LONGITUDE != None)
+            )._select(db.checklist.id, db.checklist.LATITUDE, db.checklist.LONGITUDE))
+            points = {
+                checklist_id: (checklist_id, *_unit_vector(lat, lon), lat, lon)
+                for checklist_id, lat, lon in rows
+            }
+            # Built outside the lock: searches keep using the old tree meanwhile
+            tree = self._build(list(points.values()))
+        except Exception:
+            with self._lock:
+                self._changes = None
+            raise
+        with self._lock:
+            self._points, self._tree, self._pending, self._stale = points, tree, [], 0
+            self._generation += 1
+            self._loaded = time.monotonic()
+            for point_id, entry in self._changes:
+                self._update(point_id, entry)
+            self._changes = None
+
+    def _ensure_loaded(self):
+        expired = lambda: time.monotonic() - self._loaded > settings.HOTSPOT_INDEX_MAX_AGE
+        if self._loaded is None:
+            # Nothing to search yet: wait for the load in flight, if any
+            with self._load_lock:
+                if self._loaded is None:
+                    self._load()
+        elif expired() and self._load_lock.acquire(blocking=False):
+            # Only old: this thread reloads, the others keep using this tree
+            try:
+                if expired():
+                    self._load()
+            finally:
+                self._load_lock.release()
+
+    def _update(self, point_id, entry):
+        """Index a point's new entry, or remove it when None; the caller holds the lock"""
+        if entry is None:
+            if self._points.pop(point_id, None) is None:
+                return
+        else:
+            self._points[point_id] = entry
+            self._pending.append(entry)
+        self._stale += 1
+        if self._stale > max(64, len(self._points) // 16) and not self._rebuilding:
+            self._rebuilding = True
+            threading.Thread(target=self._rebuild_in_background, daemon=True).start()
+
+    def _change(self, point_id, entry):
+        with self._lock:
+            if self._changes is not None:
+                # The load in flight may have read this point before the change
+                self._changes.append((point_id, entry))
+            self._update(point_id, entry)
+
+    def add(self, point_id, lat, lon):
+        """Add a point, or move it if it is already indexed"""
+        if lat is None or lon is None:
+            self.remove(point_id)
+            return
+        self._change(point_id, (point_id, *_unit_vector(lat, lon), lat, lon))
+
+    def remove(self, point_id):
+        """Remove a point, if indexed"""
+        self._change(point_id, None)
+
+    def _candidates(self, node, target, chord):
+        """Entries of the tree within chord of target (before the liveness check)"""
+        stack = [node]
+        while stack:
+            axis, *rest = stack.pop()
+            if axis is None:
+                yield from rest[0]
+                continue
+            split, low, high = rest
+            difference = target[axis] - split
+            near, far = (low, high) if difference < 0 else (high, low)
+            stack.append(near)
+            if abs(difference) <= chord:
+                stack.append(far)
+
+    def within(self, lat, lon, radius_km):
+        """
+        Points within a great-circle radius
+
+        Args:
+            lat, lon (float): Centre
+            radius_km (float): Radius in kilometres
+
+        Returns:
+            list: (point id, distance in km) tuples, nearest first
+        """
+        self._ensure_loaded()
+        target = _unit_vector(lat, lon)
+        chord = 2 * math.sin(min(math.pi, radius_km / EARTH_RADIUS_KM) / 2)
+        chord_squared = chord * chord
+        with self._lock:
+            points, tree, pending = self._points, self._tree, self._pending
+        results = []
+        for entry in [*self._candidates(tree, target, chord), *pending]:
+            # Skip removed points and the old positions of moved ones
+            if points.get(entry[0]) is not entry:
+                continue
+            distance = (entry[1] - target[0]) ** 2 + (entry[2] - target[1]) ** 2 + (entry[3] - target[2]) ** 2
+            if distance <= chord_squared:
+                results.append((entry[0], haversine_km(lat, lon, entry[4], entry[5])))
+        return sorted(results, key=lambda result: result[1])
+
+    def nearest(self, lat, lon, k):
+        """
+        The k points nearest to a location
+
+        Args:
+            lat, lon (float): Location
+            k (int): Number of points
+
+        Returns:
+            list: (point id, distance in km) tuples, nearest first
+        """
+        self._ensure_loaded()
+        target = _unit_vector(lat, lon)
+        with self._lock:
+            points, tree, pending = self._points, self._tree, self._pending
+        best = []  # max-heap of (-squared chord, id)
+
+        def consider(entry):
+            if points.get(entry[0]) is not entry:
+                return
+            distance = (entry[1] - target[0]) ** 2 + (entry[2] - target[1]) ** 2 + (entry[3] - target[2]) ** 2
+            if len(best) < k:
+                heapq.heappush(best, (-distance, entry[0], entry))
+            elif distance < -best[0][0]:
+                heapq.heapreplace(best, (-distance, entry[0], entry))
+
+        def search(node):
+            axis, *rest = node
+            if axis is None:
+                for entry in rest[0]:
+                    consider(entry)
+                return
+            split, low, high = rest
+            difference = target[axis] - split
+            near, far = (low, high) if difference < 0 else (high, low)
+            search(near)
+            if len(best) < k or difference * difference < -best[0][0]:
+                search(far)
+
+        if k > 0:
+            search(tree)
+            for entry in pending:
+                consider(entry)
+        return sorted(
+            ((point_id, haversine_km(lat, lon, entry[4], entry[5])) for _, point_id, entry in best),
+            key=lambda result: result[1]
+        )
+
+
+checklist_index = PointIndex()
@@ -0,0 +1,233 @@
+"""
+This file defines the in-memory index behind search_species
+
+The species picker calls search_species on every keystroke, and a SQL
+substring match (LIKE '%q%') can never use an index. Instead, every species
+name is normalised (lowercase, accents and apostrophes dropped, other
+punctuation turned into spaces) and indexed in memory three ways:
+
+    word starts  sorted suffixes of the name starting at each word, so
+                 prefix and word-boundary matches are a binary search
+    trigrams     trigram -> positions of the names containing it, padded
+                 with a space at word edges, for substring and typo-tolerant
+                 matches
+    popularity   summed observation counts from species_totals
+
+Results are ranked prefix matches first, then word-boundary matches, then
+other substring matches, each by popularity. A query matching no name as
+typed is assumed to be misspelt: names sharing most of its trigrams are
+returned instead, closest first.
+
+The index is built on first use. Code adding species (get_species_id,
+seeding and uploads) marks it stale so it rebuilds on next use, as it also
+does every settings.SPECIES_SEARCH_MAX_AGE seconds to pick up other workers'
+writes and popularity changes. One thread rebuilds at a time; the others
+keep searching the old index meanwhile.
+"""
+import re
+import time
+import heapq
+import itertools
+import bisect
+import threading
+import unicodedata
+from .common import db, settings
+
+# Share of the query's trigrams a name must contain to count as a typo match
+FUZZY_MIN_SHARE = 0.5
+
+# Ranking tiers
+PREFIX, WORD, SUBSTRING = range(3)
+
+SEPARATORS = re.compile(r"[^0-9a-z]+")
+
+
+def normalize(text):
+    """Lowercase a name, drop accents and apostrophes, and collapse punctuation into spaces"""
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(char for char in text if not unicodedata.combining(char)).lower()
+    return SEPARATORS.sub(' ', text.replace("'", '').replace('’', '')).strip()
+
+
+def trigrams(text, complete=True):
+    """
+    Trigrams of each word of a normalised text, padded with a space at word edges
+
+    Args:
+        text (str): Normalised text
+        complete (bool): Whether the last word is complete; a query's last
+            word is still being typed, so it is not padded at its end
+    """
+    words = text.split()
+    grams = set()
+    for position, word in enumerate(words):
+        padded = ' ' + word + (' ' if complete or position < len(words) - 1 else '')
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class SpeciesIndex:
+    """Ranked prefix, word-boundary, substring and typo-tolerant species search"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._loaded = None
+        self._stale = False
+        self._rows = []
+        self._names = []
+        self._popularity = []
+        self._starts = []
+        self._trigrams = {}
+        # Full rankings of queries too short for trigrams, memoised since
+        # they match a large share of the names
+        self._short = {}
+
+    def load(self):
+        """Rebuild the index from the species and species_totals tables"""
+        with self._load_lock:
+            self._load()
+
+    def _load(self):
+        """Rebuild the index; the caller holds the load lock"""
+        with self._lock:
+            # Species added from here on may be missing: they mark it stale again
+            self._stale = False
+        rows = db(db.species.id > 0).select(orderby=db.species.id).as_list()
+        totals = dict(db.executesql(db(db.species_totals.species_id > 0)._select(
+            db.species_totals.species_id, db.species_totals.total_count
+        )))
+        names = [normalize(row['COMMON_NAME']) for row in rows]
+        popularity = [totals.get(row['id']) or 0 for row in rows]
+
+        starts = []
+        grams = {}
+        for position, name in enumerate(names):
+            for match in re.finditer(r'\S+', name):
+                starts.append((name[match.start():], position))
+            for gram in trigrams(name):
+                grams.setdefault(gram, []).append(position)
+        starts.sort()
+
+        with self._lock:
+            self._rows, self._names, self._popularity = rows, names, popularity
+            self._starts, self._trigrams, self._short = starts, grams, {}
+            self._loaded = time.monotonic()
+
+    def invalidate(self):
+        """Rebuild on next use (after species were added)"""
+        with self._lock:
+            self._stale = True
+
+    def _ensure_loaded(self):
+        outdated = lambda: self._stale or time.monotonic() - self._loaded > settings.SPECIES_SEARCH_MAX_AGE
+        if self._loaded is None:
+            # Nothing to search yet: wait for the load in flight, if any
+            with self._load_lock:
+                if self._loaded is None:
+                    self._load()
+        elif outdated() and self._load_lock.acquire(blocking=False):
+            # This thread reloads, the others keep searching the old index
+            try:
+                if outdated():
+                    self._load()
+            finally:
+                self._load_lock.release()
+
+    @staticmethod
+    def _tiers(names, starts, grams, query, allowed, enough=None):
+        """
+        Tier of every name containing a normalised query
+
+        Args:
+            names, starts, grams: The index searched (see load)
+            query (str): Normalised query
+            allowed (callable): Whether a name position may be returned
+            enough (int, optional): Skip the substring pass once this many
+                prefix and word-boundary matches were found, since they all
+                rank above substring matches
+
+        Returns:
+            dict: {name position: PREFIX, WORD or SUBSTRING}
+        """
+        tiers = {}
+        index = bisect.bisect_left(starts, (query,))
+        while index < len(starts) and starts[index][0].startswith(query):
+            suffix, position = starts[index]
+            tier = PREFIX if len(suffix) == len(names[position]) else WORD
+            if allowed(position) and tier < tiers.get(position, SUBSTRING):
+                tiers[position] = tier
+            index += 1
+        if enough and len(tiers) >= enough:
+            return tiers
+
+        inner = {gram for gram in trigrams(query, complete=False) if ' ' not in gram}
+        if inner:
+            # Candidates containing every trigram of the query
+            postings = sorted((grams.get(gram, ()) for gram in inner), key=len)
+            candidates = set(postings[0]).intersection(*postings[1:])
+        else:
+            candidates = range(len(names))
+        for position in candidates:
+            if position not in tiers and query in names[position] and allowed(position):
+                tiers[position] = SUBSTRING
+        return tiers
+
+    @staticmethod
+    def _fuzzy(names, popularity, grams, query, allowed, limit):
+        """Positions of the names sharing most of a query's trigrams, closest first"""
+        query_grams = trigrams(query, complete=False)
+        shared = {}
+        for gram in query_grams:
+            for position in grams.get(gram, ()):
+                shared[position] = shared.get(position, 0) + 1
+        needed = FUZZY_MIN_SHARE * len(query_grams)
+        close = [position for position, count in shared.items() if count >= needed and allowed(position)]
+        return heapq.nsmallest(
+            limit or len(close), close,
+            key=lambda position: (-shared[position], -popularity[position], names[position])
+        )
+
+    def search(self, query, limit=None, min_observations=0):
+        """
+        Species whose names match a query, best first
+
+        Args:
+            query (str): Text typed so far; empty lists every species by id
+            limit (int, optional): Maximum number of species
+            min_observations (int): Only species with at least this many
+                observations in total
+
+        Returns:
+            list: species rows (dicts), best match first
+        """
+        self._ensure_loaded()
+        # One consistent index, even if a reload swaps in a new one meanwhile
+        with self._lock:
+            rows, names, popularity = self._rows, self._names, self._popularity
+            starts, grams, short = self._starts, self._trigrams, self._short
+        if min_observations > 0:
+            allowed = lambda position: popularity[position] >= min_observations
+        else:
+            allowed = lambda position: True
+        rank = lambda tiers: lambda position: (tiers[position], -popularity[position], names[position])
+
+        query = normalize(query)
+        if not query:
+            ranked = (position for position in range(len(rows)) if allowed(position))
+        elif len(query) < 3:
+            ranked = short.get(query)
+            if ranked is None:
+                tiers = self._tiers(names, starts, grams, query, lambda position: True)
+                ranked = short[query] = sorted(tiers, key=rank(tiers))
+            ranked = (position for position in ranked if allowed(position))
+        else:
+            tiers = self._tiers(names, starts, grams, query, allowed, limit)
+            ranked = heapq.nsmallest(limit or len(tiers), tiers, key=rank(tiers))
+            if not ranked:
+                # Nothing matches as typed: assume a typo
+                ranked = self._fuzzy(names, popularity, grams, query, allowed, limit)
+        return [rows[position] for position in itertools.islice(ranked, limit)]
+
+
+index = SpeciesIndex()
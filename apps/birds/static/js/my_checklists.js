@@ -31,9 +31,16 @@ createApp({
     methods: {
         async fetchChecklists() {
             try {
-                const response = await axios.get('/birds/get_my_checklists');
+                // The list is paginated: follow the next cursors to the last page
+                const checklists = [];
+                let after = null;
+                do {
+                    const response = await axios.get('/birds/get_my_checklists', { params: { after } });
+                    checklists.push(...response.data.checklists);
+                    after = response.data.next;
+                } while (after);
                 const checklistsWithDetails = await Promise.all(
-                    response.data.checklists.map(async (checklist) => {
+                    checklists.map(async (checklist) => {
                         try {
                             const speciesCountResponse = await axios.get('/birds/get_checklist_species_count', {
                                 params: { checklist_id: checklist.id }
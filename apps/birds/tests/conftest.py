@@ -0,0 +1,121 @@
+"""
+Shared setup of the app tests
+
+The app is imported from a copy in a temporary folder, seeded from the first
+SEED_CHECKLISTS checklists of the upload CSVs (with their sightings and every
+species), so the tests never touch the app's own database, caches or uploads.
+Background cache warming is turned off through settings_private.py.
+
+Run from the folder containing apps/:
+
+    python -m pytest apps/birds/tests
+"""
+import io
+import inspect
+import os
+import csv
+import sys
+import contextlib
+import shutil
+import tempfile
+import pytest
+
+APP_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SEED_CHECKLISTS = 300
+
+SETTINGS_PRIVATE = """
+INGEST_WORKERS = 1
+RESPONSE_CACHE_WARM = []
+RESPONSE_CACHE_WARM_ITEMS = 0
+"""
+
+
+def _copy_csv(source, target, keep=None, limit=None):
+    """Copy the rows of a CSV file, optionally filtered and truncated; returns the rows kept"""
+    kept = []
+    with open(source, 'r', encoding='utf-8-sig', newline='') as f_in, \
+            open(target, 'w', encoding='utf-8', newline='') as f_out:
+        reader, writer = csv.reader(f_in), csv.writer(f_out)
+        writer.writerow(next(reader))
+        for record in reader:
+            if keep is not None and not keep(record):
+                continue
+            writer.writerow(record)
+            kept.append(record)
+            if limit is not None and len(kept) >= limit:
+                break
+    return kept
+
+
+def _make_app(root):
+    """Copy the app's code under root/apps/birds, with small upload CSVs"""
+    app = os.path.join(root, 'apps', 'birds')
+    shutil.copytree(APP_FOLDER, app, ignore=shutil.ignore_patterns(
+        '__pycache__', 'tests', 'databases', 'uploads', 'cache', 'static'
+    ))
+    shutil.copy(os.path.join(os.path.dirname(APP_FOLDER), '__init__.py'), os.path.join(root, 'apps'))
+    os.makedirs(os.path.join(app, 'databases'))
+    with open(os.path.join(app, 'settings_private.py'), 'w', encoding='utf-8') as f:
+        f.write(SETTINGS_PRIVATE)
+
+    uploads, target = os.path.join(APP_FOLDER, 'uploads'), os.path.join(app, 'uploads')
+    os.makedirs(target)
+    _copy_csv(os.path.join(uploads, 'species.csv'), os.path.join(target, 'species.csv'))
+    checklists = _copy_csv(
+        os.path.join(uploads, 'checklists.csv'), os.path.join(target, 'checklists.csv'), limit=SEED_CHECKLISTS
+    )
+    events = {record[0] for record in checklists}
+    _copy_csv(
+        os.path.join(uploads, 'sightings.csv'), os.path.join(target, 'sightings.csv'),
+        keep=lambda record: record[0] in events
+    )
+
+
+def pytest_configure(config):
+    root = tempfile.mkdtemp(prefix='birds-tests-')
+    config._birds_root = root
+    _make_app(root)
+    # The app seeds from apps/birds/uploads relative to the working folder
+    cwd = os.getcwd()
+    sys.path.insert(0, root)
+    os.chdir(root)
+    try:
+        # Keep the seeding progress out of the test report
+        with contextlib.redirect_stdout(io.StringIO()):
+            import apps.birds
+    finally:
+        os.chdir(cwd)
+    assert apps.birds.__file__.startswith(root), "apps was imported before the test copy"
+
+
+def pytest_unconfigure(config):
+    root = getattr(config, '_birds_root', None)
+    if root:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+@pytest.fixture
+def db():
+    """The app's database; changes a test leaves uncommitted are rolled back"""
+    from apps.birds.common import db
+    db.rollback()
+    yield db
+    db.rollback()
+
+
+@pytest.fixture
+def bind_request():
+    """Point the global request at a synthetic GET query or POST JSON body"""
+    from apps.birds.response_cache import bind_request
+    return bind_request
+
+
+@pytest.fixture
+def action(bind_request):
+    """Call an action's body, without its response cache, on a synthetic request"""
+    from apps.birds import controllers
+
+    def call(name, method='GET', parameters=None):
+        bind_request(method, parameters or {})
+        return inspect.unwrap(getattr(controllers, name))()
+    return call
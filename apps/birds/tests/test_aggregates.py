@@ -0,0 +1,71 @@
+"""Summary tables: deltas applied by user writes match a rebuild from the rows"""
+import pytest
+from apps.birds import aggregates, controllers
+
+USER_EMAIL = "aggregates-test@example.com"
+
+
+def summaries(db):
+    """Every summary table's rows, without their ids"""
+    return {
+        table._tablename: sorted((tuple(row.values())[1:] for row in db(table).select().as_list()), key=repr)
+        for table, *_ in aggregates._summaries()
+    }
+
+
+def assert_as_rebuilt(db):
+    applied = summaries(db)
+    aggregates.rebuild(verbose=False)
+    assert summaries(db) == applied
+
+
+@pytest.fixture
+def checklists(db, monkeypatch):
+    """Submits user checklists; their leftovers are deleted afterwards"""
+    monkeypatch.setattr(controllers, 'get_user_email', lambda: USER_EMAIL)
+    monkeypatch.setattr(controllers.analytics.engine, 'load_in_background', lambda: None)
+    submitted = []
+
+    def submit(**data):
+        result = controllers.ChecklistManager.submit_checklist(data)
+        assert result['status'] == 'success', result
+        submitted.append(result['checklist_id'])
+        return result['checklist_id']
+
+    yield submit
+    for checklist_id in submitted:
+        if db.my_checklist(checklist_id):
+            controllers.ChecklistManager.modify_checklist(checklist_id, 'delete')
+
+
+def test_applied_checklist_changes_match_a_rebuild(db, checklists):
+    names = [row.COMMON_NAME for row in db(db.species).select(db.species.COMMON_NAME, limitby=(0, 3))]
+    first = checklists(
+        speciesName=names[0], latitude=35.0, longitude=-80.0, observationDate='2021-05-01',
+        durationMinutes=30, species=[dict(COMMON_NAME=names[0], count=4), dict(COMMON_NAME=names[1], count=2)]
+    )
+    second = checklists(
+        speciesName=names[2], latitude=36.0, longitude=-81.0, observationDate='2021-05-01',
+        species=[dict(COMMON_NAME=names[2], count=1), dict(COMMON_NAME="Aggregates test bird", count=9)]
+    )
+    assert_as_rebuilt(db)
+
+    edited = controllers.ChecklistManager.modify_checklist(
+        first, 'edit', dict(OBSERVATION_DATE='2021-06-15', DURATION_MINUTES=90, LATITUDE=34.0)
+    )
+    assert edited['status'] == 'success', edited
+    assert_as_rebuilt(db)
+
+    deleted = controllers.ChecklistManager.modify_checklist(second, 'delete')
+    assert deleted['status'] == 'success', deleted
+    assert_as_rebuilt(db)
+
+
+def test_removing_then_adding_checklists_leaves_the_tables_unchanged(db):
+    checklist_ids = [row.id for row in db(db.checklist).select(db.checklist.id, limitby=(0, 20))]
+    before = summaries(db)
+    aggregates.apply_checklists(checklist_ids, -1)
+    removed = summaries(db)
+    assert removed != before
+    aggregates.apply_checklists(checklist_ids, 1)
+    assert summaries(db) == before
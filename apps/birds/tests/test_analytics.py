@@ -0,0 +1,178 @@
+"""Analytics engine: refreshed columns answer like a rollup of the current rows"""
+import datetime
+from collections import Counter
+import pytest
+from apps.birds import analytics
+from apps.birds.response_cache import responses
+
+pytest.importorskip('numpy')
+
+BOUNDS = (30.0, 40.0, -90.0, -75.0)
+
+
+def rollup(db):
+    """Per-species count and minute totals, overall and inside BOUNDS, and dated counts, from the rows"""
+    sightings, checklist = db.sightings, db.checklist
+    rows = db(sightings).select(
+        sightings.species_id, sightings.OBSERVATION_COUNT, checklist.LATITUDE, checklist.LONGITUDE,
+        checklist.OBSERVATION_DATE, checklist.DURATION_MINUTES,
+        left=checklist.on(checklist.id == sightings.checklist_id)
+    )
+    counts, minutes, inside, dated = Counter(), Counter(), Counter(), Counter()
+    south, north, west, east = BOUNDS
+    for row in rows:
+        species_id = row.sightings.species_id
+        if not species_id:
+            continue
+        count = row.sightings.OBSERVATION_COUNT or 0
+        counts[species_id] += count
+        minutes[species_id] += row.checklist.DURATION_MINUTES or 0
+        lat, lon = row.checklist.LATITUDE, row.checklist.LONGITUDE
+        if lat is not None and lon is not None and south <= lat <= north and west <= lon <= east:
+            inside[species_id] += count
+        if row.checklist.OBSERVATION_DATE is not None:
+            dated[(species_id, row.checklist.OBSERVATION_DATE)] += count
+    return counts, minutes, inside, dated
+
+
+def top(totals, limit):
+    ranked = sorted(((species_id, total) for species_id, total in totals.items() if species_id),
+                    key=lambda item: (-item[1], item[0]))
+    return ranked[:limit]
+
+
+def assert_matches(store, db):
+    counts, minutes, inside, dated = rollup(db)
+    assert store.top_species('count', 20) == top(counts, 20)
+    assert store.top_species('count', 20, BOUNDS) == top(inside, 20)
+    engine_minutes = store.top_species('minutes', 20)
+    assert [species_id for species_id, _ in engine_minutes] == [species_id for species_id, _ in top(minutes, 20)]
+    assert [total for _, total in engine_minutes] == pytest.approx([total for _, total in top(minutes, 20)])
+    species_ids = [species_id for species_id, _ in top(counts, 3)]
+    expected = Counter()
+    for (species_id, date), count in dated.items():
+        if species_id in species_ids:
+            expected[date] += count
+    assert store.species_dates(species_ids) == sorted((date, total) for date, total in expected.items() if total)
+
+
+def change_checklists(db, step=0):
+    """Edit, empty, move and add checklists as user writes would; returns the checklist ids touched"""
+    sightings, checklist = db.sightings, db.checklist
+    first, second, third = [row.id for row in db(checklist).select(
+        checklist.id, orderby=checklist.id, limitby=(3 * step, 3 * step + 3)
+    )]
+    db(sightings.checklist_id == first).update(OBSERVATION_COUNT=sightings.OBSERVATION_COUNT + 500)
+    db(sightings.checklist_id == second).delete()
+    db(checklist.id == third).update(LATITUDE=35.0, LONGITUDE=-80.0, DURATION_MINUTES=600)
+    added = checklist.insert(
+        SAMPLING_EVENT_IDENTIFIER=f"TEST{step}", LATITUDE=36.0, LONGITUDE=-81.0,
+        OBSERVATION_DATE=datetime.date(2021, 3, 1), TIME_OBSERVATIONS_STARTED=datetime.time(8, 0),
+        DURATION_MINUTES=30
+    )
+    species_id = db(db.species).select(db.species.id, orderby=db.species.id, limitby=(0, 1)).first().id
+    sightings.insert(SAMPLING_EVENT_IDENTIFIER=f"TEST{step}", checklist_id=added, species_id=species_id,
+                     COMMON_NAME="Test", OBSERVATION_COUNT=10000)
+    return [first, second, third, added]
+
+
+@pytest.fixture
+def store(db):
+    store = analytics.ColumnStore()
+    store.load()
+    return store
+
+
+def test_loaded_store_matches_rollup(db, store):
+    assert_matches(store, db)
+
+
+def test_refresh_checklists_matches_rollup(db, store):
+    for step in range(3):
+        store.refresh_checklists(change_checklists(db, step))
+        assert_matches(store, db)
+
+
+def test_refresh_compacts_dead_rows(db, store):
+    checklist_ids = [row.id for row in db(db.checklist).select(db.checklist.id)]
+    size = store._size
+    # Refreshing every checklist twice flags more than a quarter of the rows dead
+    store.refresh_checklists(checklist_ids)
+    store.refresh_checklists(checklist_ids)
+    assert store._dead * 4 <= store._size <= size
+    assert_matches(store, db)
+
+
+def test_refresh_during_load_is_replayed(db, store):
+    read = store._read
+    touched = []
+
+    def read_then_change():
+        # The load has read the rows when this writer refreshes its checklists
+        loaded = read()
+        touched.extend(change_checklists(db))
+        store.refresh_checklists(touched)
+        return loaded
+
+    store._read = read_then_change
+    store.invalidate()
+    store.load()
+    assert touched
+    assert_matches(store, db)
+
+
+def other_process_write(db, step):
+    """Change checklists as a write of another worker process would: bumped and logged, this store untouched"""
+    checklist_ids = change_checklists(db, step)
+    version = responses.bump('checklist')['checklist']
+    analytics.log_changes(checklist_ids, version)
+    return version
+
+
+@pytest.fixture
+def loads(store, monkeypatch):
+    """Background loads started by the store (not run: they would not see this test's uncommitted rows)"""
+    started = []
+    monkeypatch.setattr(store, 'load_in_background', lambda: started.append(True))
+    return started
+
+
+def test_store_catches_up_from_the_change_log(db, store, loads, monkeypatch):
+    monkeypatch.setattr(store, '_read', lambda: pytest.fail("caught up by a full load"))
+    for step in range(3):
+        version = other_process_write(db, step)
+        assert_matches(store, db)
+        assert store._version == version
+    assert not loads
+
+
+def test_store_reloads_in_background_when_the_log_has_gaps(db, store, loads):
+    version = other_process_write(db, 0)
+    # A bulk change: bumped without logging
+    responses.bump('checklist')
+    assert store.top_species('count', 10) is None
+    assert loads
+    assert store._version < version
+
+
+def test_store_is_not_waited_for(db, monkeypatch):
+    store = analytics.ColumnStore()
+    loads = []
+    monkeypatch.setattr(store, 'load_in_background', lambda: loads.append(True))
+    assert store.top_species('count', 10) is None
+    assert store.species_dates([1]) is None
+    assert loads == [True, True]
+    store.load()
+    assert_matches(store, db)
+    store.invalidate()
+    assert store.top_species('count', 10) is None
+
+
+def test_pinned_block_answers_from_one_snapshot(db, store, loads):
+    with store.pinned():
+        before = store.top_species('count', 5)
+        other_process_write(db, 0)
+        assert store.top_species('count', 5) == before
+    store.invalidate()
+    with store.pinned():
+        assert store.top_species('count', 5) is None
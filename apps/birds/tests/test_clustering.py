@@ -0,0 +1,43 @@
+"""Map clustering: grid cells aggregate exactly the sightings that fall in them"""
+import math
+from collections import Counter, defaultdict
+import pytest
+from apps.birds import spatial, tiles
+
+
+def cell_of(lat, lon, zoom):
+    """The (row, column) grid cell of a point, counted like spatial.cluster_sightings"""
+    cells = spatial.grid_cells(zoom)
+    if spatial._has_math_functions():
+        lat = max(-tiles.MAX_LATITUDE, min(tiles.MAX_LATITUDE, lat))
+        row = int((1 - math.log(math.tan(math.pi / 4 + math.radians(lat) / 2)) / math.pi) / 2 * cells)
+    else:
+        row = int((lat + 90) / (180.0 / cells))
+    return row, int((lon + 180) / (360.0 / cells))
+
+
+def exact_cells(db, query, zoom):
+    """Sightings, capped intensity and per-species counts of every cell, from the rows"""
+    cells = defaultdict(lambda: dict(sightings=0, intensity=0, species=Counter()))
+    for row in db(query).select(db.checklist.LATITUDE, db.checklist.LONGITUDE,
+                                db.sightings.species_id, db.sightings.OBSERVATION_COUNT):
+        cell = cells[cell_of(row.checklist.LATITUDE, row.checklist.LONGITUDE, zoom)]
+        count = 1 if row.sightings.OBSERVATION_COUNT is None else row.sightings.OBSERVATION_COUNT
+        cell['sightings'] += 1
+        cell['intensity'] += min(count, 10)
+        cell['species'][row.sightings.species_id] += count
+    return cells
+
+
+@pytest.mark.parametrize('zoom', [2, 5, 8, 11])
+def test_clusters_match_the_sightings_of_their_cells(db, zoom):
+    query = (db.sightings.checklist_id == db.checklist.id) & spatial.bounds_query(25, 45, -100, -70)
+    exact = exact_cells(db, query, zoom)
+    clusters = spatial.cluster_sightings(query, zoom)
+    assert len(clusters) == len(exact)
+    for cluster in clusters:
+        # The mean position of a cell's sightings lies in the cell
+        cell = exact[cell_of(cluster['lat'], cluster['lon'], zoom)]
+        assert (cluster['sightings'], cluster['intensity']) == (cell['sightings'], cell['intensity'])
+        top = max(cell['species'].values())
+        assert cell['species'][cluster['species_id']] == top
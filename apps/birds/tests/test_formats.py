@@ -0,0 +1,60 @@
+"""Binary point responses"""
+import json
+import struct
+import pytest
+from py4web import HTTP
+from apps.birds import formats
+
+
+def test_binary_sightings_errors_are_http_errors(db, action):
+    with pytest.raises(HTTP) as error:
+        action('get_bird_sightings', 'POST', dict(north=10, format='binary'))
+    assert error.value.status == 400
+    assert 'error' in action('get_bird_sightings', 'POST', dict(north=10))
+
+
+def decode_points(payload):
+    """Decode a binary points payload following the layout documented in formats.py"""
+    magic, count, flags, max_intensity = struct.unpack_from('<4sIIf', payload)
+    assert magic == formats.POINTS_MAGIC
+    offset, columns = 16, {}
+    layout = [('lat', 'f'), ('lon', 'f')]
+    if flags & formats.FLAG_CLUSTERED:
+        layout.append(('sightings', 'I'))
+    for name, code in layout + [('species', 'H'), ('intensity', 'B')]:
+        size = struct.calcsize(code)
+        # Every column can be viewed in place as a typed array
+        assert offset % size == 0, name
+        columns[name] = list(struct.unpack_from(f'<{count}{code}', payload, offset))
+        offset += count * size
+    names = json.loads(payload[offset:].decode('utf-8'))
+    return dict(columns, names=names, max_intensity=max_intensity, clustered=bool(flags & formats.FLAG_CLUSTERED))
+
+
+@pytest.mark.parametrize('sightings', [None, [1, 70000, 3]])
+def test_packed_points_round_trip(sightings):
+    lat, lon = [37.25, -12.5, 0.0], [-84.125, 151.0, 0.0]
+    names = ["Song Sparrow", "Étourneau sansonnet", None]
+    payload = formats.pack_points(lat, lon, [1, 255, 10], [2, 0, 1], names, sightings, 42.0 if sightings else 0.0)
+    decoded = decode_points(payload)
+    assert decoded['clustered'] == (sightings is not None)
+    assert (decoded['lat'], decoded['lon']) == (lat, lon)
+    assert decoded['intensity'] == [1, 255, 10]
+    assert [decoded['names'][index] for index in decoded['species']] == [None, "Song Sparrow", "Étourneau sansonnet"]
+    assert decoded.get('sightings') == sightings
+    assert decoded['max_intensity'] == (42.0 if sightings else 0.0)
+
+
+def test_binary_sightings_decode_to_the_json_points(db, action):
+    bounds = dict(north=45, south=25, east=-70, west=-100)
+    payload = action('get_bird_sightings', 'POST', dict(bounds, format='binary'))
+    decoded = decode_points(payload)
+    points = action('get_bird_sightings', 'POST', bounds)['sightings']
+    assert len(decoded['lat']) == len(points) > 0
+    binary = sorted(
+        (round(lat, 3), round(lon, 3), decoded['names'][species], intensity) for lat, lon, species, intensity in zip(
+            decoded['lat'], decoded['lon'], decoded['species'], decoded['intensity'])
+    )
+    assert binary == sorted(
+        (round(point['lat'], 3), round(point['lon'], 3), point['species'], point['intensity']) for point in points
+    )
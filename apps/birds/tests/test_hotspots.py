@@ -0,0 +1,97 @@
+"""Hotspot KD-tree: radius and nearest lookups match a brute-force haversine scan"""
+import time
+import random
+import pytest
+from apps.birds import spatial
+
+CENTRES = [(35.0, -80.0), (40.7, -74.0), (30.0, -97.0), (0.0, 179.9), (89.0, 10.0)]
+
+
+def brute_force(points, lat, lon):
+    """(point id, distance) of every point, nearest first"""
+    return sorted(
+        ((point_id, spatial.haversine_km(lat, lon, point_lat, point_lon))
+         for point_id, (point_lat, point_lon) in points.items()),
+        key=lambda result: result[1]
+    )
+
+
+def assert_matches(index, points):
+    for lat, lon in CENTRES:
+        expected = brute_force(points, lat, lon)
+        for radius_km in (1, 50, 500, 5000):
+            within = index.within(lat, lon, radius_km)
+            inside = [result for result in expected if result[1] <= radius_km]
+            # Only points right on the edge may differ between chord and haversine
+            assert {point_id for point_id, _ in within} ^ {point_id for point_id, _ in inside} <= {
+                point_id for point_id, distance in expected if abs(distance - radius_km) < 1e-6
+            }
+            assert [distance for _, distance in within] == pytest.approx(sorted(distance for _, distance in within))
+        for k in (1, 5, 40):
+            nearest = index.nearest(lat, lon, k)
+            assert [distance for _, distance in nearest] == pytest.approx([distance for _, distance in expected[:k]])
+
+
+@pytest.fixture
+def points(db):
+    return {row.id: (row.LATITUDE, row.LONGITUDE) for row in db(db.checklist).select(
+        db.checklist.id, db.checklist.LATITUDE, db.checklist.LONGITUDE
+    ) if row.LATITUDE is not None and row.LONGITUDE is not None}
+
+
+@pytest.fixture
+def index(db):
+    index = spatial.PointIndex()
+    index.load()
+    return index
+
+
+def wait_for_rebuild(index):
+    deadline = time.monotonic() + 10
+    while index._rebuilding and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not index._rebuilding
+
+
+def test_loaded_index_matches_brute_force(db, index, points):
+    assert_matches(index, points)
+
+
+def test_updated_index_matches_brute_force(db, index, points):
+    generator = random.Random(11)
+    point_ids = sorted(points)
+    # Enough changes to cross the rebuild threshold more than once
+    for step in range(300):
+        if step % 3 == 0:
+            point_id = point_ids[step]
+            index.remove(point_id)
+            points.pop(point_id, None)
+        else:
+            point_id = 10 ** 6 + step if step % 3 == 1 else point_ids[step]
+            lat, lon = generator.uniform(25, 45), generator.uniform(-100, -70)
+            index.add(point_id, lat, lon)
+            points[point_id] = (lat, lon)
+        if step % 100 == 0:
+            assert_matches(index, points)
+    wait_for_rebuild(index)
+    assert index._stale <= max(64, len(points) // 16)
+    assert_matches(index, points)
+
+
+def test_searches_use_the_old_tree_during_a_rebuild(db, index, points):
+    build = index._build
+    during = []
+
+    def build_then_search(entries):
+        # A search while the tree is being rebuilt still sees every point
+        during.append(index.nearest(35.0, -80.0, 5))
+        return build(entries)
+
+    index._build = build_then_search
+    for step in range(100):
+        index.add(10 ** 6 + step, 35.0 + step / 1000, -80.0)
+        points[10 ** 6 + step] = (35.0 + step / 1000, -80.0)
+    wait_for_rebuild(index)
+    assert during
+    assert during[0] == index.nearest(35.0, -80.0, 5)
+    assert_matches(index, points)
@@ -0,0 +1,71 @@
+"""get_top_contributors: the leaderboard"""
+import datetime
+from collections import defaultdict
+import pytest
+from apps.birds import aggregates, controllers
+
+
+def exact_leaderboard(db, since=None):
+    """Checklists and distinct species per observer, from the rows"""
+    checklists, species = defaultdict(set), defaultdict(set)
+    query = db.checklist.id > 0
+    if since is not None:
+        query &= db.checklist.OBSERVATION_DATE >= since
+    for row in db(query).select(
+            db.checklist.id, db.checklist.OBSERVER_ID, db.sightings.species_id,
+            left=db.sightings.on(db.sightings.checklist_id == db.checklist.id)):
+        checklists[row.checklist.OBSERVER_ID].add(row.checklist.id)
+        if row.sightings.species_id is not None:
+            species[row.checklist.OBSERVER_ID].add(row.sightings.species_id)
+    return {observer: (len(ids), len(species[observer])) for observer, ids in checklists.items()}
+
+
+def assert_ranked(ranking, exact, limit):
+    assert len(ranking) == min(limit, len(exact))
+    counts = [entry['total_observations'] for entry in ranking]
+    assert counts == sorted(counts, reverse=True)
+    for entry in ranking:
+        assert (entry['total_observations'], entry['unique_species']) == exact[entry['name']], entry
+    ranked = {entry['name'] for entry in ranking}
+    # Nobody left out has more checklists than the last one ranked
+    assert all(count <= counts[-1] for observer, (count, _) in exact.items() if observer not in ranked)
+
+
+def windows(db):
+    dates = sorted(row.OBSERVATION_DATE for row in db(db.checklist).select(db.checklist.OBSERVATION_DATE))
+    return [None, dates[0], dates[len(dates) // 2], dates[-1], dates[-1] + datetime.timedelta(days=1)]
+
+
+def test_top_contributors_limit_is_at_least_one(db, action):
+    result = action('get_top_contributors', 'GET', dict(limit='-1'))
+    assert len(result['contributors']) == 1
+
+
+@pytest.mark.parametrize('limit', [1, 5, 1000])
+def test_leaderboard_matches_the_rows(db, limit):
+    for since in windows(db):
+        assert_ranked(aggregates.leaderboard(limit, since), exact_leaderboard(db, since), limit)
+
+
+def test_leaderboard_follows_checklist_changes(db, monkeypatch):
+    monkeypatch.setattr(controllers, 'get_user_email', lambda: "leaderboard-test@example.com")
+    monkeypatch.setattr(controllers.analytics.engine, 'load_in_background', lambda: None)
+    species = db(db.species).select(db.species.COMMON_NAME, limitby=(0, 1)).first().COMMON_NAME
+    last = max(row.OBSERVATION_DATE for row in db(db.checklist).select(db.checklist.OBSERVATION_DATE))
+    submitted = [controllers.ChecklistManager.submit_checklist(dict(
+        speciesName=species, latitude=35.0, longitude=-80.0, observationDate=str(last),
+        species=[dict(COMMON_NAME=species, count=1)]
+    )) for _ in range(3)]
+    try:
+        assert all(result['status'] == 'success' for result in submitted), submitted
+        controllers.ChecklistManager.modify_checklist(
+            submitted[0]['checklist_id'], 'edit', dict(OBSERVATION_DATE=last - datetime.timedelta(days=400))
+        )
+        controllers.ChecklistManager.modify_checklist(submitted[1]['checklist_id'], 'delete')
+        for since in windows(db):
+            assert_ranked(aggregates.leaderboard(1000, since), exact_leaderboard(db, since), 1000)
+    finally:
+        # Submissions are committed: delete what is left of them
+        for result in submitted:
+            if result.get('checklist_id') and db.my_checklist(result['checklist_id']):
+                controllers.ChecklistManager.modify_checklist(result['checklist_id'], 'delete')
@@ -0,0 +1,69 @@
+"""Keyset pagination: walking the pages returns every row once, in order"""
+import datetime
+import pytest
+from apps.birds import pagination
+
+
+def walk(db, table, sort, limit=7, fields=None):
+    """The ids of every page of a listing, following the cursors"""
+    ids, after = [], None
+    while True:
+        rows, after = pagination.paginate(db, table, limit=limit, after=after, sort=sort, fields=fields)
+        assert len(rows) <= limit
+        ids += [row['id'] for row in rows]
+        if after is None:
+            return ids
+
+
+def expected(db, table, sort):
+    """The ids of a table in (sort field, id) order, NULLs lowest as on SQLite"""
+    name = sort.lstrip('-')
+    rows = db(table).select(table.id, table[name]).as_list()
+    if name == 'id':
+        rows.sort(key=lambda row: row['id'])
+    else:
+        rows.sort(key=lambda row: (row[name] is not None, '' if row[name] is None else row[name], row['id']))
+    ids = [row['id'] for row in rows]
+    return ids[::-1] if sort.startswith('-') else ids
+
+
+@pytest.fixture
+def listed(db):
+    """Extra rows with repeated and missing sort values, and user checklists"""
+    checklist, my_checklist = db.checklist, db.my_checklist
+    day, started = datetime.date(2021, 2, 3), datetime.time(8, 0)
+    for index in range(5):
+        checklist.insert(SAMPLING_EVENT_IDENTIFIER=f"TEST{index}", LATITUDE=37.0, LONGITUDE=-84.0,
+                         OBSERVATION_DATE=None if index % 2 else day, TIME_OBSERVATIONS_STARTED=started)
+        my_checklist.insert(COMMON_NAME="Song Sparrow", LATITUDE=37.0, LONGITUDE=-84.0,
+                            OBSERVATION_DATE=None if index == 4 else day + datetime.timedelta(days=index % 2),
+                            TIME_OBSERVATIONS_STARTED=started, user_email="test@example.com")
+    return db
+
+
+@pytest.mark.parametrize('tablename', sorted(pagination.SORT_FIELDS))
+def test_pages_cover_every_row_once(listed, tablename):
+    db = listed
+    table = db[tablename]
+    for name in ['id'] + pagination.SORT_FIELDS[tablename]:
+        for sort in (name, f"-{name}"):
+            ids = walk(db, table, sort)
+            assert len(ids) == len(set(ids)), sort
+            assert ids == expected(db, table, sort), sort
+
+
+def test_page_size_does_not_change_the_order(listed):
+    db = listed
+    sort = '-OBSERVATION_DATE'
+    reference = walk(db, db.checklist, sort, limit=1000)
+    for limit in (1, 2, 50):
+        assert walk(db, db.checklist, sort, limit=limit, fields=['LATITUDE']) == reference
+
+
+def test_cursor_of_another_sort_is_rejected(db):
+    rows, after = pagination.paginate(db, db.checklist, limit=5, sort='OBSERVATION_DATE')
+    assert after is not None
+    with pytest.raises(ValueError):
+        pagination.paginate(db, db.checklist, limit=5, after=after, sort='-OBSERVATION_DATE')
+    with pytest.raises(ValueError):
+        pagination.paginate(db, db.checklist, limit=5, after='not a cursor')
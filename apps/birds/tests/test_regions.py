@@ -0,0 +1,119 @@
+"""Region grids: rankings read from the grids match the SQL aggregation"""
+import os
+import random
+import pytest
+from apps.birds import regions, spatial, settings
+from apps.birds.response_cache import responses
+
+pytest.importorskip('numpy')
+
+
+def sql_top_species(db, bounds, limit):
+    """Species by summed observation count inside a box, from the sightings"""
+    query = (
+        (db.sightings.checklist_id == db.checklist.id) &
+        (db.sightings.species_id != None) &
+        spatial.bounds_query(*bounds)
+    )
+    total_count = db.sightings.OBSERVATION_COUNT.coalesce_zero().sum()
+    totals = [(row.sightings.species_id, row[total_count]) for row in db(query).select(
+        db.sightings.species_id, total_count, groupby=db.sightings.species_id
+    )]
+    return sorted(totals, key=lambda item: (-item[1], item[0]))[:limit]
+
+
+def boxes(count, seed=3):
+    """Boxes over the seeded area: arbitrary ones and ones on whole grid cells"""
+    generator = random.Random(seed)
+    degrees = settings.REGION_GRID_DEGREES
+    for index in range(count):
+        south, west = generator.uniform(25, 45), generator.uniform(-100, -70)
+        height, width = generator.uniform(0.5, 15), generator.uniform(0.5, 25)
+        if index % 2:
+            south, west = south // degrees * degrees, west // degrees * degrees
+            height, width = height // degrees * degrees + degrees, width // degrees * degrees + degrees
+        yield south, south + height, west, west + width
+
+
+@pytest.fixture
+def grid(db):
+    regions.grid.rebuild()
+    yield regions.grid
+    # Patched layers must not outlive the test's rolled back changes
+    regions.grid.invalidate()
+
+
+def test_grid_matches_sql(db, grid):
+    answered = 0
+    for bounds in boxes(40):
+        ranking = grid.top_species(bounds, 10)
+        if ranking is not None:
+            answered += 1
+            assert ranking == sql_top_species(db, bounds, 10), bounds
+    # The grids are meant to answer most boxes, not just fall back
+    assert answered >= 20
+    world = (-90, 90, -180, 180)
+    assert grid.top_species(world, 10) == sql_top_species(db, world, 10)
+
+
+def change_counts(db, grid, checklist):
+    """Raise a checklist's counts as a writer would; returns the contributions removed and added, and the version"""
+    removed = grid.contributions([checklist.id])
+    db(db.sightings.checklist_id == checklist.id).update(OBSERVATION_COUNT=db.sightings.OBSERVATION_COUNT + 1000)
+    version = responses.bump('checklist')['checklist']
+    return removed, grid.contributions([checklist.id]), version
+
+
+def test_patched_grid_matches_sql(db, grid):
+    checklist = db(db.checklist).select(orderby=db.checklist.id, limitby=(0, 1)).first()
+    meta, layers = grid._open()
+    before = layers.copy()
+    removed, added, version = change_counts(db, grid, checklist)
+    # Behind the (here uncommitted) version: not used until patched
+    assert grid.top_species((-90, 90, -180, 180), 10) is None
+    grid.apply(removed, added, version)
+    # Patched into a new file: the one mapped before is unchanged
+    assert (layers == before).all()
+    assert grid._open()[0]['version'] == version
+    degrees = settings.REGION_GRID_DEGREES
+    cell_south, cell_west = checklist.LATITUDE // degrees * degrees, checklist.LONGITUDE // degrees * degrees
+    around = (cell_south - 2, cell_south + 3, cell_west - 2, cell_west + 3)
+    # Whole cells only: answered from the patched layers
+    assert grid.top_species(around, 10) == sql_top_species(db, around, 10)
+    for bounds in boxes(20, seed=5):
+        ranking = grid.top_species(bounds, 10)
+        if ranking is not None:
+            assert ranking == sql_top_species(db, bounds, 10), bounds
+
+
+def test_patch_of_another_version_is_not_applied(db, grid):
+    checklist = db(db.checklist).select(orderby=db.checklist.id, limitby=(0, 1)).first()
+    meta = grid._open()[0]
+    removed, added, version = change_counts(db, grid, checklist)
+    grid.apply(removed, added, version + 1)
+    assert grid._read_meta() == meta
+
+
+def test_rebuilds_wait_for_the_building_process(db, grid, monkeypatch):
+    grid.invalidate()
+    marker = grid._path(regions.BUILDING_FILE)
+    open(marker, 'w').close()
+    try:
+        # Another process is building: no grid to answer from, and no second build
+        monkeypatch.setattr(grid, 'rebuild_in_background', lambda: None)
+        assert grid.top_species((-90, 90, -180, 180), 10) is None
+        assert not grid.rebuild()
+        assert grid._read_meta() is None
+    finally:
+        os.remove(marker)
+    assert grid.rebuild()
+    world = (-90, 90, -180, 180)
+    assert grid.top_species(world, 10) == sql_top_species(db, world, 10)
+
+
+def test_rebuild_is_dropped_when_writes_commit_during_the_read(db, grid, monkeypatch):
+    versions = iter(range(100))
+    monkeypatch.setattr(regions.analytics, 'data_version', lambda: next(versions))
+    meta = grid._read_meta()
+    assert not grid.rebuild()
+    assert grid._read_meta() == meta
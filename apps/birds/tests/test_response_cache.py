@@ -0,0 +1,124 @@
+"""Response cache: user checklist writes invalidate the cached analytics"""
+import inspect
+import pytest
+from py4web import response
+from apps.birds import analytics, controllers, formats, regions
+from apps.birds.response_cache import responses
+
+USER_EMAIL = "cache-test@example.com"
+# Cached actions, with the key of their species ranking
+CACHED_ACTIONS = {
+    'get_top_observed_birds': 'species_summary',
+    'get_region_statistics': 'species_summary',
+    'get_bird_observation_times': 'bird_times',
+}
+
+
+@pytest.fixture
+def client(bind_request):
+    """Calls an action through its response cache, and without it"""
+    class Client:
+        @staticmethod
+        def cached(name, parameters):
+            response.headers.pop('ETag', None)
+            bind_request('GET', parameters)
+            return getattr(controllers, name)(), response.headers.get('ETag')
+
+        @staticmethod
+        def fresh(name, parameters):
+            bind_request('GET', parameters)
+            return inspect.unwrap(getattr(controllers, name))()
+
+    return Client
+
+
+@pytest.fixture
+def user(monkeypatch):
+    monkeypatch.setattr(controllers, 'get_user_email', lambda: USER_EMAIL)
+    return USER_EMAIL
+
+
+def test_repeated_requests_are_cache_hits(db, client):
+    client.cached('get_top_observed_birds', {})
+    hits = responses.statistics()['hits']
+    result, etag = client.cached('get_top_observed_birds', {})
+    assert responses.statistics()['hits'] == hits + 1
+    assert etag is not None
+    assert result == client.fresh('get_top_observed_birds', {})
+
+
+def test_submit_edit_delete_invalidate_cached_results(db, client, user):
+    checklist = db(db.checklist).select(orderby=db.checklist.id, limitby=(0, 1)).first()
+    species = db(db.species).select(orderby=~db.species.id, limitby=(0, 1)).first().COMMON_NAME
+    lat, lon = checklist.LATITUDE, checklist.LONGITUDE
+    box = dict(north=lat + 1, south=lat - 1, east=lon + 1, west=lon - 1)
+    requests = [(name, box if name == 'get_region_statistics' else {}) for name in CACHED_ACTIONS]
+
+    def snapshot():
+        """Cached results and ETags of every request, checked against uncached results"""
+        answers = {}
+        for name, parameters in requests:
+            result, etag = client.cached(name, parameters)
+            assert etag is not None, name
+            assert result == client.fresh(name, parameters), name
+            answers[name] = (result, etag)
+        return answers
+
+    def top_species(answers, name):
+        return answers[name][0][CACHED_ACTIONS[name]][0]['species']
+
+    before = snapshot()
+    assert top_species(before, 'get_top_observed_birds') != species
+
+    submitted = controllers.ChecklistManager.submit_checklist(dict(
+        speciesName=species, latitude=lat, longitude=lon, observationDate='2021-05-01',
+        timeObservationsStarted='08:00:00', durationMinutes=100000,
+        species=[dict(COMMON_NAME=species, count=1000000)]
+    ))
+    assert submitted['status'] == 'success', submitted
+    added = snapshot()
+    for name, _ in requests:
+        assert added[name][1] != before[name][1], name
+        assert top_species(added, name) == species, name
+
+    # Moved out of the box
+    edited = controllers.ChecklistManager.modify_checklist(
+        submitted['checklist_id'], 'edit', dict(LATITUDE=lat + 10, LONGITUDE=lon)
+    )
+    assert edited['status'] == 'success', edited
+    moved = snapshot()
+    for name, _ in requests:
+        assert moved[name][1] != added[name][1], name
+    assert top_species(moved, 'get_region_statistics') != species
+    assert top_species(moved, 'get_top_observed_birds') == species
+
+    deleted = controllers.ChecklistManager.modify_checklist(submitted['checklist_id'], 'delete')
+    assert deleted['status'] == 'success', deleted
+    after = snapshot()
+    for name, _ in requests:
+        assert after[name][1] != moved[name][1], name
+        assert after[name][0] == before[name][0], name
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('binary', 'binary'), ('ndjson', 'ndjson'), ('json', 'json'), ('anything', 'json'), ('', 'json'),
+])
+def test_unknown_formats_are_answered_as_json(bind_request, value, expected):
+    bind_request('GET', dict(format=value))
+    assert formats.requested_format() == expected
+
+
+def test_engine_and_sql_answers_match(db, client, monkeypatch):
+    """Answers under one ETag come from the engine or from SQL: they must not differ"""
+    checklist = db(db.checklist).select(orderby=db.checklist.id, limitby=(0, 1)).first()
+    box = dict(north=checklist.LATITUDE + 1, south=checklist.LATITUDE - 1,
+               east=checklist.LONGITUDE + 1, west=checklist.LONGITUDE - 1)
+    requests = [(name, box if name == 'get_region_statistics' else {}) for name in CACHED_ACTIONS]
+    analytics.engine.load()
+    from_engine = [client.fresh(name, parameters) for name, parameters in requests]
+    monkeypatch.setattr(analytics.engine, 'load_in_background', lambda: None)
+    monkeypatch.setattr(regions.grid, 'rebuild_in_background', lambda: None)
+    analytics.engine.invalidate()
+    regions.grid.invalidate()
+    from_sql = [client.fresh(name, parameters) for name, parameters in requests]
+    assert from_sql == from_engine
@@ -0,0 +1,111 @@
+"""Seeding: batched inserts and syncing tables with their source files"""
+import os
+import datetime
+import pytest
+from apps.birds import ingest
+from apps.birds.models import DataSeeder
+
+PREFIX = "Seeding test"
+
+
+@pytest.fixture
+def species(db):
+    """The species table; species named by these tests are deleted afterwards"""
+    yield db.species
+    db.rollback()
+    db(db.species.COMMON_NAME.startswith(PREFIX)).delete()
+    db.commit()
+
+
+def test_flush_batch_drops_only_failing_rows(db, species):
+    existing = db(species).select(species.COMMON_NAME, limitby=(0, 1)).first().COMMON_NAME
+    batch = [dict(COMMON_NAME=f"{PREFIX} 1"), dict(COMMON_NAME=existing), dict(COMMON_NAME=f"{PREFIX} 2")]
+    assert DataSeeder._flush_batch(species, batch) == 2
+    assert batch == []
+    assert db(species.COMMON_NAME.startswith(PREFIX)).count() == 2
+
+
+def test_flush_batch_fails_on_unknown_fields(db, species):
+    batch = [dict(COMMON_NAME=f"{PREFIX} 1"), dict(COMMON_NAME=f"{PREFIX} 2", COMON_NAME="typo")]
+    with pytest.raises(RuntimeError, match="COMON_NAME"):
+        DataSeeder._flush_batch(species, batch)
+    db.rollback()
+    assert db(species.COMMON_NAME.startswith(PREFIX)).count() == 0
+
+
+CHECKLIST_HEADER = ("SAMPLING EVENT IDENTIFIER,LATITUDE,LONGITUDE,OBSERVATION DATE,"
+                    "TIME OBSERVATIONS STARTED,OBSERVER ID,DURATION MINUTES")
+CHECKLIST_FIELDS = ['SAMPLING_EVENT_IDENTIFIER', 'LATITUDE', 'LONGITUDE', 'OBSERVATION_DATE',
+                    'TIME_OBSERVATIONS_STARTED', 'OBSERVER_ID', 'DURATION_MINUTES']
+
+
+@pytest.fixture
+def checklist_file(db, tmp_path):
+    """Write a checklists CSV under a name of its own; its rows and manifest are deleted afterwards"""
+    path = tmp_path / 'sync_test_checklists.csv'
+
+    def write(*records):
+        path.write_text('\n'.join((CHECKLIST_HEADER,) + records) + '\n', encoding='utf-8')
+        return str(path)
+
+    yield write
+    db.rollback()
+    db(db.checklist.seed_source == path.name).delete()
+    db(db.seed_manifest.file_name == path.name).delete()
+    db.commit()
+
+
+
+def sync(db, path):
+    return DataSeeder.sync_table(
+        db.checklist, path, ingest.map_checklist_row, ['SAMPLING_EVENT_IDENTIFIER'], CHECKLIST_FIELDS,
+        verbose=False, validator=ingest.validate_checklist_rows
+    )
+
+
+def synced(db, path):
+    """The seeded rows of a file, by event id"""
+    return {row.SAMPLING_EVENT_IDENTIFIER: row for row in db(
+        db.checklist.seed_source == os.path.basename(path)
+    ).select()}
+
+
+def test_sync_table_applies_the_file_as_a_diff(db, checklist_file):
+    path = checklist_file(
+        "SYNC1,35.0,-80.0,2021-05-01,08:00:00,obs1,30",
+        "SYNC2,36.0,-81.0,2021-05-02,09:00:00,obs2,45",
+        "SYNC3,37.0,-82.0,2021-05-03,10:00:00,obs3,60",
+    )
+    assert sync(db, path)
+    assert sorted(synced(db, path)) == ['SYNC1', 'SYNC2', 'SYNC3']
+    # Unchanged: skipped on size and mtime, then on the hash once touched
+    assert not sync(db, path)
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+    assert not sync(db, path)
+
+    before = synced(db, path)
+    path = checklist_file(
+        "SYNC1,35.0,-80.0,2021-05-01,08:00:00,obs1,30",
+        "SYNC3,37.5,-82.0,2021-05-03,10:00:00,obs3,60",
+        "SYNC4,38.0,-83.0,2021-05-04,11:00:00,obs4,90",
+    )
+    assert sync(db, path)
+    after = synced(db, path)
+    assert sorted(after) == ['SYNC1', 'SYNC3', 'SYNC4']
+    # Unchanged and updated rows keep their ids
+    assert after['SYNC1'].id == before['SYNC1'].id
+    assert after['SYNC3'].id == before['SYNC3'].id
+    assert after['SYNC3'].LATITUDE == 37.5
+    assert after['SYNC4'].OBSERVATION_DATE == datetime.date(2021, 5, 4)
+    assert db.checklist(before['SYNC2'].id) is None
+
+
+def test_sync_table_leaves_other_rows_alone(db, checklist_file):
+    others = db(db.checklist.seed_source != 'sync_test_checklists.csv').count()
+    path = checklist_file("SYNC1,35.0,-80.0,2021-05-01,08:00:00,obs1,30")
+    assert sync(db, path)
+    path = checklist_file()
+    assert sync(db, path)
+    assert synced(db, path) == {}
+    assert db(db.checklist.seed_source != 'sync_test_checklists.csv').count() == others
@@ -0,0 +1,99 @@
+"""Sketches: the approximate answers bound the exact ones"""
+import random
+from collections import Counter
+import pytest
+from apps.birds import sketches
+from apps.birds.sketches import TopItems, HyperLogLog
+
+
+def exact_region(db, bounds):
+    """Exact checklists, species totals and distinct counts of the sketch cells overlapping a box"""
+    south, north, west, east = bounds
+    south_cell, west_cell = sketches.cell_of(south, west)
+    north_cell, east_cell = sketches.cell_of(north, east)
+    checklists, totals, observers = 0, Counter(), set()
+    for checklist in db(db.checklist).select(db.checklist.id, db.checklist.LATITUDE,
+                                             db.checklist.LONGITUDE, db.checklist.OBSERVER_ID):
+        cell = sketches.cell_of(checklist.LATITUDE, checklist.LONGITUDE)
+        if cell is None or not (south_cell <= cell[0] <= north_cell and west_cell <= cell[1] <= east_cell):
+            continue
+        checklists += 1
+        observers.add(checklist.OBSERVER_ID)
+        for sighting in db(db.sightings.checklist_id == checklist.id).select(
+                db.sightings.species_id, db.sightings.OBSERVATION_COUNT):
+            if sighting.species_id is not None:
+                totals[sighting.species_id] += sighting.OBSERVATION_COUNT or 0
+    return checklists, totals, observers
+
+
+@pytest.mark.parametrize('bounds', [
+    (-90, 90, -180, 180),
+    (30.5, 40.25, -90, -75.5),
+    (35, 36, -85, -84),
+])
+def test_region_summary_bounds_the_exact_totals(db, bounds):
+    summary = sketches.region_summary(bounds, 1000)
+    checklists, totals, observers = exact_region(db, bounds)
+    assert summary['checklists'] == checklists
+    for species_id, upper, lower in summary['top_species']:
+        assert lower <= totals[species_id] <= upper
+    ranked = {species_id for species_id, _, _ in summary['top_species']}
+    if len(totals) <= sketches.TOP_ITEMS:
+        assert ranked == set(totals)
+    distinct = summary['distinct_species']
+    assert distinct['low'] <= len(totals) <= distinct['high']
+    distinct = summary['distinct_observers']
+    assert distinct['low'] <= len(observers) <= distinct['high']
+
+
+def test_top_contributors_bounds_the_exact_counts(db):
+    exact = Counter(row.OBSERVER_ID for row in db(db.checklist).select(db.checklist.OBSERVER_ID))
+    ranking = sketches.top_contributors(20)
+    assert ranking['contributors']
+    for observer, upper, lower in ranking['contributors']:
+        assert lower <= exact[observer] <= upper
+
+
+def test_top_items_merge_bounds_every_item():
+    generator = random.Random(7)
+    exact, summaries = Counter(), []
+    for part in range(5):
+        summary = TopItems()
+        # Skewed weights over more items than a summary keeps, so items get dropped
+        for _ in range(2000):
+            item = f"item{generator.randrange(10) if generator.random() < 0.5 else generator.randrange(300)}"
+            weight = generator.randint(1, 5)
+            summary.add(item, weight)
+            exact[item] += weight
+        assert len(summary.items) <= sketches.TOP_ITEMS
+        summaries.append(summary if part % 2 else summary.to_json())
+    merged = TopItems.merge(summaries)
+    floor = sum(TopItems.from_json(s).floor if isinstance(s, str) else s.floor for s in summaries)
+    assert floor > 0
+    for item, (upper, lower) in merged.items():
+        assert lower <= exact[item] <= upper
+    # Items no summary kept weigh at most the summed floors
+    for item, weight in exact.items():
+        if item not in merged:
+            assert weight <= floor
+
+
+def test_top_items_from_counts_is_exact():
+    counts = {f"item{index}": index for index in range(1, 100)}
+    merged = TopItems.merge([TopItems.from_counts(counts)])
+    assert len(merged) == sketches.TOP_ITEMS
+    for item, (upper, lower) in merged.items():
+        assert lower == counts[item]
+        assert upper >= counts[item]
+
+
+def test_hyperloglog_merge_matches_the_union():
+    left, right, union = HyperLogLog(), HyperLogLog(), HyperLogLog()
+    for value in range(3000):
+        (left if value % 2 else right).add(value)
+        union.add(value)
+    merged = HyperLogLog.from_bytes(left.to_bytes())
+    merged.update_bytes(right.to_bytes())
+    assert merged.registers == union.registers
+    bounds = merged.bounds()
+    assert bounds['low'] <= 3000 <= bounds['high']
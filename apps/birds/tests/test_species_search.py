@@ -0,0 +1,71 @@
+"""search_species: parameter validation and the ranked species index"""
+import pytest
+from apps.birds import species_search
+
+
+@pytest.mark.parametrize('parameters', [
+    dict(q='sp', limit='-1'),
+    dict(q='sp', limit='0'),
+    dict(q='sp', limit='many'),
+    dict(q='sp', min_obs='some'),
+])
+def test_search_species_rejects_invalid_parameters(db, action, parameters):
+    assert 'error' in action('search_species', 'GET', parameters)
+
+
+def test_search_species_limit(db, action):
+    assert len(action('search_species', 'GET', dict(limit='3'))['species']) == 3
+
+
+def expected_ranking(db, query, min_observations=0):
+    """Every species matching a query, ranked from the rows: prefix, word start, substring, then popularity"""
+    totals = {row.species_id: row.total_count for row in db(db.species_totals).select()}
+    ranked = []
+    for row in db(db.species).select():
+        name = species_search.normalize(row.COMMON_NAME)
+        popularity = totals.get(row.id) or 0
+        if query not in name or popularity < min_observations:
+            continue
+        if name.startswith(query):
+            tier = species_search.PREFIX
+        elif any(word.startswith(query) for word in name.split()):
+            tier = species_search.WORD
+        else:
+            tier = species_search.SUBSTRING
+        ranked.append(((tier, -popularity, name), row.id))
+    return [species_id for _, species_id in sorted(ranked)]
+
+
+@pytest.fixture
+def index(db):
+    index = species_search.SpeciesIndex()
+    index.load()
+    return index
+
+
+@pytest.mark.parametrize('query', ['war', 'ow', 'red', 'spar', 'er', 'a'])
+def test_search_ranks_prefix_word_and_substring_matches(db, index, query):
+    expected = expected_ranking(db, query)
+    assert expected
+    assert [row['id'] for row in index.search(query)] == expected
+    assert [row['id'] for row in index.search(query.upper(), limit=5)] == expected[:5]
+
+
+def test_search_min_observations(db, index):
+    assert [row['id'] for row in index.search('war', min_observations=50)] == expected_ranking(db, 'war', 50)
+
+
+def test_search_tolerates_typos(db, index):
+    results = index.search('warblr', limit=5)
+    assert results
+    assert all('warbler' in species_search.normalize(row['COMMON_NAME']) for row in results[:3])
+
+
+def test_stale_index_is_searched_while_another_thread_reloads(db, index):
+    name = "Zzyzx Test Bird"
+    db.species.insert(COMMON_NAME=name)
+    index.invalidate()
+    # Another thread is reloading: the old index answers without waiting
+    with index._load_lock:
+        assert index.search('zzyzx') == []
+    assert [row['COMMON_NAME'] for row in index.search('zzyzx')] == [name]
@@ -0,0 +1,51 @@
+"""Heatmap tiles: cells stay inside their tile, so tiles split and add up exactly"""
+import json
+import inspect
+import pytest
+from apps.birds import controllers, spatial, tiles
+
+
+@pytest.fixture
+def tile(db, bind_request):
+    """Render a tile from the rows, bypassing the tile cache"""
+    tiles.tile_cache.clear()
+
+    def render(z, x, y):
+        bind_request('GET', {})
+        payload = inspect.unwrap(controllers.get_heatmap_tile)(z, x, y)
+        tiles.tile_cache.clear()
+        return json.loads(payload)['cells']
+    return render
+
+
+def sightings_in(db, bounds):
+    return db((db.sightings.checklist_id == db.checklist.id) & spatial.bounds_query(*bounds)).count()
+
+
+@pytest.mark.parametrize('zoom', [3, 6, 9])
+def test_tile_cells_add_up_across_zoom_levels(db, tile, zoom):
+    if not spatial._has_math_functions():
+        pytest.skip("cells follow tile rows only with SQL math functions")
+    checklist = db(db.checklist).select(orderby=db.checklist.id, limitby=(0, 1)).first()
+    _, x, y = list(tiles.tiles_for_point(checklist.LATITUDE, checklist.LONGITUDE, zoom))[-1]
+    parent = tile(zoom, x, y)
+    assert parent
+    total = 0
+    for child_x in (2 * x, 2 * x + 1):
+        for child_y in (2 * y, 2 * y + 1):
+            south, north, west, east = bounds = tiles.tile_bounds(zoom + 1, child_x, child_y)
+            cells = tile(zoom + 1, child_x, child_y)
+            for cell in cells:
+                assert south <= cell['lat'] <= north and west <= cell['lon'] <= east, cell
+            sightings = sum(cell['sightings'] for cell in cells)
+            assert sightings == sightings_in(db, bounds)
+            total += sightings
+    # No cell straddles a tile edge, so the children hold the parent's sightings
+    assert total == sum(cell['sightings'] for cell in parent) == sightings_in(db, tiles.tile_bounds(zoom, x, y))
+
+
+def test_tile_cells_lie_in_the_tile(db, tile):
+    for z, x, y in [(0, 0, 0), (1, 0, 0), (2, 1, 1), (4, 4, 6)]:
+        south, north, west, east = tiles.tile_bounds(z, x, y)
+        for cell in tile(z, x, y):
+            assert south <= cell['lat'] <= north and west <= cell['lon'] <= east, (z, x, y, cell)
@@ -0,0 +1,11 @@
+"""get_species_time_series: periods and limits"""
+
+
+def test_time_series_limit_is_at_least_one(db, action):
+    species = db(db.species_totals).select(
+        db.species_totals.species_id, orderby=~db.species_totals.total_count, limitby=(0, 1)
+    ).first().species_id
+    name = db.species(species).COMMON_NAME
+    result = action('get_species_time_series', 'POST', dict(species=name, limit=-1))
+    assert 'error' not in result, result
+    assert len(result['time_series']) == 1
@@ -0,0 +1,135 @@
+"""Uploads: committed batches keep the summaries, sketches and indexes as a rebuild would"""
+import io
+import uuid
+import inspect
+import pytest
+from py4web import request
+from apps.birds import aggregates, analytics, controllers, regions, sketches, spatial
+from apps.birds.response_cache import responses
+
+USER_EMAIL = "upload-test@example.com"
+PREFIX = "UPLOADTEST"
+SPECIES = "Upload test bird"
+
+CHECKLISTS = """SAMPLING EVENT IDENTIFIER,LATITUDE,LONGITUDE,OBSERVATION DATE,TIME OBSERVATIONS STARTED,OBSERVER ID,DURATION MINUTES
+{prefix}1,36.5,-81.5,2021-06-01,07:00:00,obs1644106,45
+{prefix}2,36.6,-81.4,2021-06-02,08:00:00,{prefix}-observer,30
+{existing},36.7,-81.3,2021-06-03,09:00:00,obs1,60
+"""
+
+SIGHTINGS = """SAMPLING EVENT IDENTIFIER,COMMON NAME,OBSERVATION COUNT
+{prefix}1,{known},12
+{prefix}1,{species},3
+{prefix}2,{known},X
+{existing},{species},7
+"""
+
+
+@pytest.fixture
+def uploads(db, monkeypatch):
+    """Posts upload bodies as a user; the committed rows are deleted and the summaries rebuilt afterwards"""
+    monkeypatch.setattr(controllers, 'get_user_email', lambda: USER_EMAIL)
+    # Background loads would run on the other tests' data
+    monkeypatch.setattr(analytics.engine, 'load_in_background', lambda: None)
+    monkeypatch.setattr(regions.grid, 'rebuild_in_background', lambda: None)
+
+    def upload(kind, body, upload_id=None):
+        body = body.encode('utf-8')
+        request.__init__({
+            'REQUEST_METHOD': 'POST',
+            'PATH_INFO': '/internal',
+            'QUERY_STRING': f"kind={kind}&upload_id={upload_id or uuid.uuid4().hex}",
+            'CONTENT_TYPE': 'text/csv',
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': io.BytesIO(body),
+        })
+        return inspect.unwrap(controllers.upload_observations)()
+
+    yield upload
+    db.rollback()
+    db(db.sightings.SAMPLING_EVENT_IDENTIFIER.startswith(PREFIX)).delete()
+    db(db.sightings.COMMON_NAME == SPECIES).delete()
+    db(db.checklist.SAMPLING_EVENT_IDENTIFIER.startswith(PREFIX)).delete()
+    db(db.species.COMMON_NAME == SPECIES).delete()
+    db(db.upload_progress.owner == USER_EMAIL).delete()
+    aggregates.rebuild(verbose=False)
+    sketches.rebuild(verbose=False)
+    responses.bump()
+    db.commit()
+    analytics.engine.invalidate()
+    regions.grid.invalidate()
+    spatial.checklist_index.load()
+
+
+def summaries(db):
+    """Every summary table's rows, and the exact parts of the sketch rows"""
+    tables = {
+        table._tablename: sorted(tuple(row.values())[1:] for row in db(table).select().as_list())
+        for table, *_ in aggregates._summaries()
+    }
+    sketch = db.region_sketches
+    tables['region_sketches'] = sorted(
+        (row.cell_lat, row.cell_lon, str(row.OBSERVATION_DATE), row.checklists, row.species_hll, row.observer_hll)
+        for row in db(sketch).select()
+    )
+    return tables
+
+
+def assert_as_rebuilt(db):
+    applied = summaries(db)
+    aggregates.rebuild(verbose=False)
+    sketches.rebuild(verbose=False)
+    assert summaries(db) == applied
+
+
+def test_upload_applies_its_batches(db, uploads, monkeypatch):
+    existing = db(db.checklist).select(orderby=db.checklist.id, limitby=(0, 1)).first()
+    known = db(db.species).select(orderby=db.species.id, limitby=(0, 1)).first().COMMON_NAME
+    values = dict(prefix=PREFIX, existing=existing.SAMPLING_EVENT_IDENTIFIER, known=known, species=SPECIES)
+    analytics.engine.load()
+    monkeypatch.setattr(analytics.engine, '_read', lambda: pytest.fail("reloaded"))
+    uploaded = uploads('checklists', CHECKLISTS.format(**values))
+    assert uploaded['status'] == 'success', uploaded
+    # The existing event is rejected as a duplicate
+    assert (uploaded['inserted'], uploaded['rejected']) == (2, 1)
+    assert_as_rebuilt(db)
+
+    uploaded = uploads('sightings', SIGHTINGS.format(**values))
+    assert uploaded['status'] == 'success', uploaded
+    assert uploaded['inserted'] == 4
+    # Applied to the columns without reloading them
+    assert analytics.engine._version == analytics.data_version()
+    assert db(db.sightings.SAMPLING_EVENT_IDENTIFIER.startswith(PREFIX) & (
+        (db.sightings.checklist_id == None) | (db.sightings.species_id == None))).isempty()
+    assert_as_rebuilt(db)
+
+    fresh = analytics.ColumnStore()
+    fresh.load()
+    assert analytics.engine.top_species('count', 50) == fresh.top_species('count', 50)
+    added = db(db.checklist.SAMPLING_EVENT_IDENTIFIER.startswith(PREFIX)).select()
+    for checklist in added:
+        assert spatial.checklist_index.nearest(checklist.LATITUDE, checklist.LONGITUDE, 1)[0][0] == checklist.id
+
+
+def test_sightings_without_a_checklist_count_once_linked(db, uploads):
+    known = db(db.species).select(orderby=db.species.id, limitby=(0, 1)).first().COMMON_NAME
+    values = dict(prefix=PREFIX, existing=f"{PREFIX}0", known=known, species=SPECIES)
+    # Sightings first: their checklists arrive with the next upload
+    assert uploads('sightings', SIGHTINGS.format(**values))['status'] == 'success'
+    assert_as_rebuilt(db)
+    assert uploads('checklists', CHECKLISTS.format(**values))['status'] == 'success'
+    assert db(db.sightings.SAMPLING_EVENT_IDENTIFIER.startswith(PREFIX) & (db.sightings.checklist_id == None)).isempty()
+    assert_as_rebuilt(db)
+
+
+def test_upload_progress_is_stored_for_its_owner(db, uploads, monkeypatch):
+    upload_id = uuid.uuid4().hex
+    known = db(db.species).select(orderby=db.species.id, limitby=(0, 1)).first().COMMON_NAME
+    values = dict(prefix=PREFIX, existing=f"{PREFIX}0", known=known, species=SPECIES)
+    uploaded = uploads('checklists', CHECKLISTS.format(**values), upload_id)
+    assert uploads('checklists', CHECKLISTS.format(**values), upload_id)['message'] == "upload_id is already in use"
+    progress = inspect.unwrap(controllers.upload_progress)(upload_id)
+    assert progress == uploaded
+    assert progress['status'] == 'success' and progress['inserted'] == 3
+    monkeypatch.setattr(controllers, 'get_user_email', lambda: "someone-else@example.com")
+    assert inspect.unwrap(controllers.upload_progress)(upload_id)['message'] == "Unknown upload id"
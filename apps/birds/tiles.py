@@ -0,0 +1,205 @@
+"""
+This file defines the slippy-map tile math and the cache of heatmap tiles
+
+Heatmap density is served per standard z/x/y web-map tile, so the same tile
+is requested by every client browsing the same area. Rendered tiles are kept
+as JSON files on disk, with an in-memory LRU in front of them. A memory entry
+is only used while its file is unchanged on disk, so removing a file (when a
+checklist inside the tile changes) invalidates the tile for every process
+sharing the cache folder.
+"""
+import os
+import glob
+import math
+import shutil
+import threading
+from collections import OrderedDict
+from . import settings
+
+# Web Mercator stops at about +-85.05 degrees latitude
+MAX_LATITUDE = math.degrees(math.atan(math.sinh(math.pi)))
+
+
+def tile_bounds(z, x, y):
+    """
+    Geographic bounds of a web-map tile
+
+    Returns:
+        tuple: (south, north, west, east) in degrees
+    """
+    n = 2 ** z
+
+    def latitude(tile_y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * tile_y / n))))
+
+    return latitude(y + 1), latitude(y), x / n * 360.0 - 180.0, (x + 1) / n * 360.0 - 180.0
+
+
+def tiles_for_point(lat, lon, max_zoom=None):
+    """
+    The tiles containing a point, one per zoom level
+
+    Args:
+        lat, lon (float): Point coordinates
+        max_zoom (int, optional): Highest zoom level (default: settings.TILE_MAX_ZOOM)
+
+    Yields:
+        tuple: (z, x, y)
+    """
+    lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))
+    mercator_y = (1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2
+    for z in range(0, (settings.TILE_MAX_ZOOM if max_zoom is None else max_zoom) + 1):
+        n = 2 ** z
+        x = min(n - 1, max(0, int((lon + 180.0) / 360.0 * n)))
+        y = min(n - 1, max(0, int(mercator_y * n)))
+        yield z, x, y
+
+
+class TileCache:
+    """
+    Two-level cache of rendered tiles, keyed by (z, x, y, variant)
+
+    Tiles are stored as <folder>/<z>/<x>/<y>/<variant>.json, where the variant
+    distinguishes e.g. per-species tiles. At most memory_items tiles are kept
+    in memory (least recently used first out).
+
+    The number of files on disk is counted once, then kept up to date as new
+    files are written; once it goes over disk_items, a background thread
+    prunes the oldest files down to nine tenths of disk_items and recounts
+    them. Files written or removed by other processes are only seen by the
+    next count.
+    """
+
+    def __init__(self, folder, memory_items, disk_items):
+        self.folder = folder
+        self.memory_items = memory_items
+        self.disk_items = disk_items
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        # Tile files on disk, None until counted
+        self._files = None
+        self._pruning = False
+
+    def _tile_folder(self, z, x, y):
+        return os.path.join(self.folder, str(z), str(x), str(y))
+
+    def _path(self, key):
+        z, x, y, variant = key
+        return os.path.join(self._tile_folder(z, x, y), f"{variant}.json")
+
+    def _remember(self, key, payload, mtime):
+        with self._lock:
+            self._memory[key] = (payload, mtime)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_items:
+                self._memory.popitem(last=False)
+
+    def get(self, key):
+        """
+        Retrieve a cached tile
+
+        Returns:
+            str: The tile's JSON, or None if it is not cached
+        """
+        path = self._path(key)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            with self._lock:
+                self._memory.pop(key, None)
+            return None
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and entry[1] == mtime:
+                self._memory.move_to_end(key)
+                return entry[0]
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                payload = f.read()
+        except FileNotFoundError:
+            return None
+        self._remember(key, payload, mtime)
+        return payload
+
+    def put(self, key, payload):
+        """
+        Store a rendered tile
+
+        Args:
+            key (tuple): (z, x, y, variant)
+            payload (str): The tile's JSON
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, so readers never see a partial file
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(payload)
+        created = not os.path.exists(path)
+        os.replace(temp_path, path)
+        self._remember(key, payload, os.stat(path).st_mtime_ns)
+        with self._lock:
+            if created and self._files is not None:
+                self._files += 1
+            prune = not self._pruning and (self._files is None or self._files > self.disk_items)
+            if prune:
+                self._pruning = True
+        if prune:
+            threading.Thread(target=self._prune_in_background, daemon=True).start()
+
+    def _prune_in_background(self):
+        try:
+            self.prune()
+        finally:
+            with self._lock:
+                self._pruning = False
+
+    def prune(self):
+        """Count the tile files, and remove the oldest ones if there are more than disk_items"""
+        paths = glob.glob(os.path.join(self.folder, '*', '*', '*', '*.json'))
+        if len(paths) <= self.disk_items:
+            with self._lock:
+                self._files = len(paths)
+            return
+        aged = []
+        for path in paths:
+            try:
+                aged.append((os.stat(path).st_mtime_ns, path))
+            except FileNotFoundError:
+                pass
+        aged.sort()
+        # Leave room, so the next prune is not due after a few writes
+        keep = self.disk_items * 9 // 10
+        for _, path in aged[:len(aged) - keep]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self._files = min(len(aged), keep)
+
+    def invalidate_point(self, lat, lon):
+        """Drop every cached tile (all zoom levels and variants) containing a point"""
+        if lat is None or lon is None:
+            return
+        tiles = set(tiles_for_point(lat, lon))
+        for z, x, y in tiles:
+            shutil.rmtree(self._tile_folder(z, x, y), ignore_errors=True)
+        with self._lock:
+            for key in [key for key in self._memory if key[:3] in tiles]:
+                del self._memory[key]
+
+    def clear(self):
+        """Drop every cached tile"""
+        shutil.rmtree(self.folder, ignore_errors=True)
+        with self._lock:
+            self._memory.clear()
+            if self._files is not None:
+                self._files = 0
+
+
+tile_cache = TileCache(
+    settings.TILE_CACHE_FOLDER,
+    settings.TILE_CACHE_MEMORY_ITEMS,
+    settings.TILE_CACHE_DISK_ITEMS
+)
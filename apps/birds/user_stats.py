@@ -0,0 +1,162 @@
+"""
+This file defines the per-user statistics behind the stats page
+
+A user's statistics (species summary, monthly trends, locations and date
+range) are computed from their checklists joined to their sightings, and
+cached per user. Checklist submissions, edits and deletes invalidate the
+submitting user's entry; entries also expire after
+settings.USER_STATS_CACHE_SECONDS, so writes handled by other worker
+processes show up eventually.
+"""
+import time
+import threading
+from collections import OrderedDict
+from .common import db, settings
+
+
+class UserStatistics:
+    """Computes and caches the statistics of each user's checklists"""
+
+    _cache = OrderedDict()
+    _lock = threading.Lock()
+    # Bumped on every invalidation, so statistics computed concurrently
+    # with a write are not cached
+    _generation = 0
+
+    @classmethod
+    def get(cls, user_email):
+        """
+        Retrieve a user's statistics, computing them if not cached
+
+        Args:
+            user_email (str): The user's email
+
+        Returns:
+            dict: Statistics (see compute)
+        """
+        now = time.monotonic()
+        with cls._lock:
+            entry = cls._cache.get(user_email)
+            if entry is not None and now - entry[0] < settings.USER_STATS_CACHE_SECONDS:
+                cls._cache.move_to_end(user_email)
+                return entry[1]
+            generation = cls._generation
+
+        statistics = cls.compute(user_email)
+        with cls._lock:
+            if generation != cls._generation:
+                return statistics
+            cls._cache[user_email] = (now, statistics)
+            cls._cache.move_to_end(user_email)
+            while len(cls._cache) > settings.USER_STATS_CACHE_ITEMS:
+                cls._cache.popitem(last=False)
+        return statistics
+
+    @classmethod
+    def invalidate(cls, user_email):
+        """Drop a user's cached statistics"""
+        with cls._lock:
+            cls._generation += 1
+            cls._cache.pop(user_email, None)
+
+    @classmethod
+    def clear(cls):
+        """Drop every cached statistics entry"""
+        with cls._lock:
+            cls._generation += 1
+            cls._cache.clear()
+
+    @staticmethod
+    def compute(user_email):
+        """
+        Compute a user's statistics from their checklists and sightings
+
+        The user's checklists are joined to their sightings once grouped per
+        species (totals and summed positions, for the species summary and
+        locations) and once grouped per checklist (dates and sighting counts,
+        for the date range and monthly trends); letting the database group
+        is several times faster than folding every sighting row in Python.
+
+        Monthly trends count sightings per observation month; each species'
+        location is the mean position of its sightings.
+
+        Args:
+            user_email (str): The user's email
+
+        Returns:
+            dict: total_observations, total_checklists, unique_species,
+                species_summary, most_observed_species, monthly_trends,
+                location_data, first_observation and last_observation
+        """
+        sightings, my_checklist = db.sightings, db.my_checklist
+        species_rows = db.executesql(db(
+            (my_checklist.user_email == user_email) &
+            (sightings.checklist_id == my_checklist.checklist_id)
+        )._select(
+            sightings.species_id,
+            sightings.OBSERVATION_COUNT.sum(),
+            sightings.id.count(),
+            my_checklist.LATITUDE.sum(),
+            my_checklist.LONGITUDE.sum(),
+            groupby=sightings.species_id
+        ))
+        checklist_rows = db.executesql(db(my_checklist.user_email == user_email)._select(
+            my_checklist.id,
+            my_checklist.OBSERVATION_DATE,
+            sightings.id.count(),
+            left=sightings.on(sightings.checklist_id == my_checklist.checklist_id),
+            groupby=my_checklist.id
+        ))
+
+        first_observation = last_observation = None
+        monthly_trends = {}
+        for _, observation_date, sighting_count in checklist_rows:
+            if not observation_date:
+                continue
+            # Raw dates are strings on SQLite and date objects elsewhere
+            observation_date = str(observation_date)[:10]
+            first_observation = min(first_observation or observation_date, observation_date)
+            last_observation = max(last_observation or observation_date, observation_date)
+            if sighting_count:
+                month = observation_date[:7]
+                monthly_trends[month] = monthly_trends.get(month, 0) + sighting_count
+
+        species_rows = [row for row in species_rows if row[0] is not None]
+        names = db(db.species.id.belongs([row[0] for row in species_rows])).select(
+            db.species.id, db.species.COMMON_NAME
+        )
+        names = {row.id: row.COMMON_NAME for row in names}
+        total_observations = sum(row[1] or 0 for row in species_rows)
+        species_summary = sorted(
+            (
+                {
+                    'species': names.get(species_id),
+                    'total_count': count or 0,
+                    'percentage': ((count or 0) / total_observations * 100) if total_observations > 0 else 0
+                } for species_id, count, _, _, _ in species_rows
+            ),
+            key=lambda x: x['total_count'],
+            reverse=True
+        )
+
+        return dict(
+            total_observations=total_observations,
+            total_checklists=len(checklist_rows),
+            unique_species=len(species_rows),
+            species_summary=species_summary,
+            most_observed_species={
+                'name': species_summary[0]['species'] if species_summary else None,
+                'count': species_summary[0]['total_count'] if species_summary else 0
+            },
+            monthly_trends=dict(sorted(monthly_trends.items())),
+            location_data=[
+                {
+                    'species': names.get(species_id),
+                    'avg_latitude': latitude / sighting_count,
+                    'avg_longitude': longitude / sighting_count,
+                    'location_count': sighting_count
+                } for species_id, _, sighting_count, latitude, longitude in species_rows
+            ],
+            first_observation=first_observation,
+            last_observation=last_observation
+        )